@@ -0,0 +1,458 @@
+# alchemy_storage.py
+#
+# SQLAlchemy backend with the same interface as SqlStorage. Point DATABASE_URL
+# (ATTENDANCE_DATABASE_URL) at a server database and every Streamlit replica or
+# API process shares one pooled store; with the default sqlite:/// URL it works
+# on the existing attendance.db.
+
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+from sqlalchemy import (
+    Column, Float, Index, Integer, MetaData, String, Table, Text,
+    create_engine, delete, func, insert, inspect, select, update,
+)
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+
+from idempotency import RecentPunches, run_deduplicated
+from storage import (
+    ACCESS_VERSION_KEY, ADMIN_PHONES, DEFAULT_DASHBOARD_PW, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE_SECONDS,
+    CHANGE_COLUMNS, change_rows, hash_pw, migrate_legacy_whitelist, new_access_version, notify, report_error,
+)
+
+ACTIONS = ("IN", "OUT", "WFH IN", "WFH OUT", "LEAVE")
+CHANGE_LOG_LOCK = "change_log_lock"  # settings row every feed writer updates before appending (see _log)
+
+metadata = MetaData()
+users = Table(
+    "users", metadata,
+    Column("PhoneNumber", String(32), primary_key=True),
+    Column("Name", String(255)),
+    Column("Departments", Text),
+    Column("PasswordHash", String(128)),
+    Column("Role", String(32)),
+)
+attendance = Table(
+    "attendance", metadata,
+    Column("Date", String(10), primary_key=True),
+    Column("Name", String(255)),
+    Column("PhoneNumber", String(32), primary_key=True),
+    Column("IN_TIME", String(8)),
+    Column("OUT_TIME", String(8)),
+    Column("WFH", String(3)),
+    Column("Leave", String(3)),
+    Column("Departments", Text),
+    Column("Office", Text),
+    Index("ix_attendance_phone", "PhoneNumber"),
+)
+offices = Table(
+    "offices", metadata,
+    Column("OfficeName", String(255), primary_key=True),
+    Column("Latitude", Float),
+    Column("Longitude", Float),
+    Column("RadiusMeters", Float),
+)
+departments = Table(
+    "departments", metadata,
+    Column("DepartmentGroup", String(255), primary_key=True),
+)
+settings = Table(
+    "settings", metadata,
+    Column("Key", String(64), primary_key=True),
+    Column("Value", Text),
+)
+attendance_edits = Table(  # same columns as the existing attendance.db table (no key); create_all never alters it
+    "attendance_edits", metadata,
+    Column("DateTime", String(32)),
+    Column("EditedByPhone", String(32)),
+    Column("EditedByName", String(255)),
+    Column("TargetPhone", String(32)),
+    Column("Date", String(10)),
+    Column("Field", String(32)),
+    Column("OldValue", Text),
+    Column("NewValue", Text),
+    Column("Reason", Text),
+)
+access_grants = Table(
+    "access_grants", metadata,
+    Column("PhoneNumber", String(32), primary_key=True),
+    Column("Role", String(32), nullable=False, server_default="Admin"),
+    Column("GrantedBy", String(64)),
+    Column("GrantedAt", String(32)),
+    Index("idx_access_grants_role", "Role"),
+)
+change_log = Table(
+    "change_log", metadata,
+    Column("Seq", Integer, primary_key=True, autoincrement=True),
+    Column("At", String(32)),
+    Column("Event", String(32)),
+    Column("PhoneNumber", String(32)),
+    Column("Date", String(10)),
+    Column("Data", Text),
+    sqlite_autoincrement=True,  # never reuse a Seq, so consumer cursors stay valid
+)
+
+ATTENDANCE_COLS = {"Date": "Date", "Name": "Name", "PhoneNumber": "PhoneNumber", "IN": "IN_TIME", "OUT": "OUT_TIME",
+                   "WFH": "WFH", "Leave": "Leave", "Departments": "Departments", "Office": "Office"}
+
+# One engine (and connection pool) per URL, shared by every storage instance in the process
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(url):
+    with _engines_lock:
+        if url not in _engines:
+            kw = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE_SECONDS, "future": True}
+            if url.startswith("sqlite"):
+                kw["connect_args"] = {"timeout": 30, "check_same_thread": False}
+                if url not in ("sqlite://", "sqlite:///:memory:"):
+                    kw.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+            else:
+                kw.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+            _engines[url] = create_engine(url, **kw)
+        return _engines[url]
+
+
+def upsert(conn, table, rows, keys, update_cols):
+    # INSERT ... ON CONFLICT / ON DUPLICATE KEY in one round trip; update_cols=[] means insert-if-missing
+    rows = rows if isinstance(rows, list) else [rows]
+    if not rows:
+        return
+    dialect = conn.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(table).values(rows)
+        if update_cols:
+            stmt = stmt.on_conflict_do_update(index_elements=keys, set_={c: stmt.excluded[c] for c in update_cols})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+        conn.execute(stmt)
+    elif dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(table).values(rows)
+        cols = update_cols or keys[:1]  # no-op update keeps the existing row
+        conn.execute(stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in cols}))
+    else:
+        for r in rows:
+            where = [table.c[k] == r[k] for k in keys]
+            res = conn.execute(update(table).where(*where).values({c: r[c] for c in update_cols})) if update_cols else None
+            if res is None or res.rowcount == 0:
+                if conn.execute(select(table.c[keys[0]]).where(*where)).first() is None:
+                    conn.execute(insert(table).values(r))
+
+
+class AlchemyStorage:
+    def __init__(self, url, admin_phones=None):
+        self.url = url
+        self.seed_admins = list(ADMIN_PHONES if admin_phones is None else admin_phones)  # per-tenant shards bring their own
+        self.engine = get_engine(url)
+        self._grants = None  # cached {phone: role}, valid while the stored access version is unchanged
+        self._grants_version = None
+        self._admin_phones = frozenset()
+        self._listeners = []
+        self._recent = RecentPunches()  # duplicate-punch filter shared by all sessions
+        self.lock = threading.RLock()  # serializes writes against run_maintenance() within the process
+
+    def subscribe(self, fn): self._listeners.append(fn)
+    def invalidate_caches(self): self._grants = None  # after the database was replaced (restore)
+
+    def _log(self, conn, rows):
+        # Feed rows go in the mutation's own transaction. Server databases hand out Seq values before
+        # commit, so writers first take the lock row in turn: Seq order stays commit order for cursors.
+        # Always the last statement of a transaction, so no writer waits on it while holding it.
+        if not rows:
+            return
+        if conn.dialect.name != "sqlite":  # SQLite already has a single writer
+            conn.execute(update(settings).where(settings.c.Key == CHANGE_LOG_LOCK).values(Value=rows[-1][0]))
+        conn.execute(insert(change_log), [dict(zip(CHANGE_COLUMNS[1:], r)) for r in rows])
+
+    def init(self):
+        grants_existed = inspect(self.engine).has_table("access_grants")
+        metadata.create_all(self.engine)
+        now = datetime.now().isoformat()
+        with self.engine.begin() as conn:
+            upsert(conn, users, [{"PhoneNumber": ph, "Name": f"Admin{i+1}", "Departments": "Management Team",
+                                  "PasswordHash": hash_pw(DEFAULT_DASHBOARD_PW), "Role": "Admin"}
+                                 for i, ph in enumerate(self.seed_admins)], ["PhoneNumber"], [])
+            if not grants_existed:
+                upsert(conn, access_grants, [{"PhoneNumber": ph, "Role": "Admin", "GrantedBy": "seed", "GrantedAt": now}
+                                             for ph in self.seed_admins], ["PhoneNumber"], [])
+            upsert(conn, departments, {"DepartmentGroup": "Management Team"}, ["DepartmentGroup"], [])
+            upsert(conn, settings, {"Key": CHANGE_LOG_LOCK, "Value": ""}, ["Key"], [])
+        migrate_legacy_whitelist(self)
+
+    # User APIs
+    def get_user(self, phone):
+        with self.engine.connect() as conn:
+            row = conn.execute(select(users).where(users.c.PhoneNumber == str(phone))).mappings().first()
+        return dict(row) if row else None
+
+    def add_user(self, u):
+        change = dict(phone=str(u.get("PhoneNumber")), user=dict(u))
+        with self.engine.begin() as conn:
+            upsert(conn, users, {"PhoneNumber": u.get("PhoneNumber"), "Name": u.get("Name"), "Departments": u.get("Departments", ""),
+                                 "PasswordHash": u.get("PasswordHash", ""), "Role": u.get("Role", "User")},
+                   ["PhoneNumber"], ["Name", "Departments", "PasswordHash", "Role"])
+            self._log(conn, change_rows("user_added", [change]))
+        notify(self, "user_added", [change])
+        return True
+
+    def update_user(self, phone, updates):
+        values = {k: updates[k] for k in ["Name", "Departments", "PasswordHash", "Role", "PhoneNumber"] if k in updates}
+        if not values:
+            return True
+        change = dict(phone=str(phone), updates=dict(updates))
+        with self.engine.begin() as conn:
+            changed = conn.execute(update(users).where(users.c.PhoneNumber == str(phone)).values(values)).rowcount
+            if changed > 0:
+                self._log(conn, change_rows("user_updated", [change]))
+        if changed > 0:
+            notify(self, "user_updated", [change])
+        return changed > 0
+
+    def check_password(self, phone, pw):
+        u = self.get_user(phone)
+        return u and u.get("PasswordHash") == hash_pw(pw)
+
+    def get_users(self):
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(select(users), conn)
+        return df.fillna("")
+
+    def import_records(self, users=(), departments=(), offices=()):
+        # Bulk import in one transaction: a failing row (e.g. a phone registered meanwhile) rolls back everything
+        t = metadata.tables  # the arguments shadow the module-level table names
+        changes = [dict(phone=str(u["PhoneNumber"]), user=dict(u)) for u in users]
+        try:
+            with self.engine.begin() as conn:
+                if users:
+                    conn.execute(insert(t["users"]), [{"PhoneNumber": u["PhoneNumber"], "Name": u["Name"], "Departments": u.get("Departments", ""),
+                                                        "PasswordHash": u.get("PasswordHash", ""), "Role": u.get("Role", "User")} for u in users])
+                upsert(conn, t["departments"], [{"DepartmentGroup": d["DepartmentGroup"]} for d in departments], ["DepartmentGroup"], [])
+                upsert(conn, t["offices"], [dict(o) for o in offices], ["OfficeName"], ["Latitude", "Longitude", "RadiusMeters"])
+                self._log(conn, change_rows("user_added", changes))
+        except SQLAlchemyError as e:
+            report_error(f"Import failed, nothing was written: {e}")
+            return False
+        notify(self, "user_added", changes)
+        return True
+
+    # Attendance APIs
+    def mark_attendance(self, phone, name, deps, action, office=None, idempotency_key=None):
+        return self.mark_attendance_batch([{"phone": phone, "name": name, "deps": deps, "action": action, "office": office, "idempotency_key": idempotency_key}])[0]
+
+    def mark_attendance_batch(self, punches):
+        # Duplicates (same punch this minute, or a repeated idempotency key) never reach the DB
+        return run_deduplicated(self._recent, punches, self._write_punches)
+
+    def _write_punches(self, punches):
+        # All punches share one pooled connection and one transaction
+        try:
+            now_local = datetime.now(ZoneInfo("Asia/Kolkata"))
+            today_str = now_local.date().isoformat()
+            nowt = now_local.strftime("%H:%M:%S")
+            results, events = [], []
+            with self.lock, self.engine.begin() as conn:
+                for p in punches:
+                    action = str(p.get("action")).strip().upper()
+                    row, err = self._apply_punch(conn, str(p.get("phone")), p.get("name"), p.get("deps"), action, p.get("office"), today_str, nowt)
+                    if err:
+                        results.append((False, err)); continue
+                    events.append(dict(phone=str(p.get("phone")), action=action, office=p.get("office"), row=row))
+                    results.append((True, "Recorded"))
+                self._log(conn, change_rows("attendance_marked", events))
+            notify(self, "attendance_marked", events)
+            return results
+        except Exception as e:
+            report_error(f"Error in mark_attendance (SQLAlchemy): {e}")
+            return [(False, f"Error: {e}")] * len(punches)
+
+    def _apply_punch(self, conn, phone, name, deps, action, office, today_str, nowt):
+        if action not in ACTIONS:
+            return None, f"Invalid action: {action}"
+        a = attendance.c
+        cur = conn.execute(select(attendance).where(a.Date == today_str, a.PhoneNumber == phone).with_for_update()).mappings().first()
+        row = dict(cur) if cur else {"Date": today_str, "Name": name, "PhoneNumber": phone, "IN_TIME": "", "OUT_TIME": "",
+                                     "WFH": "No", "Leave": "No", "Departments": deps, "Office": ""}
+        row = {k: "" if v is None else v for k, v in row.items()}
+        changed = []
+
+        # Office merge
+        parts = [p.strip() for p in str(row["Office"]).split(",") if p.strip()]
+        if office and office != "-" and office not in parts:
+            parts.append(office)
+            row["Office"] = ",".join(parts)
+            changed.append("Office")
+
+        # Actions; only the columns an action touches are overwritten on conflict
+        if action in ("IN", "OUT"):
+            col = "IN_TIME" if action == "IN" else "OUT_TIME"
+            row[col] = nowt
+            row["WFH"] = row["WFH"] or "No"
+            row["Leave"] = row["Leave"] or "No"
+            changed += [col, "WFH", "Leave"]
+        elif action in ("WFH IN", "WFH OUT"):
+            col = "IN_TIME" if action == "WFH IN" else "OUT_TIME"
+            row[col] = nowt
+            row["WFH"] = "Yes"
+            changed += [col, "WFH"]
+        elif action == "LEAVE":
+            row["Leave"] = "Yes"
+            changed.append("Leave")
+
+        upsert(conn, attendance, row, ["Date", "PhoneNumber"], changed)
+        return {k: str(row[c]) for k, c in ATTENDANCE_COLS.items()}, None
+
+    def get_attendance_row(self, phone, day=None):
+        day = day or datetime.now(ZoneInfo("Asia/Kolkata")).date()
+        a = attendance.c
+        with self.engine.connect() as conn:
+            r = conn.execute(select(attendance).where(a.Date == day.isoformat(), a.PhoneNumber == str(phone))).mappings().first()
+        return None if not r else {k: "" if r[c] is None else str(r[c]) for k, c in ATTENDANCE_COLS.items()}
+
+    def get_attendance(self):
+        stmt = select(*[attendance.c[c].label(k) for k, c in ATTENDANCE_COLS.items()])
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(stmt, conn)
+        return df.fillna("")
+    def get_attendance_between(self, start, end):
+        stmt = select(*[attendance.c[c].label(k) for k, c in ATTENDANCE_COLS.items()])\
+            .where(attendance.c.Date.between(str(start), str(end)))
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(stmt, conn)
+        return df.fillna("")
+
+    # Offices / Departments / Settings / Edits
+    def get_offices(self):
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(select(offices), conn)
+        return df.fillna("")
+    def add_office(self, n, lat, lon, r):
+        with self.engine.begin() as conn:
+            upsert(conn, offices, {"OfficeName": n, "Latitude": lat, "Longitude": lon, "RadiusMeters": r},
+                   ["OfficeName"], ["Latitude", "Longitude", "RadiusMeters"])
+    def delete_office(self, n):
+        with self.engine.begin() as conn:
+            conn.execute(delete(offices).where(offices.c.OfficeName == n))
+
+    def get_departments(self):
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(select(departments), conn)
+        return df.fillna("")
+    def add_department(self, g):
+        with self.engine.begin() as conn:
+            upsert(conn, departments, {"DepartmentGroup": g}, ["DepartmentGroup"], [])
+    def delete_department(self, g):
+        with self.engine.begin() as conn:
+            conn.execute(delete(departments).where(departments.c.DepartmentGroup == g))
+
+    def get_setting(self, key):
+        with self.engine.connect() as conn:
+            v = conn.execute(select(settings.c.Value).where(settings.c.Key == key)).scalar()
+        return "" if v is None else str(v)
+    def set_setting(self, key, val):
+        with self.engine.begin() as conn:
+            upsert(conn, settings, {"Key": key, "Value": str(val)}, ["Key"], ["Value"])
+
+    def append_edit(self, e):
+        cols = ["DateTime", "EditedByPhone", "EditedByName", "TargetPhone", "Date", "Field", "OldValue", "NewValue", "Reason"]
+        change = dict(phone=str(e.get("TargetPhone")), date=e.get("Date"), edit=dict(e))
+        with self.engine.begin() as conn:
+            conn.execute(insert(attendance_edits).values({c: None if e.get(c) is None else str(e.get(c)) for c in cols}))
+            self._log(conn, change_rows("edit_appended", [change]))
+        notify(self, "edit_appended", [change])
+
+    def get_edits(self):
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(select(attendance_edits).order_by(attendance_edits.c.DateTime), conn)
+        return df.fillna("")
+
+    def append_changes(self, rows):
+        with self.engine.begin() as conn:
+            self._log(conn, rows)
+
+    def get_changes(self, since=0, limit=500):
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(change_log).where(change_log.c.Seq > int(since)).order_by(change_log.c.Seq).limit(int(limit))).mappings()
+            return [dict(r) for r in rows]
+
+    def last_change_seq(self):
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.coalesce(func.max(change_log.c.Seq), 0))).scalar()
+
+    def update_attendance_fields(self, phone: str, date_str: str, updates: dict):
+        values = {ATTENDANCE_COLS.get(k, k): v for k, v in updates.items()}
+        if not values:
+            return True
+        day = date_str if isinstance(date_str, str) else date_str.isoformat()
+        change = dict(phone=str(phone), date=day, updates=dict(updates))
+        with self.lock, self.engine.begin() as conn:
+            changed = conn.execute(update(attendance).where(attendance.c.Date == day, attendance.c.PhoneNumber == str(phone)).values(values)).rowcount
+            if changed > 0:
+                self._log(conn, change_rows("attendance_updated", [change]))
+        if changed > 0:
+            notify(self, "attendance_updated", [change])
+        return changed > 0
+
+    def run_maintenance(self):
+        # Dialect-specific statistics refresh and compaction; needs autocommit (no VACUUM inside a transaction)
+        dialect = self.engine.dialect.name
+        report = {"backend": "sqlalchemy", "dialect": dialect, "statements": []}
+        if dialect == "sqlite":
+            stmts = ["ANALYZE", "VACUUM", "PRAGMA optimize"]
+        elif dialect == "postgresql":
+            stmts = ["VACUUM (ANALYZE)"]
+        elif dialect in ("mysql", "mariadb"):
+            stmts = ["ANALYZE TABLE " + ", ".join(t.name for t in metadata.sorted_tables)]
+        else:
+            stmts = []
+        with self.lock, self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for sql in stmts:
+                conn.exec_driver_sql(sql)
+                report["statements"].append(sql)
+        pool = self.engine.pool
+        report["pool"] = pool.status() if hasattr(pool, "status") else type(pool).__name__
+        return report
+
+    # Access grants
+    def get_access_grants(self):
+        stmt = select(access_grants.c.PhoneNumber, access_grants.c.Role, access_grants.c.GrantedBy, access_grants.c.GrantedAt)\
+            .order_by(access_grants.c.Role, access_grants.c.PhoneNumber)
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(stmt, conn)
+        return df.fillna("")
+    def access_roles(self):
+        # Replicas grant and revoke too: one settings-row read per check decides whether the cache is current
+        with self.engine.connect() as conn:
+            version = conn.execute(select(settings.c.Value).where(settings.c.Key == ACCESS_VERSION_KEY)).scalar() or ""
+            if self._grants is None or version != self._grants_version:
+                self._grants = {p: r for p, r in conn.execute(select(access_grants.c.PhoneNumber, access_grants.c.Role))}
+                self._grants_version = version
+                self._admin_phones = frozenset(self._grants)
+        return self._grants
+    def admin_phones(self): self.access_roles(); return self._admin_phones
+    def has_access(self, phone, roles=None):
+        role = self.access_roles().get(str(phone).strip())
+        return role is not None and (roles is None or role in roles)
+    def grant_access(self, phones, role="Admin", granted_by=""):
+        phones = list(dict.fromkeys(str(p).strip() for p in phones if str(p).strip()))
+        if not phones: return 0
+        now = datetime.now().isoformat()
+        with self.engine.begin() as conn:
+            upsert(conn, access_grants, [{"PhoneNumber": p, "Role": role, "GrantedBy": granted_by, "GrantedAt": now} for p in phones],
+                   ["PhoneNumber"], ["Role", "GrantedBy", "GrantedAt"])
+            self._bump_access_version(conn)
+        self._grants = None
+        return len(phones)
+    def revoke_access(self, phones):
+        phones = [str(p).strip() for p in phones]
+        with self.engine.begin() as conn:
+            removed = conn.execute(delete(access_grants).where(access_grants.c.PhoneNumber.in_(phones))).rowcount
+            self._bump_access_version(conn)
+        self._grants = None
+        return removed
+    def _bump_access_version(self, conn):
+        # Same transaction as the grant change: every replica's next access_roles() reloads
+        upsert(conn, settings, {"Key": ACCESS_VERSION_KEY, "Value": new_access_version()}, ["Key"], ["Value"])
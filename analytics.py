@@ -0,0 +1,242 @@
+# analytics.py
+#
+# Optional columnar mirror for admin reporting. Attendance is copied into
+# Parquet files partitioned by month (analytics/attendance/year=YYYY/month=MM/),
+# plus users.parquet and edits.parquet, and queried through an embedded DuckDB
+# engine. Filters on Date, Departments and Office are pushed down to the files,
+# so dashboards never load the operational store into memory.
+#
+# Needs the optional duckdb and pyarrow packages; ANALYTICS_AVAILABLE is False
+# without them and the app falls back to plain pandas views.
+#
+#     python analytics.py --full     # rebuild the mirror from storage
+
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+
+try:
+    import duckdb
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    ANALYTICS_AVAILABLE = True
+except ImportError:
+    ANALYTICS_AVAILABLE = False
+
+ANALYTICS_DIR = "analytics"
+REFRESH_MAX_AGE_SECONDS = 60
+ATTENDANCE_COLUMNS = ["Date", "Name", "PhoneNumber", "IN", "OUT", "WFH", "Leave", "Departments", "Office"]
+USER_COLUMNS = ["PhoneNumber", "Name", "Departments", "Role"]  # never mirror password hashes
+
+
+def month_key(iso_day):
+    return str(iso_day)[:7]  # "2026-10"
+
+
+def month_bounds(key):
+    y, m = int(key[:4]), int(key[5:7])
+    end = date(y + (m == 12), m % 12 + 1, 1)
+    return date(y, m, 1).isoformat(), date.fromordinal(end.toordinal() - 1).isoformat()
+
+
+def _write_parquet(df, path):
+    # Written to a temp file of its own next to the target and swapped in, so readers never see a
+    # half-written file and two writers (e.g. the CLI next to the app) never share a temp file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".part-", suffix=".tmp", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        pq.write_table(pa.Table.from_pandas(df.astype(str), preserve_index=False), tmp, row_group_size=64_000)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class AttendanceAnalytics:
+    def __init__(self, storage, root=ANALYTICS_DIR):
+        self.storage = storage
+        self.root = root
+        self._lock = threading.Lock()  # change tracking; never held while files are written
+        self._refresh_lock = threading.Lock()  # one refresh writes the mirror at a time
+        self._dirty_months = set()
+        self._edits_dirty = True
+        self._reload = False  # a restore or maintenance run rewrote attendance: next refresh is full
+        self._last_refresh = 0.0
+        self.manifest_path = os.path.join(root, "manifest.json")
+
+    # --- change tracking (storage events) ---
+    def on_event(self, event, payload):
+        with self._lock:
+            if event == "attendance_marked":
+                self._dirty_months.add(month_key(payload["row"]["Date"]))
+            elif event == "attendance_updated":
+                self._dirty_months.add(month_key(payload["date"]))
+                self._edits_dirty = True
+            elif event == "storage_reloaded":
+                self._reload = self._edits_dirty = True
+
+    def _manifest(self):
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # --- mirroring ---
+    def refresh_if_stale(self, max_age=REFRESH_MAX_AGE_SECONDS):
+        with self._lock:
+            stale = bool(self._dirty_months) or self._edits_dirty or time.monotonic() - self._last_refresh > max_age
+        return self.refresh() if stale else None
+
+    def refresh(self, full=False):
+        with self._refresh_lock:
+            return self._refresh(full)
+
+    def _refresh(self, full):
+        # Incremental: rewrite only months touched since the last refresh (plus the current one,
+        # which other processes such as the API may have written to)
+        manifest = self._manifest()
+        with self._lock:
+            full = full or manifest is None or self._reload
+            self._reload = False
+            months = set(self._dirty_months)
+            self._dirty_months.clear()
+            edits_dirty, self._edits_dirty = self._edits_dirty, False
+            self._last_refresh = time.monotonic()
+        started = datetime.now()
+        report = {"full": full, "months": []}
+
+        if full:
+            df = self.storage.get_attendance()
+            if not df.empty:
+                df["Date"] = df["Date"].astype(str).str[:10]
+            parts = {k: g for k, g in df.groupby(df["Date"].str[:7])} if not df.empty else {}
+            for key, g in parts.items():
+                self._write_month(key, g)
+            # Months no longer in storage go only after the new files are in place: queries never see an empty mirror
+            written = {self._month_path(key) for key in parts}
+            for dirpath, _, files in os.walk(os.path.join(self.root, "attendance")):
+                for f in files:
+                    path = os.path.join(dirpath, f)
+                    if f.endswith(".parquet") and path not in written:
+                        os.remove(path)
+            report["months"] = sorted(parts)
+            edits_dirty = True
+        else:
+            months.add(month_key(datetime.now(ZoneInfo("Asia/Kolkata")).date().isoformat()))
+            for key in sorted(months):
+                start, end = month_bounds(key)
+                self._write_month(key, self.storage.get_attendance_between(start, end))
+            report["months"] = sorted(months)
+
+        # The users table is small, so it is simply re-mirrored each time
+        u = self.storage.get_users()
+        _write_parquet(u.reindex(columns=USER_COLUMNS).fillna(""), os.path.join(self.root, "users.parquet"))
+        if edits_dirty:
+            _write_parquet(self.storage.get_edits().fillna(""), os.path.join(self.root, "edits.parquet"))
+        report.update({"edits": edits_dirty,
+                       "refreshed_at": datetime.now().isoformat(timespec="seconds"),
+                       "duration_s": round((datetime.now() - started).total_seconds(), 3)})
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        return report
+
+    def _month_path(self, key):
+        return os.path.join(self.root, "attendance", f"year={key[:4]}", f"month={key[5:7]}", "part.parquet")
+
+    def _write_month(self, key, df):
+        path = self._month_path(key)
+        if df is None or df.empty:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        df = df.reindex(columns=ATTENDANCE_COLUMNS).fillna("")
+        df["Date"] = df["Date"].astype(str).str[:10]
+        # Sorted by Date so row-group min/max stats let DuckDB skip data inside a file too
+        _write_parquet(df.sort_values(["Date", "PhoneNumber"]), path)
+
+    # --- querying ---
+    def connect(self):
+        con = duckdb.connect()
+        glob = os.path.join(self.root, "attendance", "*", "*", "*.parquet").replace("\\", "/")
+        has_att = any(files for _, _, files in os.walk(os.path.join(self.root, "attendance")))
+        if has_att:
+            con.execute(f"CREATE VIEW attendance AS SELECT * FROM read_parquet('{glob}', hive_partitioning = true, hive_types = {{'year': INTEGER, 'month': INTEGER}})")
+        else:
+            con.execute("CREATE VIEW attendance AS SELECT " + ", ".join(f"''::VARCHAR AS \"{c}\"" for c in ATTENDANCE_COLUMNS)
+                        + ", 0 AS year, 0 AS month WHERE false")
+        for name in ("users", "edits"):
+            path = os.path.join(self.root, f"{name}.parquet").replace("\\", "/")
+            if os.path.exists(path):
+                con.execute(f"CREATE VIEW {name} AS SELECT * FROM read_parquet('{path}')")
+        return con
+
+    def query(self, sql, params=None):
+        con = self.connect()
+        try:
+            return con.execute(sql, params or []).df()
+        finally:
+            con.close()
+
+    def _where(self, start, end, departments, offices):
+        # The year/month clause prunes whole partition directories; Date then uses row-group stats
+        start, end = str(start)[:10], str(end)[:10]
+        clauses = ["(year, month) >= (?, ?)", "(year, month) <= (?, ?)", "Date BETWEEN ? AND ?"]
+        params = [int(start[:4]), int(start[5:7]), int(end[:4]), int(end[5:7]), start, end]
+        if departments:
+            clauses.append("list_has_any(string_split(Departments, ','), ?)")
+            params.append(list(departments))
+        if offices:
+            clauses.append("list_has_any(string_split(Office, ','), ?)")
+            params.append(list(offices))
+        return " AND ".join(clauses), params
+
+    def date_bounds(self):
+        df = self.query("SELECT min(Date) AS lo, max(Date) AS hi FROM attendance WHERE Date <> ''")
+        lo, hi = df.iloc[0]["lo"], df.iloc[0]["hi"]
+        return (None, None) if pd.isna(lo) else (date.fromisoformat(lo), date.fromisoformat(hi))
+
+    def attendance_between(self, start, end, departments=None, offices=None):
+        where, params = self._where(start, end, departments, offices)
+        return self.query(f"SELECT {', '.join(chr(34) + c + chr(34) for c in ATTENDANCE_COLUMNS)} FROM attendance "
+                          f"WHERE {where} ORDER BY Date, PhoneNumber", params)
+
+    def daily_summary(self, start, end, departments=None, offices=None):
+        where, params = self._where(start, end, departments, offices)
+        return self.query(f"""
+            SELECT Date,
+                   count(*) FILTER (WHERE "IN" <> '' AND WFH <> 'Yes') AS in_office,
+                   count(*) FILTER (WHERE WFH = 'Yes') AS wfh,
+                   count(*) FILTER (WHERE Leave = 'Yes') AS on_leave
+            FROM attendance WHERE {where} GROUP BY Date ORDER BY Date""", params)
+
+    def department_summary(self, start, end, departments=None, offices=None):
+        where, params = self._where(start, end, departments, offices)
+        return self.query(f"""
+            SELECT trim(dep) AS Department, count(*) AS days_present,
+                   count(DISTINCT PhoneNumber) AS people
+            FROM (SELECT *, unnest(string_split(Departments, ',')) AS dep FROM attendance WHERE {where})
+            WHERE "IN" <> '' AND trim(dep) <> ''
+            GROUP BY 1 ORDER BY 2 DESC""", params)
+
+
+if __name__ == "__main__":
+    import argparse
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Refresh the Parquet analytics mirror")
+    ap.add_argument("--full", action="store_true", help="rebuild every month instead of only recent ones")
+    args = ap.parse_args()
+    if not ANALYTICS_AVAILABLE:
+        raise SystemExit("Install duckdb and pyarrow to use the analytics mirror")
+    s = make_storage()
+    s.init()
+    print(json.dumps(AttendanceAnalytics(s).refresh(full=args.full), indent=2))
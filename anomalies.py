@@ -0,0 +1,231 @@
+# anomalies.py
+#
+# Batch audit of suspicious attendance. Row checks run column-wise over a date
+# range of attendance joined with office coordinates:
+#   in_after_out, missing_out (past days only), out_without_in, punch_on_leave,
+#   long_day, odd_hours, and multi_office_day (the offices listed for a day
+#   cannot all be reached between IN and OUT).
+# The change feed (changefeed.py) adds what the rows alone do not keep:
+#   impossible_travel  consecutive office punches too far apart for the time between them
+#   outside_geofence   an office IN confirmed from outside the radius or without a location
+#
+# AnomalyScanner caches row flags per month. It follows the change feed with a
+# cursor, so only days touched by new punches or edits are scanned again, and
+# writes from other processes (the API) are picked up too. A restore or
+# maintenance run (storage_reloaded) drops the cache.
+#
+#     python anomalies.py 2026-01-01 2026-12-31 --out audit.csv
+
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+from analytics import month_bounds, month_key
+from changefeed import iter_changes
+from geo import office_distance_matrix
+
+MAX_TRAVEL_KMH = 80  # faster than this between two offices is not a real trip
+LONG_DAY_HOURS = 14
+EARLIEST_IN, LATEST_IN = "05:00:00", "22:00:00"
+ANOMALY_COLUMNS = ["Date", "PhoneNumber", "Name", "Anomaly", "Detail"]
+ANOMALY_KINDS = ["impossible_travel", "outside_geofence", "multi_office_day", "in_after_out", "missing_out",
+                 "out_without_in", "punch_on_leave", "long_day", "odd_hours"]
+ROW_COLUMNS = ["Date", "Name", "PhoneNumber", "IN", "OUT", "WFH", "Leave", "Office"]
+
+
+def today_local():
+    return datetime.now(ZoneInfo("Asia/Kolkata")).date().isoformat()
+
+
+def _flags(df, mask, kind, detail):
+    mask = mask.fillna(False).astype(bool)
+    out = df.loc[mask, ["Date", "PhoneNumber", "Name"]].assign(Anomaly=kind)
+    out["Detail"] = detail[mask] if isinstance(detail, pd.Series) else detail
+    return out
+
+
+def _seconds(col):
+    # "HH:MM:SS" -> seconds since midnight, NaN when empty; each distinct time is parsed once
+    uniq = pd.Series(col.unique())
+    secs = pd.to_timedelta(uniq.where(uniq != ""), errors="coerce").dt.total_seconds()
+    return col.map(dict(zip(uniq, secs))).astype(float)
+
+
+def _concat(parts):
+    parts = [p for p in parts if not p.empty]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=ANOMALY_COLUMNS)
+
+
+def _pair_km(distances, a, b):
+    # Vectorized lookup in the office distance matrix; unknown offices -> NaN
+    names = distances.index
+    ia, ib = names.get_indexer(a), names.get_indexer(b)
+    km = distances.to_numpy()[np.maximum(ia, 0), np.maximum(ib, 0)] / 1000
+    return np.where((ia < 0) | (ib < 0), np.nan, km)
+
+
+def office_path_km(offices_col, distances):
+    # "CSMT,Thane,CSMT" -> km along the listed offices, per row; single-office rows are 0 without splitting
+    multi = offices_col[offices_col.str.contains(",", regex=False)]
+    hops = multi.str.split(",").explode().str.strip().loc[lambda s: s.fillna("") != ""].to_frame("to")
+    hops["from"] = hops.groupby(level=0)["to"].shift()
+    hops = hops.dropna(subset=["from"])
+    km = pd.Series(_pair_km(distances, hops["from"], hops["to"]), index=hops.index)
+    return km.groupby(level=0).sum().reindex(offices_col.index, fill_value=0.0)
+
+
+def scan_rows(df, distances, today=None):
+    # -> anomaly rows (ANOMALY_COLUMNS) for attendance rows
+    if df is None or df.empty:
+        return pd.DataFrame(columns=ANOMALY_COLUMNS)
+    today = today or today_local()
+    df = df.reindex(columns=ROW_COLUMNS).fillna("").astype(str).reset_index(drop=True)
+    df["Date"] = df["Date"].str[:10]
+    tin, tout = _seconds(df["IN"]), _seconds(df["OUT"])
+    hours = (tout - tin) / 3600
+    path_km = office_path_km(df["Office"], distances) if not distances.empty else pd.Series(0.0, index=df.index)
+
+    flags = [
+        _flags(df, hours < 0, "in_after_out", "OUT " + df["OUT"] + " is before IN " + df["IN"]),
+        _flags(df, tin.notna() & tout.isna() & (df["Date"] < today), "missing_out", "IN " + df["IN"] + " with no OUT"),
+        _flags(df, tin.isna() & tout.notna(), "out_without_in", "OUT " + df["OUT"] + " with no IN"),
+        _flags(df, df["Leave"].eq("Yes") & tin.notna(), "punch_on_leave", "On leave but punched IN " + df["IN"]),
+        _flags(df, hours > LONG_DAY_HOURS, "long_day", hours.round(1).astype(str) + " h between IN and OUT"),
+        _flags(df, tin.notna() & ((df["IN"] < EARLIEST_IN) | (df["IN"] > LATEST_IN)), "odd_hours", "IN at " + df["IN"]),
+        _flags(df, (path_km > 0) & (hours > 0) & (path_km / hours > MAX_TRAVEL_KMH), "multi_office_day",
+               df["Office"] + ": " + path_km.round(1).astype(str) + " km between IN and OUT (" + hours.round(1).astype(str) + " h)"),
+    ]
+    return _concat(flags)
+
+
+def scan_travel(punches, distances):
+    # punches: Date, PhoneNumber, Name, At (timestamp), Office -> impossible_travel rows
+    if punches.empty or distances.empty:
+        return pd.DataFrame(columns=ANOMALY_COLUMNS)
+    p = punches.sort_values("At")
+    g = p.groupby(["PhoneNumber", "Date"])
+    p = p.assign(From=g["Office"].shift(), Since=g["At"].shift())
+    p = p[p["From"].notna() & (p["From"] != p["Office"])]
+    if p.empty:
+        return pd.DataFrame(columns=ANOMALY_COLUMNS)
+    km = pd.Series(_pair_km(distances, p["From"], p["Office"]), index=p.index)
+    minutes = (p["At"] - p["Since"]).dt.total_seconds() / 60
+    kmh = km / (minutes.clip(lower=1) / 60)
+    took = pd.Series(np.where(minutes < 1, "<1", minutes.round().astype(int).astype(str)), index=p.index).astype(str)
+    detail = p["From"] + " → " + p["Office"] + ": " + km.round(1).astype(str) + " km in " + took + " min"
+    return _flags(p, kmh > MAX_TRAVEL_KMH, "impossible_travel", detail)
+
+
+class AnomalyScanner:
+    def __init__(self, storage):
+        self.storage = storage
+        self._lock = threading.Lock()  # one sync/scan at a time
+        self._reset()
+
+    def _reset(self):
+        self._stale = False
+        self._cursor = 0
+        self._months = {}  # month -> row anomalies
+        self._dirty = set()  # ISO days touched since their month was scanned
+        self._punches = {}  # (phone, date) -> office punches from the change feed: [(Date, PhoneNumber, Name, At, Office)]
+        self._overrides = []  # geofence anomaly rows
+        self._travel = pd.DataFrame(columns=ANOMALY_COLUMNS)
+        self._today = None
+
+    def on_event(self, event, payload):
+        # A restore or maintenance run rewrites attendance without feed entries (a restore also puts
+        # back an older change_log), so the next scan starts over from the whole feed
+        if event == "storage_reloaded":
+            self._stale = True
+
+    # --- change feed ---
+    def sync(self):
+        touched = set()
+        for c in iter_changes(self.storage, self._cursor):
+            self._cursor = c["seq"]
+            data = c["data"]
+            if c["event"] in ("attendance_marked", "attendance_updated"):
+                self._dirty.add(c["date"])
+            if c["event"] == "attendance_marked" and data.get("action") in ("IN", "OUT") and data.get("office") not in (None, "", "-"):
+                self._punches.setdefault((c["phone"], c["date"]), []).append(
+                    (c["date"], c["phone"], data["row"].get("Name", ""), c["at"], data["office"]))
+                touched.add((c["phone"], c["date"]))
+            elif c["event"] == "geofence_override":
+                where = f"{data['distance_m'] / 1000:.1f} km away" if data.get("distance_m") is not None else "without a location"
+                self._overrides.append((c["date"], c["phone"], data.get("name", ""), "outside_geofence",
+                                        f"IN at {data.get('office')} confirmed {where}"))
+        if touched:
+            self._rescan_travel(touched)
+
+    def _rescan_travel(self, touched):
+        punches = pd.DataFrame([p for k in touched for p in self._punches[k]], columns=["Date", "PhoneNumber", "Name", "At", "Office"])
+        fresh = scan_travel(punches.assign(At=pd.to_datetime(punches["At"], utc=True)), self._distances())
+        old = self._travel
+        if not old.empty:
+            old = old[~pd.MultiIndex.from_frame(old[["PhoneNumber", "Date"]]).isin(list(touched))]
+        self._travel = _concat([old, fresh])
+        # Punches are always for today, so only the newest day's punches can gain another hop
+        newest = max(d for _, d in touched)
+        self._punches = {k: v for k, v in self._punches.items() if k[1] >= newest}
+
+    def _distances(self):
+        return office_distance_matrix(self.storage.get_offices())
+
+    # --- row flags, cached per month ---
+    def _month(self, key, distances, today):
+        start, end = month_bounds(key)
+        if key not in self._months:
+            self._months[key] = scan_rows(self.storage.get_attendance_between(start, end), distances, today)
+            self._dirty -= {d for d in self._dirty if start <= d <= end}
+            return self._months[key]
+        days = sorted(d for d in self._dirty if start <= d <= end)
+        if days:
+            rows = self.storage.get_attendance_between(days[0], days[-1])
+            rows = rows[rows["Date"].astype(str).str[:10].isin(days)] if not rows.empty else rows
+            cached = self._months[key]
+            self._months[key] = pd.concat([cached[~cached["Date"].isin(days)], scan_rows(rows, distances, today)], ignore_index=True)
+            self._dirty -= set(days)
+        return self._months[key]
+
+    def scan(self, start, end):
+        # -> anomalies between two ISO dates (inclusive), newest first
+        start, end = str(start)[:10], str(end)[:10]
+        with self._lock:
+            if self._stale:
+                self._reset()
+            today = today_local()
+            if self._today and self._today != today:
+                self._dirty.add(self._today)  # yesterday's open INs have become missing OUTs
+            self._today = today
+            self.sync()
+            distances = self._distances()
+            months, key = [], month_key(start)
+            while key <= month_key(end):
+                months.append(self._month(key, distances, today))
+                y, m = int(key[:4]), int(key[5:7])
+                key = f"{y + (m == 12)}-{m % 12 + 1:02d}"
+            out = _concat(months + [self._travel, pd.DataFrame(self._overrides, columns=ANOMALY_COLUMNS)])
+        out = out[(out["Date"] >= start) & (out["Date"] <= end)]
+        return out.sort_values(["Date", "PhoneNumber", "Anomaly"], ascending=[False, True, True]).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Scan attendance for suspicious punches")
+    ap.add_argument("start", help="YYYY-MM-DD")
+    ap.add_argument("end", help="YYYY-MM-DD")
+    ap.add_argument("--out", help="write CSV instead of printing")
+    args = ap.parse_args()
+    s = make_storage()
+    s.init()
+    result = AnomalyScanner(s).scan(args.start, args.end)
+    if args.out:
+        result.to_csv(args.out, index=False)
+        print(f"wrote {len(result)} anomalies to {args.out}")
+    else:
+        print(result.to_string(index=False) if not result.empty else "no anomalies")
@@ -0,0 +1,241 @@
+# api.py
+#
+# Headless punch API for lobby kiosks and biometric-device bridges. Runs as its
+# own process on top of the same storage classes as the Streamlit app:
+#
+#     ATTENDANCE_API_KEYS="kiosk-csmt:CSMT,bridge-1" python api.py --port 8600
+#
+# In a multi-tenant deployment (see tenants.py) each organization's shard is
+# served by its own API process: python api.py --tenant acme --port 8601
+#
+# The API needs the sql or sqlalchemy backend. The Excel workbook is rewritten
+# whole on every save and nothing locks it across processes, so a second writer
+# next to the Streamlit app would lose punches or corrupt the file.
+#
+# Every request needs an X-API-Key header. A key bound to an office ("key:Office")
+# belongs to a fixed device and always punches at that office; unbound keys must
+# send lat/lon with office IN punches, which are checked against the geofence.
+#
+#   POST /punch         {"phone", "action", "office"?, "lat"?, "lon"?, "idempotency_key"?}
+#                       (an Idempotency-Key header works too)
+#   POST /punch/batch   {"punches": [ ...same objects... ]}
+#   GET  /status/{phone}   office-bound keys only see phones punched at their office today
+#   GET  /changes?since=N&limit=M   change feed page (unbound keys only; see changefeed.py)
+#   GET  /health        (no key needed)
+#
+# Retries and repeated punches are acknowledged with "Already recorded" without a write.
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from aiohttp import web
+
+from changefeed import DEFAULT_PAGE_SIZE, read_changes
+from geo import within_office
+from storage import get_storage_mode, make_storage
+from tenants import make_router
+
+ACTIONS = ("IN", "OUT", "WFH IN", "WFH OUT", "LEAVE")
+CACHE_TTL_SECONDS = 60
+MAX_BATCH = 500
+
+
+def load_api_keys(raw):
+    keys = {}
+    for item in str(raw or "").split(","):
+        key, _, office = item.strip().partition(":")
+        if key:
+            keys[key] = office.strip() or None
+    return keys
+
+
+class PunchService:
+    def __init__(self, storage, api_keys):
+        self.storage = storage
+        self.api_keys = api_keys
+        # Writes go through one thread: one batch per transaction, so the database lock is never contended in-process
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="punch-writer")
+        self._users = {}  # phone -> (expires_at, user or None)
+        self._offices = (0.0, None)
+
+    async def _run(self, fn, *args, write=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer if write else None, fn, *args)
+
+    async def user(self, phone):
+        hit = self._users.get(phone)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        u = await self._run(self.storage.get_user, phone)
+        self._users[phone] = (time.monotonic() + CACHE_TTL_SECONDS, u)
+        return u
+
+    async def offices(self):
+        expires, df = self._offices
+        if df is None or expires <= time.monotonic():
+            df = await self._run(self.storage.get_offices)
+            self._offices = (time.monotonic() + CACHE_TTL_SECONDS, df)
+        return df
+
+    async def prepare(self, key_office, p):
+        # Returns (punch, None) ready for mark_attendance_batch, or (None, error)
+        phone = str(p.get("phone", "")).strip()
+        action = str(p.get("action", "")).strip().upper()
+        if not phone:
+            return None, "phone is required"
+        if action not in ACTIONS:
+            return None, f"Invalid action: {action}"
+        u = await self.user(phone)
+        if not u:
+            return None, f"Unknown phone: {phone}"
+
+        office = None
+        if action in ("IN", "OUT"):
+            office = key_office or str(p.get("office") or "").strip()
+            if not office or office == "-":
+                return None, "office is required for IN/OUT (use WFH IN / WFH OUT otherwise)"
+            offices_df = await self.offices()
+            if offices_df.empty or office not in offices_df["OfficeName"].tolist():
+                return None, f"Unknown office: {office}"
+            if action == "IN" and not key_office:
+                lat, lon = p.get("lat"), p.get("lon")
+                if lat is None or lon is None:
+                    return None, "lat/lon are required for office IN from an unbound key"
+                if not within_office(offices_df, office, lat, lon):
+                    return None, f"Outside the {office} geofence"
+
+        return {"phone": phone, "name": u["Name"], "deps": u["Departments"], "action": action, "office": office,
+                "idempotency_key": p.get("idempotency_key")}, None
+
+    async def punch_many(self, key_office, items):
+        prepared = [await self.prepare(key_office, p) for p in items]
+        punches = [p for p, err in prepared if p]
+        written = iter(await self._run(self.storage.mark_attendance_batch, punches, write=True) if punches else [])
+        results = []
+        for (p, err), item in zip(prepared, items):
+            ok, msg = next(written) if p else (False, err)
+            results.append({"ok": ok, "message": msg, "phone": str(item.get("phone", "")), "action": p["action"] if p else item.get("action")})
+        return results
+
+    async def status(self, phone):
+        return await self._run(self.storage.get_attendance_row, phone)
+
+
+# ---------------------------
+# HTTP
+# ---------------------------
+@web.middleware
+async def api_key_auth(request, handler):
+    if request.path == "/health":
+        return await handler(request)
+    key = request.headers.get("X-API-Key", "")
+    keys = request.app["service"].api_keys
+    if key not in keys:
+        return web.json_response({"ok": False, "message": "Invalid or missing X-API-Key"}, status=401)
+    request["key_office"] = keys[key]
+    return await handler(request)
+
+
+async def read_json(request):
+    try:
+        body = await request.json()
+    except Exception:
+        raise web.HTTPBadRequest(text='{"ok": false, "message": "Body must be JSON"}', content_type="application/json")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text='{"ok": false, "message": "Body must be a JSON object"}', content_type="application/json")
+    return body
+
+
+async def handle_punch(request):
+    body = await read_json(request)
+    if request.headers.get("Idempotency-Key"):
+        body.setdefault("idempotency_key", request.headers["Idempotency-Key"])
+    result = (await request.app["service"].punch_many(request["key_office"], [body]))[0]
+    return web.json_response(result, status=200 if result["ok"] else 422)
+
+
+async def handle_batch(request):
+    body = await read_json(request)
+    items = body.get("punches")
+    if not isinstance(items, list) or not all(isinstance(p, dict) for p in items):
+        return web.json_response({"ok": False, "message": "punches must be a list of objects"}, status=400)
+    if len(items) > MAX_BATCH:
+        return web.json_response({"ok": False, "message": f"At most {MAX_BATCH} punches per batch"}, status=413)
+    results = await request.app["service"].punch_many(request["key_office"], items)
+    return web.json_response({"ok": all(r["ok"] for r in results), "results": results})
+
+
+async def handle_status(request):
+    phone = request.match_info["phone"]
+    row = await request.app["service"].status(phone)
+    # A device key answers for its own lobby only: anyone else's status is as unknown as a missing phone
+    key_office = request["key_office"]
+    if key_office and key_office not in str((row or {}).get("Office", "")).split(","):
+        return web.json_response({"ok": False, "message": f"No punch at {key_office} today for this phone"}, status=403)
+    today = datetime.now(ZoneInfo("Asia/Kolkata")).date().isoformat()
+    return web.json_response({"ok": True, "phone": phone, "date": today, "attendance": row})
+
+
+async def handle_changes(request):
+    # Payroll and other back-office consumers; device (office-bound) keys cannot read the feed
+    if request["key_office"]:
+        return web.json_response({"ok": False, "message": "This key cannot read the change feed"}, status=403)
+    try:
+        since = int(request.query.get("since", 0))
+        limit = int(request.query.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return web.json_response({"ok": False, "message": "since and limit must be integers"}, status=400)
+    service = request.app["service"]
+    page = await service._run(read_changes, service.storage, since, limit)
+    return web.json_response({"ok": True, **page})
+
+
+async def handle_health(request):
+    return web.json_response({"ok": True, "storage": request.app["storage_mode"]})
+
+
+def make_app(storage, api_keys, storage_mode=""):
+    app = web.Application(middlewares=[api_key_auth])
+    app["service"] = PunchService(storage, api_keys)
+    app["storage_mode"] = storage_mode
+    app.router.add_post("/punch", handle_punch)
+    app.router.add_post("/punch/batch", handle_batch)
+    app.router.add_get("/status/{phone}", handle_status)
+    app.router.add_get("/changes", handle_changes)
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless attendance punch API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8600)
+    ap.add_argument("--tenant", help="serve this organization's shard (multi-tenant deployments)")
+    args = ap.parse_args(argv)
+
+    api_keys = load_api_keys(os.environ.get("ATTENDANCE_API_KEYS"))
+    if not api_keys:
+        sys.exit("Set ATTENDANCE_API_KEYS (comma-separated, optionally key:Office) before starting the API")
+    if args.tenant:
+        router = make_router()
+        if router is None or router.catalog.tenant(args.tenant) is None:
+            sys.exit(f"Unknown tenant: {args.tenant}")
+        mode, storage = f"tenant:{args.tenant}", router.storage(args.tenant)
+    else:
+        mode = get_storage_mode()
+        if mode == "excel":
+            sys.exit("The API needs the sql or sqlalchemy backend (storage_mode.txt); the Excel workbook "
+                     "cannot be shared with the app by a second process")
+        storage = make_storage(mode)
+        storage.init()
+    web.run_app(make_app(storage, api_keys, mode), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
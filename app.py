@@ -1,19 +1,31 @@
 # app.py
 
 import os
-import hashlib
-from datetime import datetime, date, timedelta
+from datetime import datetime, date
 import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
-from geopy.distance import geodesic
 from streamlit_js_eval import get_geolocation
-import openpyxl
 from io import BytesIO
-import sqlite3
 import time
 import secrets
+from types import SimpleNamespace
 from typing import Optional
+from occupancy import OccupancyBoard, TodayStatusCache, ACTIONS_BY_STATUS, PUNCH_ACTIONS, status_line, today_status
+from geo import fix_age, fix_verdict, make_fix, needs_fix
+from maintenance import MaintenanceScheduler, run_maintenance, last_report
+from analytics import ANALYTICS_AVAILABLE, ANALYTICS_DIR, AttendanceAnalytics
+from bulk_import import IMPORT_KINDS, read_upload, run_import, template_workbook
+from reports import REPORT_FORMATS, ReportRunner
+from register import RegisterCache
+from anomalies import ANOMALY_KINDS, AnomalyScanner
+from backup import BACKUP_DIR, BackupScheduler, make_backup_manager, recover_workbook
+from tenants import MAX_OPEN_SHARDS, make_router
+from storage import (
+    make_storage, set_error_reporter, report_error, emit_changes,
+    init_workbook, hash_pw, parse_phone_list,
+    DATA_FILE, DEFAULT_DASHBOARD_PW, ACCESS_ROLES,
+)
 
 # Set page config at the very top - must be first Streamlit command
 st.set_page_config("Attendance","🕒")
@@ -25,474 +37,12 @@ cookies = EncryptedCookieManager(
     password="attendance_secret_key_2024"
 )
 
-# ---------------------------
-# CONFIG
-# ---------------------------
-ADMIN_PHONES = ["8080042473"]
-DEFAULT_DASHBOARD_PW = "32193"
-SEED_OFFICES = [
-    {"OfficeName": "CSMT", "Latitude": 18.94358359403972, "Longitude": 72.83826109487124, "RadiusMeters": 350},
-    {"OfficeName": "Thane", "Latitude": 19.236363706991003, "Longitude": 72.98719749815108, "RadiusMeters": 350},
-    {"OfficeName": "Nerul", "Latitude": 19.044282739911402, "Longitude": 73.01426940651511, "RadiusMeters": 350},
-]
-
-DATA_FILE = "attendance_system.xlsx"
-ROW_LIMIT = 1_048_000
-MONTH_LIMIT = 10
-
-# ---------------------------
-# UTILITIES
-# ---------------------------
-def hash_pw(pw: str) -> str:
-    return hashlib.sha256(str(pw).encode()).hexdigest()
-
-def init_workbook():
-    if os.path.exists(DATA_FILE): return
-    with pd.ExcelWriter(DATA_FILE, engine="openpyxl") as writer:
-        # Users
-        df_users = pd.DataFrame(columns=["PhoneNumber","Name","Departments","PasswordHash","Role"])
-        for i, ph in enumerate(ADMIN_PHONES):
-            df_users.loc[len(df_users)] = [ph, f"Admin{i+1}", "Management Team", hash_pw(DEFAULT_DASHBOARD_PW), "Admin"]
-        df_users.to_excel(writer, sheet_name="users", index=False)
-        # Attendance
-        pd.DataFrame(columns=["Date","Name","PhoneNumber","IN","OUT","WFH","Leave","Departments","Office"])\
-            .to_excel(writer, sheet_name="attendance_1", index=False)
-        # Offices
-        offs = pd.DataFrame(SEED_OFFICES)
-        offs.to_excel(writer, sheet_name="offices", index=False)
-        # Departments
-        pd.DataFrame({"DepartmentGroup":["Management Team",]}).to_excel(writer, sheet_name="departments", index=False)
-        # Settings
-        s = pd.DataFrame({"Key":["whitelist"], "Value":[",".join(ADMIN_PHONES)]})
-        s.to_excel(writer, sheet_name="settings", index=False)
-        # Edit logs
-        pd.DataFrame(columns=["DateTime","EditedByPhone","EditedByName","TargetPhone","Date","Field","OldValue","NewValue","Reason"])\
-            .to_excel(writer, sheet_name="attendance_edits", index=False)
-
-def read_sheet(sheet):
-    try:
-        return pd.read_excel(DATA_FILE, sheet_name=sheet, engine="openpyxl", dtype=str).fillna("")
-    except Exception as e:
-        st.error(f"Error reading sheet '{sheet}': {e}")
-        # Return empty DataFrame if sheet doesn't exist
-        return pd.DataFrame()
-
-def write_sheet(sheet, df):
-    try:
-        with pd.ExcelWriter(DATA_FILE, engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
-            df.to_excel(writer, sheet_name=sheet, index=False)
-    except Exception as e:
-        st.error(f"Error writing to Excel: {e}")
-
-def get_latest_attendance_sheet():
-    book = openpyxl.load_workbook(DATA_FILE)
-    # Only consider sheets with numeric suffix like attendance_1, attendance_2, ...
-    numeric_sheets = []
-    for s in book.sheetnames:
-        if s.startswith("attendance_"):
-            suffix = s.split("_")[-1]
-            if suffix.isdigit():
-                numeric_sheets.append((int(suffix), s))
-    if not numeric_sheets:
-        # Fallback: create the first attendance sheet if missing
-        first = "attendance_1"
-        # Ensure the sheet is created if it doesn't exist
-        try:
-            pd.read_excel(DATA_FILE, sheet_name=first)
-        except Exception:
-            write_sheet(first, pd.DataFrame(columns=["Date","Name","PhoneNumber","IN","OUT","WFH","Leave","Departments","Office"]))
-        return first
-    numeric_sheets.sort(key=lambda t: t[0])
-    return numeric_sheets[-1][1]
-
-def cleanup_and_rotate(df):
-    cutoff = date.today() - timedelta(days=MONTH_LIMIT*30)
-    df["Date"] = pd.to_datetime(df["Date"], errors="coerce").dt.date # Ensure 'Date' column is datetime.date
-    df = df[df["Date"] >= cutoff]
-    if len(df) > ROW_LIMIT:
-        new_sheet = f"attendance_{int(get_latest_attendance_sheet().split('_')[1])+1}"
-        write_sheet(new_sheet, pd.DataFrame(columns=df.columns))
-        df = df.iloc[-ROW_LIMIT:]
-    return df
-
-# ---------------------------
-# Storage Class
-# ---------------------------
-class ExcelStorage:
-    def init(self): init_workbook()
-    def get_user(self, phone):
-        df=read_sheet("users"); r=df[df["PhoneNumber"]==str(phone)]
-        return None if r.empty else r.iloc[0].to_dict()
-    def add_user(self,u): df=read_sheet("users"); df=pd.concat([df,pd.DataFrame([u])],ignore_index=True); write_sheet("users",df)
-    def update_user(self,phone,updates):
-        df=read_sheet("users")
-        if str(phone) not in df["PhoneNumber"].values: return False
-        for k,v in updates.items():
-            if k not in df.columns: df[k]=""
-            df.loc[df["PhoneNumber"]==str(phone),k]=v
-        write_sheet("users",df); return True
-    def check_password(self,phone,pw): u=self.get_user(phone); return u and u["PasswordHash"]==hash_pw(pw)
-
-    def mark_attendance(self, phone, name, deps, action, office=None):
-        try:
-            action = str(action).strip().upper()
-            sheet = get_latest_attendance_sheet()
-            df = read_sheet(sheet)
-            df = cleanup_and_rotate(df)
-            LOCAL_TZ = ZoneInfo("Asia/Kolkata")
-            now_local = datetime.now(LOCAL_TZ)
-            day = now_local.date()
-            nowt = now_local.strftime("%H:%M:%S")
-            
-            idxs = df[(df["PhoneNumber"] == str(phone)) & (df["Date"] == day)].index
-
-            if len(idxs):
-                idx = idxs[0]
-            else:
-                new = {
-                    "Date": day,
-                    "Name": name,
-                    "PhoneNumber": phone,
-                    "Departments": deps,
-                    "IN": "",
-                    "OUT": "",
-                    "WFH": "No",
-                    "Leave": "No",
-                    "Office": ""
-                }
-                df = pd.concat([df, pd.DataFrame([new])], ignore_index=True)
-                idx = df.index[-1]
-
-            # --- Office Handling ---
-            # --- Office Handling ---
-            prev_office = str(df.at[idx, "Office"]).strip()
-            offices = [o.strip() for o in prev_office.split(",") if o.strip()] if prev_office else []
-
-            if office and office != "-":
-                if office not in offices:
-                    offices.append(office)
-                df.at[idx, "Office"] = ",".join(offices)
-
-
-        # --- Independent Actions ---
-            if action == "IN":
-                df.at[idx, "IN"] = nowt   # ✅ Updates only IN
-                if df.at[idx, "WFH"] == "":
-                    df.at[idx, "WFH"] = "No"
-                if df.at[idx, "Leave"] == "":
-                    df.at[idx, "Leave"] = "No"
-
-            elif action == "OUT":
-                df.at[idx, "OUT"] = nowt  # ✅ Updates only OUT
-                if df.at[idx, "WFH"] == "":
-                    df.at[idx, "WFH"] = "No"
-                if df.at[idx, "Leave"] == "":
-                    df.at[idx, "Leave"] = "No"
-
-            elif action == "WFH IN":
-                df.at[idx, "IN"] = nowt
-                df.at[idx, "WFH"] = "Yes"
-
-            elif action == "WFH OUT":
-                df.at[idx, "OUT"] = nowt
-                df.at[idx, "WFH"] = "Yes"
-
-            elif action == "LEAVE":
-                df.at[idx, "Leave"] = "Yes"
-            else:
-                return False, f"Invalid action: {action}"
-
-        # Fill defaults if missing
-            if not df.at[idx, "WFH"]:
-                df.at[idx, "WFH"] = "No"
-            if not df.at[idx, "Leave"]:
-                df.at[idx, "Leave"] = "No"
-
-            write_sheet(sheet, df)
-            return True, "Recorded"
-
-        except Exception as e:
-            st.error(f"Error in mark_attendance: {e}")
-            return False, f"Error: {e}"
-
-
-    def get_attendance(self): return read_sheet(get_latest_attendance_sheet())
-    def get_offices(self): return read_sheet("offices")
-    def add_office(self,n,lat,lon,r): df=self.get_offices(); df.loc[len(df)]=[n,lat,lon,r]; write_sheet("offices",df)
-    def delete_office(self,n): df=self.get_offices(); df=df[df["OfficeName"]!=n]; write_sheet("offices",df)
-    def get_departments(self): return read_sheet("departments")
-    def add_department(self,g): df=self.get_departments(); df.loc[len(df)]=[g]; write_sheet("departments",df)
-    def delete_department(self,g): df=self.get_departments(); df=df[df["DepartmentGroup"]!=g]; write_sheet("departments",df)
-    def get_setting(self,key): df=read_sheet("settings"); r=df[df["Key"]==key]; return "" if r.empty else str(r.iloc[0]["Value"])
-    def set_setting(self,key,val):
-        df = read_sheet("settings")
-        if key in df["Key"].values:
-            df.loc[df["Key"]==key, "Value"] = str(val)
-        else:
-            df = pd.concat([df, pd.DataFrame([{ "Key": key, "Value": str(val)}])], ignore_index=True)
-        write_sheet("settings", df)
-    def append_edit(self,e): df=read_sheet("attendance_edits"); df=pd.concat([df,pd.DataFrame([e])],ignore_index=True); write_sheet("attendance_edits",df)
-
-    def update_attendance_fields(self, phone: str, date_str: str, updates: dict):
-        sheet = get_latest_attendance_sheet()
-        df = read_sheet(sheet)
-        # Normalize Date to string for comparison
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce").dt.date
-        target_date = pd.to_datetime(date_str, errors="coerce").date() if not isinstance(date_str, date) else date_str
-        mask = (df["PhoneNumber"].astype(str) == str(phone)) & (df["Date"] == target_date)
-        for k, v in updates.items():
-            if k not in df.columns:
-                df[k] = ""
-            df.loc[mask, k] = v
-        write_sheet(sheet, df)
-        return True
-
-class SqlStorage:
-    def __init__(self, db_path: str = "attendance.db"):
-        self.db_path = db_path
-
-    def init(self):
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        # Users
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-          PhoneNumber TEXT PRIMARY KEY,
-          Name TEXT,
-          Departments TEXT,
-          PasswordHash TEXT,
-          Role TEXT
-        )""")
-        # Attendance
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS attendance (
-          Date TEXT,
-          Name TEXT,
-          PhoneNumber TEXT,
-          IN_TIME TEXT,
-          OUT_TIME TEXT,
-          WFH TEXT,
-          Leave TEXT,
-          Departments TEXT,
-          Office TEXT,
-          PRIMARY KEY (Date, PhoneNumber)
-        )""")
-        # Offices
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS offices (
-          OfficeName TEXT PRIMARY KEY,
-          Latitude REAL,
-          Longitude REAL,
-          RadiusMeters REAL
-        )""")
-        # Departments
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS departments (
-          DepartmentGroup TEXT PRIMARY KEY
-        )""")
-        # Settings
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-          Key TEXT PRIMARY KEY,
-          Value TEXT
-        )""")
-        # Edit logs
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS attendance_edits (
-          DateTime TEXT,
-          EditedByPhone TEXT,
-          EditedByName TEXT,
-          TargetPhone TEXT,
-          Date TEXT,
-          Field TEXT,
-          OldValue TEXT,
-          NewValue TEXT,
-          Reason TEXT
-        )""")
-
-        # Seed admin phones in users and whitelist if empty
-        for i, ph in enumerate(ADMIN_PHONES):
-            cur.execute("INSERT OR IGNORE INTO users (PhoneNumber, Name, Departments, PasswordHash, Role) VALUES (?,?,?,?,?)",
-                        (ph, f"Admin{i+1}", "Management Team", hash_pw(DEFAULT_DASHBOARD_PW), "Admin"))
-        # Seed whitelist setting
-        cur.execute("INSERT OR IGNORE INTO settings (Key, Value) VALUES (?, ?)", ("whitelist", ",".join(ADMIN_PHONES)))
-        # Seed departments default
-        cur.execute("INSERT OR IGNORE INTO departments (DepartmentGroup) VALUES (?)", ("Management Team",))
-
-        con.commit(); con.close()
-
-    # User APIs
-    def get_user(self, phone):
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute("SELECT PhoneNumber, Name, Departments, PasswordHash, Role FROM users WHERE PhoneNumber=?", (str(phone),))
-        row = cur.fetchone(); con.close()
-        if not row: return None
-        return {"PhoneNumber": row[0], "Name": row[1], "Departments": row[2], "PasswordHash": row[3], "Role": row[4]}
-
-    def add_user(self, u):
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute("INSERT OR REPLACE INTO users (PhoneNumber, Name, Departments, PasswordHash, Role) VALUES (?,?,?,?,?)",
-                    (u.get("PhoneNumber"), u.get("Name"), u.get("Departments",""), u.get("PasswordHash",""), u.get("Role","User")))
-        con.commit(); con.close()
-
-    def update_user(self, phone, updates):
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        # Build dynamic update
-        fields = []
-        values = []
-        for k in ["Name","Departments","PasswordHash","Role","PhoneNumber"]:
-            if k in updates:
-                fields.append(f"{ 'PhoneNumber' if k=='PhoneNumber' else k }=?")
-                values.append(updates[k])
-        if not fields:
-            con.close(); return True
-        values.append(str(phone))
-        cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE PhoneNumber=?", tuple(values))
-        changed = cur.rowcount
-        con.commit(); con.close(); return changed > 0
-
-    def check_password(self, phone, pw):
-        u = self.get_user(phone)
-        return u and u.get("PasswordHash") == hash_pw(pw)
-
-    # Attendance APIs
-    def mark_attendance(self, phone, name, deps, action, office=None):
-        try:
-            action = str(action).strip().upper()
-            LOCAL_TZ = ZoneInfo("Asia/Kolkata")
-            now_local = datetime.now(LOCAL_TZ)
-            today_str = now_local.date().isoformat()
-            nowt = now_local.strftime("%H:%M:%S")
-            con = sqlite3.connect(self.db_path)
-            cur = con.cursor()
-            # Ensure row exists
-            cur.execute("SELECT Date, Name, PhoneNumber, IN_TIME, OUT_TIME, WFH, Leave, Departments, Office FROM attendance WHERE Date=? AND PhoneNumber=?",
-                        (today_str, str(phone)))
-            row = cur.fetchone()
-            if not row:
-                cur.execute("INSERT INTO attendance (Date, Name, PhoneNumber, IN_TIME, OUT_TIME, WFH, Leave, Departments, Office) VALUES (?,?,?,?,?,?,?,?,?)",
-                            (today_str, name, str(phone), "", "", "No", "No", deps, ""))
-
-            # Office merge
-            if office and office != "-":
-                cur.execute("SELECT Office FROM attendance WHERE Date=? AND PhoneNumber=?", (today_str, str(phone)))
-                prev = cur.fetchone()
-                current = prev[0] if prev and prev[0] else ""
-                parts = [p.strip() for p in current.split(',') if p and p.strip()]
-                if office not in parts:
-                    parts.append(office)
-                new_off = ",".join(parts)
-                cur.execute("UPDATE attendance SET Office=? WHERE Date=? AND PhoneNumber=?", (new_off, today_str, str(phone)))
-
-            # Actions
-            if action == "IN":
-                cur.execute("UPDATE attendance SET IN_TIME=?, WFH=COALESCE(NULLIF(WFH,''),'No'), Leave=COALESCE(NULLIF(Leave,''),'No') WHERE Date=? AND PhoneNumber=?",
-                            (nowt, today_str, str(phone)))
-            elif action == "OUT":
-                cur.execute("UPDATE attendance SET OUT_TIME=?, WFH=COALESCE(NULLIF(WFH,''),'No'), Leave=COALESCE(NULLIF(Leave,''),'No') WHERE Date=? AND PhoneNumber=?",
-                            (nowt, today_str, str(phone)))
-            elif action == "WFH IN":
-                cur.execute("UPDATE attendance SET IN_TIME=?, WFH='Yes' WHERE Date=? AND PhoneNumber=?",
-                            (nowt, today_str, str(phone)))
-            elif action == "WFH OUT":
-                cur.execute("UPDATE attendance SET OUT_TIME=?, WFH='Yes' WHERE Date=? AND PhoneNumber=?",
-                            (nowt, today_str, str(phone)))
-            elif action == "LEAVE":
-                cur.execute("UPDATE attendance SET Leave='Yes' WHERE Date=? AND PhoneNumber=?", (today_str, str(phone)))
-            else:
-                con.close(); return False, f"Invalid action: {action}"
-
-            con.commit(); con.close(); return True, "Recorded"
-        except Exception as e:
-            st.error(f"Error in mark_attendance (SQL): {e}")
-            return False, f"Error: {e}"
-
-    def get_attendance(self):
-        con = sqlite3.connect(self.db_path)
-        df = pd.read_sql_query("SELECT Date as Date, Name, PhoneNumber, IN_TIME as `IN`, OUT_TIME as `OUT`, WFH, Leave, Departments, Office FROM attendance", con)
-        con.close(); return df.fillna("")
-
-    # Offices / Departments / Settings / Edits
-    def get_offices(self):
-        con = sqlite3.connect(self.db_path)
-        df = pd.read_sql_query("SELECT OfficeName, Latitude, Longitude, RadiusMeters FROM offices", con)
-        con.close(); return df.fillna("")
-    def add_office(self, n, lat, lon, r):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("INSERT OR REPLACE INTO offices (OfficeName, Latitude, Longitude, RadiusMeters) VALUES (?,?,?,?)", (n, lat, lon, r))
-        con.commit(); con.close()
-    def delete_office(self, n):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("DELETE FROM offices WHERE OfficeName=?", (n,))
-        con.commit(); con.close()
-
-    def get_departments(self):
-        con = sqlite3.connect(self.db_path)
-        df = pd.read_sql_query("SELECT DepartmentGroup FROM departments", con)
-        con.close(); return df.fillna("")
-    def add_department(self, g):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("INSERT OR IGNORE INTO departments (DepartmentGroup) VALUES (?)", (g,))
-        con.commit(); con.close()
-    def delete_department(self, g):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("DELETE FROM departments WHERE DepartmentGroup=?", (g,))
-        con.commit(); con.close()
-
-    def get_setting(self, key):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("SELECT Value FROM settings WHERE Key=?", (key,))
-        row = cur.fetchone(); con.close()
-        return "" if not row else str(row[0])
-    def set_setting(self, key, val):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("INSERT INTO settings (Key, Value) VALUES (?, ?) ON CONFLICT(Key) DO UPDATE SET Value=excluded.Value", (key, str(val)))
-        con.commit(); con.close()
-
-    def append_edit(self, e):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        cur.execute("INSERT INTO attendance_edits (DateTime, EditedByPhone, EditedByName, TargetPhone, Date, Field, OldValue, NewValue, Reason) VALUES (?,?,?,?,?,?,?,?,?)",
-                    (e.get("DateTime"), e.get("EditedByPhone"), e.get("EditedByName"), e.get("TargetPhone"), e.get("Date"), e.get("Field"), e.get("OldValue"), e.get("NewValue"), e.get("Reason")))
-        con.commit(); con.close()
-
-    def update_attendance_fields(self, phone: str, date_str: str, updates: dict):
-        con = sqlite3.connect(self.db_path); cur = con.cursor()
-        sets = []
-        vals = []
-        # Map keys to SQL columns
-        mapping = {"IN": "IN_TIME", "OUT": "OUT_TIME", "WFH": "WFH", "Leave": "Leave", "Office": "Office"}
-        for k, v in updates.items():
-            col = mapping.get(k, k)
-            sets.append(f"{col}=?")
-            vals.append(v)
-        if not sets:
-            con.close(); return True
-        vals.extend([date_str if isinstance(date_str, str) else date_str.isoformat(), str(phone)])
-        cur.execute(f"UPDATE attendance SET {', '.join(sets)} WHERE Date=? AND PhoneNumber=?", tuple(vals))
-        con.commit(); con.close(); return True
-
-def get_storage_mode():
-    try:
-        if os.path.exists("storage_mode.txt"):
-            with open("storage_mode.txt", "r", encoding="utf-8") as f:
-                mode = f.read().strip().lower()
-                if mode in ("sql", "sqlite", "db"):
-                    return "sql"
-    except Exception:
-        pass
-    return "excel"
-
-if get_storage_mode() == "sql":
-    storage = SqlStorage()
-else:
-    storage = ExcelStorage()
-storage.init()
+set_error_reporter(st.error)
 
-# Validate Excel file integrity
+# Validate Excel file integrity; a corrupted workbook is restored from the newest good snapshot
 def validate_excel_file():
+    if not os.path.exists(DATA_FILE):
+        return  # storage.init() creates a fresh one
     try:
         # Try to read a sheet to check if file is valid
         test_df = pd.read_excel(DATA_FILE, sheet_name="users", engine="openpyxl")
@@ -501,6 +51,10 @@ def validate_excel_file():
             init_workbook()
     except Exception as e:
         st.error(f"Excel file is corrupted: {e}")
+        restored = recover_workbook()
+        if restored:
+            st.warning(f"Restored the workbook from backup {restored}")
+            return
         # Try to remove file, but don't fail if it's locked
         try:
             if os.path.exists(DATA_FILE):
@@ -512,14 +66,124 @@ def validate_excel_file():
             pass
         init_workbook()
 
-# Check file integrity on startup
+# Check file integrity before storage opens the workbook
 validate_excel_file()
 
+# Multi-tenant deployments (a tenant catalog exists) route each session to its organization's shard.
+# Single-tenant deployments use tenant None throughout.
+@st.cache_resource
+def get_router():
+    return make_router()
+
+router = get_router()
+tenant = st.session_state.get("tenant") if router is not None else None
+
+def tenant_dir(root, tenant):
+    return root if tenant is None else os.path.join(root, tenant)
+
+def open_resources(tenant):
+    # One storage instance per server process (and tenant) so its caches (e.g. access grants) survive reruns,
+    # plus everything built on it
+    if tenant is not None:
+        storage = router.open(tenant)
+    else:
+        storage = make_storage()
+        storage.init()
+    r = SimpleNamespace(storage=storage)
+
+    # Live occupancy: built once from storage, then kept current by storage events
+    r.occupancy = OccupancyBoard(storage)
+    r.occupancy.rebuild()
+    storage.subscribe(r.occupancy.on_event)
+
+    # Each user's row for today, for the home and mark pages (no storage read per rerun)
+    r.today_cache = TodayStatusCache(storage)
+    storage.subscribe(r.today_cache.on_event)
+
+    # Retention / rotation / VACUUM run off-peak on a background thread, not inside punches
+    r.maintenance = MaintenanceScheduler(storage)
+    r.maintenance.start()
+
+    # Admin reporting reads a Parquet/DuckDB mirror instead of the live store (optional deps)
+    r.analytics = AttendanceAnalytics(storage, tenant_dir(ANALYTICS_DIR, tenant)) if ANALYTICS_AVAILABLE else None
+    if r.analytics is not None:
+        storage.subscribe(r.analytics.on_event)
+
+    # Monthly department reports build in worker processes, started from a background thread
+    r.report_runner = ReportRunner(storage)
+
+    # Muster registers per month, dropped when a storage event touches that month
+    r.register_cache = RegisterCache(storage)
+    storage.subscribe(r.register_cache.on_event)
+
+    # Anomaly audit follows the change feed; the subscription only tells it when a restore rewrote history
+    r.anomaly_scanner = AnomalyScanner(storage)
+    storage.subscribe(r.anomaly_scanner.on_event)
+
+    # Online snapshots: SQLite hourly in small backup steps, Excel after saves
+    r.backups = make_backup_manager(storage, tenant_dir(BACKUP_DIR, tenant))
+    r.backup_scheduler = BackupScheduler(r.backups) if r.backups.kind == "sqlite" else None
+    if r.backup_scheduler is not None:
+        r.backup_scheduler.start()
+    return r
+
+def close_resources(r):
+    # An evicted tenant's threads stop; its storage and caches go with the last session holding them
+    r.maintenance.stop()
+    r.backups.close()
+    if r.backup_scheduler is not None:
+        r.backup_scheduler.stop()
+
+# At most MAX_OPEN_SHARDS tenants are kept open per process, least recently used evicted first
+@st.cache_resource(max_entries=MAX_OPEN_SHARDS, on_release=close_resources)
+def get_resources(tenant=None):
+    return open_resources(tenant)
+
+# Until login, a multi-tenant session has no shard; login and signup look it up by phone
+resources = get_resources(tenant) if router is None or tenant else None
+has_shard = resources is not None
+storage, occupancy, today_cache, analytics, report_runner, register_cache, anomaly_scanner, backups = (
+    (resources.storage, resources.occupancy, resources.today_cache, resources.analytics, resources.report_runner,
+     resources.register_cache, resources.anomaly_scanner, resources.backups) if has_shard else (None,) * 8)
+
+def phone_claims():
+    # Multi-tenant writers claim a phone in the catalog before the shard stores it (see tenants.PhoneClaims)
+    return router.claims(tenant) if router is not None else None
+
+def claim_phones(phones):
+    # -> (claimed, {phone: other organization}); single-tenant deployments have nothing to claim
+    claims = phone_claims()
+    return claims.claim(phones) if claims else ([], {})
+
+def release_phones(phones):
+    # Undo a claim whose shard write failed
+    claims = phone_claims()
+    if claims:
+        claims.release(phones)
+
+def add_claimed_user(s, u, claims, claimed):
+    # Stores a new account whose phone was just claimed; a failed write gives the claim back -> True when stored
+    try:
+        ok = s.add_user(u) is not False
+    except Exception as e:
+        report_error(f"Could not create the account: {e}")
+        ok = False
+    if not ok and claims:
+        claims.release(claimed)
+    return ok
+
 # ---------------------------
 # UI HELPERS
 # ---------------------------
 def nav_to(p): st.session_state.page=p; st.rerun()
 
+def account_storage(phone):
+    # -> (tenant, storage) holding this phone's account; (None, None) for a phone no tenant knows
+    if router is None:
+        return None, storage
+    t = router.catalog.tenant_for_phone(phone)
+    return (t, get_resources(t).storage) if t else (None, None)
+
 # ---------------------------
 # STREAMLIT APP
 # ---------------------------
@@ -528,8 +192,9 @@ if "page" not in st.session_state: st.session_state.page="login"
 if "user" not in st.session_state: st.session_state.user=None
 if "pending_wfh_confirm" not in st.session_state: st.session_state.pending_wfh_confirm=False
 if "pending_wfh_office" not in st.session_state: st.session_state.pending_wfh_office=None
-if "last_click_time" not in st.session_state: st.session_state.last_click_time=0
 if "user_attempting_login" not in st.session_state: st.session_state.user_attempting_login=False
+if router is not None and st.session_state.user is not None and not tenant:
+    st.session_state.user=None; st.session_state.page="login"  # signed in before tenants were enabled
 
 # Auto-login if remember cookie exists and no active user
 # Only run auto-login on initial page load, not when user is actively logging in
@@ -545,9 +210,12 @@ if (st.session_state.page=="login" and
     try:
         remembered_phone = cookies.get("remembered_phone")
         if remembered_phone:
-            u = storage.get_user(remembered_phone)
+            t, s = account_storage(remembered_phone)
+            u = s.get_user(remembered_phone) if s else None
             if u:
+                st.session_state.tenant = t
                 st.session_state.user = u
+                get_resources(t).today_cache.load(u["PhoneNumber"])
                 st.session_state.page = "home"
                 st.rerun()
     except Exception:
@@ -579,9 +247,12 @@ def show_login():
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Login"):
-            if storage.check_password(phone,pw):
-                user = storage.get_user(phone)
+            t, s = account_storage(phone)
+            if s and s.check_password(phone,pw):
+                user = s.get_user(phone)
+                st.session_state.tenant = t
                 st.session_state.user = user
+                get_resources(t).today_cache.load(user["PhoneNumber"])
                 st.session_state.user_attempting_login = False  # Reset flag on successful login
                 
                 # Handle remember me functionality
@@ -604,19 +275,30 @@ def show_login():
 # SIGNUP
 def show_signup():
     st.header("Sign up")
+    org = st.text_input("Organization code").strip() if router is not None else None
     name=st.text_input("Name"); phone=st.text_input("Phone"); pw=st.text_input("Password",type="password")
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Create Account"):
-            # Check if phone is already in whitelist (admin)
-            whitelist = [p.strip() for p in storage.get_setting("whitelist").split(",")]
-            if phone in whitelist:
+            s = storage if router is None else get_resources(org).storage if org and router.catalog.tenant(org) else None
+            if s is None:
+                st.error("Unknown organization code")
+            # Check if phone already has admin access granted
+            elif s.has_access(phone):
                 st.error("This phone number is reserved for admin use. Please contact administrator.")
-            elif storage.get_user(phone):
+            elif s.get_user(phone):
                 st.error("User already exists")
             else: # This else was missing, causing the signup to not proceed
+                # The phone is claimed for the organization before the account is stored
+                claims = router.claims(org) if router is not None else None
+                claimed, taken = claims.claim([phone]) if claims else ([], {})
                 u={"PhoneNumber":phone,"Name":name,"Departments":"","PasswordHash":hash_pw(pw),"Role":"User"}
-                storage.add_user(u); st.session_state.user=u; nav_to("home")
+                if taken:
+                    st.error("User already exists")
+                elif not add_claimed_user(s, u, claims, claimed):
+                    st.error("Could not create the account. Please try again.")
+                else:
+                    st.session_state.tenant=org; st.session_state.user=u; nav_to("home")
     with col2:
         if st.button("Back to Login"):
             nav_to("login")
@@ -624,22 +306,21 @@ def show_signup():
 # HOME
 def show_home():
     u=st.session_state.user; st.header(f"Hello, {u['Name']}")
+    st.info(f"Today: {status_line(today_cache.get(u['PhoneNumber']))}")
     if st.button("Mark Attendance"): nav_to("mark")
     if st.button("Profile"): nav_to("profile")
 
-    whitelist = [p.strip() for p in storage.get_setting("whitelist").split(",") if p.strip()]
-    # Access to Admin Dashboard is controlled solely by whitelist
-    if (u["PhoneNumber"] in whitelist):
+    # Access to Admin Dashboard is controlled solely by access grants (cached, no storage read)
+    if storage.has_access(u["PhoneNumber"]):
         if st.button("Admin Dashboard"): nav_to("admin")
 
     if st.button("Logout"):
         # Clear all session state variables
         st.session_state.user = None
+        st.session_state.tenant = None
         st.session_state.pending_wfh_confirm = False
         st.session_state.pending_wfh_office = None
-        st.session_state.last_click_time = 0
-        st.session_state.user_geolocation = None
-        st.session_state.geolocation_attempts = 0
+        st.session_state.geo_fix = None
         st.session_state.user_attempting_login = False
         st.session_state.login_page_visited = False  # Reset to allow auto-login on next visit
         st.session_state.just_logged_out = True  # Prevent immediate auto-login
@@ -655,6 +336,13 @@ def show_home():
         st.rerun()
 
 # MARK
+def record_geofence_override(u, office, fix):
+    # An office IN confirmed outside the radius (or without a location) is kept for the anomaly audit
+    inside_dist = (fix or {}).get("verdicts", {}).get(office)
+    emit_changes(storage, "geofence_override", [dict(
+        phone=u["PhoneNumber"], date=datetime.now(ZoneInfo("Asia/Kolkata")).date().isoformat(), name=u["Name"], office=office,
+        distance_m=round(inside_dist[1]) if inside_dist else None, accuracy=(fix or {}).get("accuracy"))])
+
 def show_mark():
     u = st.session_state.user
     st.header("Mark Attendance")
@@ -663,118 +351,104 @@ def show_mark():
 
     selected_office = st.selectbox("Select Office (skip for WFH)", options=["-"] + office_names)
 
-    # Simple location check function
-    def user_within_selected_office(user_location) -> bool:
-        if selected_office == "-":
-            return False
-        if not user_location or "coords" not in user_location:
-            return False
-
-        row = offices_df[offices_df["OfficeName"] == selected_office].iloc[0]
-        office_lat = float(row["Latitude"])
-        office_lon = float(row["Longitude"])
-        radius = float(row["RadiusMeters"])
-
-        user_lat = user_location["coords"].get("latitude")
-        user_lon = user_location["coords"].get("longitude")
-
-        if user_lat is None or user_lon is None:
-            return False
-
-        distance_m = geodesic((user_lat, user_lon), (office_lat, office_lon)).meters
-        return distance_m <= (radius + 150)  # 100m buffer
+    # Only the actions that make sense for today's status. Gating reads the row itself (one keyed lookup, which
+    # also refreshes the cache): a punch at a kiosk a moment ago must not leave IN on offer
+    today = today_cache.load(u["PhoneNumber"])
+    st.info(f"Today: {status_line(today)}")
+    show_all = st.checkbox("Show all actions", key="mark_show_all")
+    actions = PUNCH_ACTIONS if show_all else ACTIONS_BY_STATUS[today_status(today)]
+    if not actions:
+        st.caption("Nothing to mark right now. Tick 'Show all actions' to correct today's entry.")
 
     col1, col2, col3, col4, col5 = st.columns(5)
 
-    # Geolocation fetch with mobile-friendly handling
-    if "user_geolocation" not in st.session_state:
-        st.session_state.user_geolocation = None
-    if "geolocation_attempts" not in st.session_state:
-        st.session_state.geolocation_attempts = 0
-
-    geolocation_placeholder = st.empty()
-    
-    # Try to get location with retries for mobile
-    if st.session_state.user_geolocation is None and st.session_state.geolocation_attempts < 3:
-        st.session_state.geolocation_attempts += 1
-        st.session_state.user_geolocation = get_geolocation()
-        
-        if st.session_state.user_geolocation is None:
-            if st.session_state.geolocation_attempts == 1:
-                geolocation_placeholder.warning("⚠️ Getting your location... Please allow location access in your browser.")
-            elif st.session_state.geolocation_attempts == 2:
-                geolocation_placeholder.warning("⚠️ Still getting location... Make sure location services are enabled.")
-            else:
-                geolocation_placeholder.warning("⚠️ Location access needed. You can still mark attendance, but office verification will be skipped.")
-        else:
-            geolocation_placeholder.success("✅ Location detected!")
-    elif st.session_state.user_geolocation is None:
-        geolocation_placeholder.info("ℹ️ Location not available. You can still mark attendance.")
-        
-        # Add refresh location button for mobile users
+    # Location: one browser lookup per fix, reused for GEO_MAX_AGE_SECONDS. The lookup never blocks
+    # the page (None until the browser answers, then one rerun) and office verdicts come with the fix.
+    if "geo_fix" not in st.session_state:
+        st.session_state.geo_fix = None
+    if "geo_request" not in st.session_state:
+        st.session_state.geo_request = 0
+    if needs_fix(st.session_state.geo_fix):
+        loc = get_geolocation(component_key=f"geo_{st.session_state.geo_request}")
+        if loc is not None:
+            st.session_state.geo_fix = make_fix(loc, offices_df)
+            st.session_state.geo_request += 1  # the next lookup needs a fresh component
+    fix = st.session_state.geo_fix
+    fresh_fix = None if needs_fix(fix) else fix
+    verdict = fix_verdict(fresh_fix, offices_df, selected_office) if selected_office != "-" else None
+
+    if fresh_fix is None:
+        st.caption("📍 Getting your location... You can mark attendance meanwhile.")
+    elif "error" in fresh_fix:
+        st.caption(f"📍 Location not available ({fresh_fix['error']}). Office IN will ask for confirmation.")
         if st.button("🔄 Try Location Again", key="refresh_location"):
-            st.session_state.user_geolocation = None
-            st.session_state.geolocation_attempts = 0
+            st.session_state.geo_fix = None
             st.rerun()
-
-    user_loc = st.session_state.user_geolocation
+    else:
+        accuracy = f" (±{fresh_fix['accuracy']:.0f} m)" if fresh_fix.get("accuracy") else ""
+        where = ""
+        if verdict is not None:
+            inside, dist = fresh_fix["verdicts"][selected_office]
+            dist = f"{dist / 1000:.1f} km" if dist >= 1000 else f"{dist:.0f} m"
+            where = f" · {'inside' if inside else 'outside'} {selected_office}, {dist} away"
+        age = int(fix_age(fresh_fix) // 60)
+        st.caption(f"📍 Location from {f'{age} min ago' if age else 'just now'}{accuracy}{where}")
 
     # --- IN ---
-    if col1.button("IN"):
-        import time
-        current_time = time.time()
-        if current_time - st.session_state.last_click_time < 2:
-            st.warning("Please wait a moment before clicking again...")
-            st.session_state.user_geolocation = None
-            return
-        st.session_state.last_click_time = current_time
-
+    # Repeated clicks are de-duplicated server-side by storage (see idempotency.py); mark_attendance
+    # also appends the office to the day's office list, which the multi-office anomaly check reads
+    if "IN" in actions and col1.button("IN"):
+        st.session_state.pending_wfh_confirm = False
+        st.session_state.pending_wfh_office = None
         if selected_office != "-":
-            # Check if we have location data
-            if user_loc and "coords" in user_loc:
-                if user_within_selected_office(user_loc):
+            # Verdict precomputed for the cached fix; None when there is no fresh location
+            if verdict is not None:
+                if verdict:
                     ok, msg = storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "IN", selected_office)
                     if ok:
-                        storage.update_attendance_fields(u["PhoneNumber"],datetime.now(ZoneInfo("Asia/Kolkata")).date(),{"Office": selected_office})
                         st.success(f"✅ {msg} at {selected_office}")
                         st.rerun()
                     else:
                         st.error(msg)
                 else:
-                    # Location available but outside radius - show warning and offer options
-                    st.warning(f"⚠️ You are not within the {selected_office} office radius. Please choose an option below:")
-                    col_confirm1, col_confirm2 = st.columns(2)
-                    with col_confirm1:
-                        if st.button(f"Confirm IN at {selected_office}", key="confirm_office_in"):
-                            ok, msg = storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "IN", selected_office)
-                            if ok:
-                                storage.update_attendance_fields(u["PhoneNumber"],datetime.now(ZoneInfo("Asia/Kolkata")).date(),{"Office": selected_office})
-                                st.success(f"✅ {msg} at {selected_office}")
-                                st.rerun()
-                    with col_confirm2:
-                        if st.button("Mark as WFH IN", key="wfh_in_fallback"):
-                            st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "WFH IN")[1])
-                            st.rerun()
+                    # Location available but outside radius - confirmed below, across reruns
+                    st.session_state.pending_wfh_confirm = True
+                    st.session_state.pending_wfh_office = selected_office
             else:
-                # No location data - allow manual confirmation
-                col_confirm1, col_confirm2 = st.columns(2)
-                with col_confirm1:
-                    if st.button(f"Confirm IN at {selected_office}", key="confirm_office_in_no_loc"):
-                        ok, msg = storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "IN", selected_office)
-                        if ok:
-                            storage.update_attendance_fields(u["PhoneNumber"], date.today(), {"Office": selected_office})
-                            st.success(f"✅ {msg} at {selected_office}")
-                            st.rerun()
-                with col_confirm2:
-                    if st.button("Mark as WFH IN", key="wfh_in_no_loc"):
-                        st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "WFH IN")[1])
-                        st.rerun()
+                # No location data - allow manual confirmation below
+                st.session_state.pending_wfh_confirm = True
+                st.session_state.pending_wfh_office = selected_office
         else:
             st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "WFH IN")[1])
             st.rerun()
 
+    # --- Office IN confirmation ---
+    # Kept in session state: the Confirm click is a new rerun in which the IN button is no longer pressed
+    if st.session_state.pending_wfh_confirm and st.session_state.pending_wfh_office == selected_office:
+        if verdict is not None:
+            st.warning(f"⚠️ You are not within the {selected_office} office radius. Please choose an option below:")
+        col_confirm1, col_confirm2 = st.columns(2)
+        with col_confirm1:
+            if st.button(f"Confirm IN at {selected_office}", key="confirm_office_in"):
+                ok, msg = storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "IN", selected_office)
+                if ok:
+                    if not verdict:  # the location may have come in (inside) since IN was clicked
+                        record_geofence_override(u, selected_office, fresh_fix)
+                    st.session_state.pending_wfh_confirm = False
+                    st.session_state.pending_wfh_office = None
+                    st.success(f"✅ {msg} at {selected_office}")
+                    st.rerun()
+                else:
+                    st.error(msg)
+        with col_confirm2:
+            if st.button("Mark as WFH IN", key="wfh_in_fallback"):
+                st.session_state.pending_wfh_confirm = False
+                st.session_state.pending_wfh_office = None
+                st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "WFH IN")[1])
+                st.rerun()
+
     # --- OUT ---
-    if col2.button("OUT"):
+    if "OUT" in actions and col2.button("OUT"):
         st.session_state.pending_wfh_confirm = False
         st.session_state.pending_wfh_office = None
 
@@ -782,7 +456,6 @@ def show_mark():
             ok, msg = storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "OUT",selected_office if selected_office != "-" else None)
 
             if ok:
-                storage.update_attendance_fields(u["PhoneNumber"], date.today(), {"Office": selected_office})
                 st.success(f"✅ {msg} at {selected_office}")
                 st.rerun()
             else:
@@ -792,21 +465,21 @@ def show_mark():
             st.rerun()
 
     # --- Leave ---
-    if col3.button("Leave"):
+    if "Leave" in actions and col3.button("Leave"):
         st.session_state.pending_wfh_confirm = False
         st.session_state.pending_wfh_office = None
-        st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "Leave",None))
+        st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "Leave",None)[1])
         st.rerun()
 
     # --- WFH IN ---
-    if col4.button("WFH IN"):
+    if "WFH IN" in actions and col4.button("WFH IN"):
         st.session_state.pending_wfh_confirm = False
         st.session_state.pending_wfh_office = None
         st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "WFH IN",None))
         st.rerun()
 
     # --- WFH OUT ---
-    if col5.button("WFH OUT"):
+    if "WFH OUT" in actions and col5.button("WFH OUT"):
         st.session_state.pending_wfh_confirm = False
         st.session_state.pending_wfh_office = None
         st.success(storage.mark_attendance(u["PhoneNumber"], u["Name"], u["Departments"], "WFH OUT",None))
@@ -815,7 +488,6 @@ def show_mark():
     if st.button("Back"):
         st.session_state.pending_wfh_confirm = False
         st.session_state.pending_wfh_office = None
-        st.session_state.user_geolocation = None
         nav_to("home")
 
 
@@ -858,11 +530,16 @@ def show_profile():
                 updates["PasswordHash"] = hash_pw(pw1)
             
             # Handle phone number change
+            claimed = []
             if new_phone != original_phone:
                 existing = storage.get_user(new_phone)
                 if existing and existing["PhoneNumber"] != original_phone: # Ensure it's not the current user's phone
                     st.error("Phone already registered to another user")
                     return
+                claimed, taken = claim_phones([new_phone])  # logins must keep routing to this organization
+                if taken:
+                    st.error("Phone already registered with another organization")
+                    return
                 updates["PhoneNumber"] = new_phone # Add new phone to updates if it changed
 
             # Apply updates
@@ -875,11 +552,252 @@ def show_profile():
                     st.session_state.user = storage.get_user(original_phone)
                 st.success("Profile updated")
             else:
+                release_phones(claimed)
                 st.error("Failed to update profile.")
     with col2:
         if st.button("Back"):
             nav_to("home")
 
+# LIVE OCCUPANCY (reads only the in-memory board; re-runs on its own timer)
+LIVE_REFRESH_SECONDS = 10
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+
+def _live_board(office_names):
+    snap = occupancy.snapshot()
+    st.caption(f"{snap['day']} · updated {snap['updated_at']:%H:%M:%S} · auto-refresh every {LIVE_REFRESH_SECONDS}s")
+    cols = st.columns(len(snap["by_status"]))
+    for col, (status, n) in zip(cols, snap["by_status"].items()):
+        col.metric(status, n)
+    offices = {o: snap["by_office"].get(o, 0) for o in office_names}
+    offices.update(snap["by_office"])
+    st.markdown("**By office**")
+    st.dataframe(pd.DataFrame(list(offices.items()), columns=["Office","Present"]), hide_index=True)
+    st.markdown("**By department (office + WFH)**")
+    st.dataframe(pd.DataFrame(sorted(snap["by_department"].items()), columns=["Department","Present"]), hide_index=True)
+    if snap["present"]:
+        st.markdown("**Currently in**")
+        st.dataframe(pd.DataFrame(snap["present"])[["Name","PhoneNumber","Departments","CurrentOffice","IN","WFH"]], hide_index=True)
+
+if _fragment is not None:
+    show_live_board = _fragment(run_every=LIVE_REFRESH_SECONDS)(_live_board)
+else:
+    def show_live_board(office_names):
+        _live_board(office_names)
+        if st.button("Refresh", key="live_refresh"): st.rerun()
+
+# MONTHLY REPORTS (generation never runs on the session thread; the job list polls while any is running)
+REPORT_REFRESH_SECONDS = 2
+
+def _report_jobs():
+    for job in report_runner.jobs():
+        label = f"{job['month']} ({job['format']}) · started {job['started_at']:%H:%M:%S}"
+        if job["status"] == "running":
+            st.progress(job["done"] / job["total"] if job["total"] else 0.0,
+                        text=f"{label} · {job['done']}/{job['total']} departments")
+        elif job["status"] == "done":
+            st.download_button(f"Download {job['filename']}", data=job["data"], file_name=job["filename"], key=f"report_{job['id']}",
+                               mime="application/zip" if job["format"] == "zip" else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        else:
+            st.error(f"{label} failed: {job['error']}")
+
+if _fragment is not None:
+    show_report_jobs = _fragment(run_every=REPORT_REFRESH_SECONDS)(_report_jobs)
+else:
+    def show_report_jobs():
+        _report_jobs()
+        if st.button("Refresh", key="report_refresh"): st.rerun()
+
+def recent_months(n=12):
+    today = datetime.now(ZoneInfo("Asia/Kolkata")).date()
+    months, y, m = [], today.year, today.month
+    for _ in range(n):
+        months.append(f"{y}-{m:02d}")
+        y, m = (y, m - 1) if m > 1 else (y - 1, 12)
+    return months
+
+def show_department_reports():
+    st.subheader("Monthly Department Report")
+    st.caption("One sheet per department group with per-employee summaries. Built in the background; "
+               "you can keep working while it runs.")
+    months = recent_months()
+    col_m, col_f = st.columns(2)
+    with col_m:
+        month = st.selectbox("Month", months, index=1, key="report_month")  # last month by default
+    with col_f:
+        fmt = st.radio("Format", REPORT_FORMATS, horizontal=True, key="report_format",
+                       format_func=lambda f: "Single workbook" if f == "xlsx" else "Zip (one file per department)")
+    if st.button("Generate Report", key="report_generate"):
+        report_runner.start(month, fmt, st.session_state.user["PhoneNumber"])
+    show_report_jobs()
+
+# MUSTER REGISTER
+def show_muster_register():
+    st.subheader("Monthly Register")
+    st.caption("P = at office, WFH = work from home, L = leave, A = absent")
+    month = st.selectbox("Month", recent_months(), key="register_month")
+    register = register_cache.get(month)
+    st.dataframe(register, hide_index=True)
+    st.download_button("Download Register (Excel)", data=register_cache.xlsx(month), file_name=f"muster_{month}.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="register_download")
+
+# ANOMALY AUDIT
+def show_anomalies():
+    st.subheader("Suspicious Punches")
+    today = datetime.now(ZoneInfo("Asia/Kolkata")).date()
+    col_s, col_e = st.columns(2)
+    with col_s:
+        start = st.date_input("From", value=today.replace(day=1), key="audit_start")
+    with col_e:
+        end = st.date_input("To", value=today, key="audit_end")
+    kinds = st.multiselect("Kinds", ANOMALY_KINDS, default=ANOMALY_KINDS, key="audit_kinds")
+    found = anomaly_scanner.scan(start, end)
+    found = found[found["Anomaly"].isin(kinds)]
+    if found.empty:
+        st.success("No anomalies in this range.")
+        return
+    st.caption(" · ".join(f"{k}: {n}" for k, n in found["Anomaly"].value_counts().items()))
+    st.dataframe(found, hide_index=True)
+    st.download_button("Download CSV", data=found.to_csv(index=False).encode("utf-8"), file_name=f"anomalies_{start}_to_{end}.csv",
+                       mime="text/csv", key="audit_download")
+
+def attendance_downloads(df_view, start_date, end_date):
+    csv_bytes = df_view.to_csv(index=False).encode("utf-8")
+    st.download_button("Download CSV", data=csv_bytes, file_name=f"attendance_{start_date}_to_{end_date}.csv", mime="text/csv")
+
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+        df_view.to_excel(writer, index=False, sheet_name="attendance")
+    st.download_button("Download Excel", data=buf.getvalue(), file_name=f"attendance_{start_date}_to_{end_date}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+# Fallback viewer when duckdb/pyarrow are not installed: loads everything into pandas
+def show_attendance_viewer():
+    df_all = storage.get_attendance()
+    if df_all.empty:
+        st.info("No attendance records yet")
+        return
+    st.subheader("Attendance Viewer & Export")
+    df_all["Date"] = pd.to_datetime(df_all["Date"], errors="coerce").dt.date
+    valid_dates = df_all["Date"].dropna()
+    if valid_dates.empty:
+        min_d = max_d = date.today()
+    else:
+        min_d = valid_dates.min()
+        max_d = valid_dates.max()
+    col_a, col_b = st.columns(2)
+    with col_a:
+        start_date = st.date_input("Start date", value=min_d)
+    with col_b:
+        end_date = st.date_input("End date", value=max_d)
+
+    if start_date and end_date:
+        mask = (df_all["Date"] >= start_date) & (df_all["Date"] <= end_date)
+        df_view = df_all.loc[mask]
+    else:
+        df_view = df_all
+    st.dataframe(df_view)
+    attendance_downloads(df_view, start_date, end_date)
+
+# Filters are pushed down to the Parquet mirror; only the selected rows reach pandas
+def show_attendance_analytics():
+    try:
+        analytics.refresh_if_stale()
+    except Exception as e:
+        st.warning(f"Analytics refresh failed, showing the last mirror: {e}")
+    min_d, max_d = analytics.date_bounds()
+    if min_d is None:
+        st.info("No attendance records yet")
+        return
+    st.subheader("Attendance Viewer & Export")
+    col_a, col_b = st.columns(2)
+    with col_a:
+        start_date = st.date_input("Start date", value=min_d)
+    with col_b:
+        end_date = st.date_input("End date", value=max_d)
+    col_c, col_d = st.columns(2)
+    with col_c:
+        deps = st.multiselect("Departments", storage.get_departments()["DepartmentGroup"].tolist())
+    with col_d:
+        offs = st.multiselect("Offices", storage.get_offices()["OfficeName"].tolist())
+    start_date, end_date = start_date or min_d, end_date or max_d
+
+    df_view = analytics.attendance_between(start_date, end_date, deps, offs)
+    st.dataframe(df_view)
+    attendance_downloads(df_view, start_date, end_date)
+
+    st.markdown("**Daily summary**")
+    st.dataframe(analytics.daily_summary(start_date, end_date, deps, offs))
+    st.markdown("**By department**")
+    st.dataframe(analytics.department_summary(start_date, end_date, deps, offs))
+
+# Onboarding: validate a whole CSV/XLSX at once, then write the valid rows in one storage call
+def show_bulk_import():
+    st.subheader("Bulk Import")
+    st.caption("XLSX with sheets named users / departments / offices, or a CSV of one kind. "
+               "Users without a Password get the default one.")
+    st.download_button("Download template", data=template_workbook(), file_name="attendance_import_template.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    upload = st.file_uploader("Import file", type=["csv", "xlsx"], key="bulk_import_file")
+    col_k, col_p = st.columns(2)
+    with col_k:
+        kind = st.selectbox("CSV contains", IMPORT_KINDS, key="bulk_import_kind")
+    with col_p:
+        default_pw = st.text_input("Default password", value=DEFAULT_DASHBOARD_PW, type="password", key="bulk_import_pw")
+    dry_run = st.checkbox("Dry run (validate only, write nothing)", value=True, key="bulk_import_dry")
+    if upload is None or not st.button("Validate" if dry_run else "Import", key="bulk_import_run"):
+        return
+    try:
+        frames = read_upload(upload.name, upload.getvalue(), kind)
+    except Exception as e:
+        st.error(f"Could not read file: {e}")
+        return
+    if not frames:
+        st.error("No users / departments / offices sheet found in the file")
+        return
+    report = run_import(storage, frames, dry_run=dry_run, default_password=default_pw or DEFAULT_DASHBOARD_PW, claims=phone_claims())
+    for k, n in report["rows"].items():
+        st.write(f"{k}: {report['valid'].get(k, 0)} of {n} row(s) valid")
+    if dry_run:
+        st.info("Dry run: nothing was written")
+    elif report["written"]:
+        st.success(f"Imported {sum(report['valid'].values())} record(s)")
+    elif any(report["valid"].values()):
+        st.error("Import failed; nothing was written")
+    errors = report["errors"]
+    if not errors.empty:
+        st.warning(f"{len(errors)} problem(s) found; rows with errors are skipped")
+        st.dataframe(errors)
+        st.download_button("Download error report", data=errors.to_csv(index=False).encode("utf-8"),
+                           file_name="import_errors.csv", mime="text/csv")
+
+def show_backups():
+    st.subheader("Backups")
+    if backups.kind is None:
+        st.info("This database is backed up by the database server, not by the app")
+        return
+    st.caption("SQLite is snapshotted hourly with the online backup API; the workbook after saves (at most every 5 minutes). "
+               "Older snapshots are pruned automatically.")
+    snaps = backups.list_snapshots()
+    if snaps:
+        st.dataframe(pd.DataFrame(snaps), hide_index=True)
+    else:
+        st.info("No snapshots yet")
+    if st.button("Snapshot Now", key="backup_now"):
+        with st.spinner("Taking snapshot..."):
+            report = backups.snapshot("manual")
+        (st.success if report["ok"] else st.error)(report.get("name") or report.get("error"))
+        st.rerun()
+    if snaps:
+        restore_sel = st.selectbox("Restore snapshot", [s["name"] for s in snaps], key="backup_restore_sel")
+        confirm = st.checkbox("I understand the current data will be replaced (a safety snapshot is taken first)", key="backup_restore_ok")
+        if st.button("Restore", key="backup_restore") and confirm:
+            with st.spinner("Restoring..."):
+                backups.restore(restore_sel)
+                occupancy.rebuild()
+                if analytics is not None:
+                    analytics.refresh(full=True)
+            st.success(f"Restored {restore_sel}")
+            st.rerun()
+
 # ADMIN
 def show_admin():
     st.header("Admin Dashboard")
@@ -888,43 +806,17 @@ def show_admin():
     with top_back_col:
         if st.button("Back", key="admin_back_top"):
             nav_to("home")
-    tab1,tab2,tab3,tab4,tab5=st.tabs(["Attendance","Departments/Offices","Edit Logs","Settings","Edit Attendance"])
+    tab1,tab2,tab3,tab4,tab5,tab6,tab7=st.tabs(["Attendance","Departments/Offices","Edit Logs","Settings","Edit Attendance","Live","Audit"])
 
     with tab1:
-        df_all = storage.get_attendance()
-        if df_all.empty:
-            st.info("No attendance records yet")
+        if analytics is not None:
+            show_attendance_analytics()
         else:
-            st.subheader("Attendance Viewer & Export")
-            df_all["Date"] = pd.to_datetime(df_all["Date"], errors="coerce").dt.date
-            valid_dates = df_all["Date"].dropna()
-            if valid_dates.empty:
-                min_d = max_d = date.today()
-            else:
-                min_d = valid_dates.min()
-                max_d = valid_dates.max()
-            col_a, col_b = st.columns(2)
-            with col_a:
-                start_date = st.date_input("Start date", value=min_d)
-            with col_b:
-                end_date = st.date_input("End date", value=max_d)
-
-            if start_date and end_date:
-                mask = (df_all["Date"] >= start_date) & (df_all["Date"] <= end_date)
-                df_view = df_all.loc[mask]
-            else:
-                df_view = df_all
-            st.dataframe(df_view)
-
-
-            # Downloads
-            csv_bytes = df_view.to_csv(index=False).encode("utf-8")
-            st.download_button("Download CSV", data=csv_bytes, file_name=f"attendance_{start_date}_to_{end_date}.csv", mime="text/csv")
-
-            buf = BytesIO()
-            with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-                df_view.to_excel(writer, index=False, sheet_name="attendance")
-            st.download_button("Download Excel", data=buf.getvalue(), file_name=f"attendance_{start_date}_to_{end_date}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            show_attendance_viewer()
+        st.markdown("---")
+        show_muster_register()
+        st.markdown("---")
+        show_department_reports()
     with tab2:
         st.subheader("Departments")
         ddf = storage.get_departments()
@@ -970,10 +862,13 @@ def show_admin():
                     storage.delete_office(del_off)
                     st.warning("Office deleted")
                     st.rerun()
+
+        st.markdown("---")
+        show_bulk_import()
     with tab3:
         st.subheader("Edit Logs")
         try:
-            edit_df = read_sheet("attendance_edits")
+            edit_df = storage.get_edits()
             if not edit_df.empty:
                 st.dataframe(edit_df)
             else:
@@ -982,30 +877,59 @@ def show_admin():
             st.info(f"No edit logs sheet found or error reading: {e}")
     with tab4:
         st.subheader("Admin & Access Settings")
-        # Whitelist management
-        wl_raw = storage.get_setting("whitelist")
-        wl_list = [p.strip() for p in wl_raw.split(",") if p.strip()] if wl_raw else []
-        wl_text = st.text_area("Whitelist phone numbers (comma-separated)", value=",".join(wl_list))
-        if st.button("Save Whitelist", key="save_whitelist"):
-            storage.set_setting("whitelist", wl_text)
-            st.success("Whitelist updated")
+        # Access grants management
+        grants_df = storage.get_access_grants()
+        st.dataframe(grants_df)
+        me = st.session_state.user["PhoneNumber"]
+        col_g, col_r = st.columns(2)
+        with col_g:
+            bulk_text = st.text_area("Phone numbers to grant (comma or newline separated)")
+            bulk_role = st.selectbox("Role", ACCESS_ROLES, key="bulk_grant_role")
+            if st.button("Grant to All", key="bulk_grant") and bulk_text.strip():
+                n = storage.grant_access(parse_phone_list(bulk_text), bulk_role, me)
+                st.success(f"Access granted to {n} phone number(s)")
+                st.rerun()
+        with col_r:
+            revoke_sel = st.multiselect("Revoke access", [p for p in grants_df["PhoneNumber"].tolist() if p != me])
+            if st.button("Revoke Selected", key="bulk_revoke") and revoke_sel:
+                n = storage.revoke_access(revoke_sel)
+                st.warning(f"Access revoked for {n} phone number(s)")
+                st.rerun()
 
         st.markdown("---")
-        st.subheader("Grant Access (adds to whitelist)")
+        st.subheader("Grant Access (creates user if missing)")
         access_phone = st.text_input("Phone Number to Grant Access")
         access_name = st.text_input("Name (optional)")
+        access_role = st.selectbox("Role", ACCESS_ROLES, key="grant_role")
         if st.button("Grant Access", key="grant_access") and access_phone.strip():
-            # Ensure user exists
+            # Ensure user exists; a new user's phone is claimed for this organization first
             existing = storage.get_user(access_phone.strip())
-            if not existing:
-                u = {"PhoneNumber": access_phone.strip(), "Name": access_name or f"User-{access_phone.strip()}", "Departments":"", "PasswordHash": hash_pw(DEFAULT_DASHBOARD_PW), "Role":"User"}
-                storage.add_user(u)
-            # Add to whitelist
-            new_wl = [p.strip() for p in wl_text.split(",") if p.strip()]
-            if access_phone.strip() not in new_wl:
-                new_wl.append(access_phone.strip())
-            storage.set_setting("whitelist", ",".join(new_wl))
-            st.success("Access granted via whitelist")
+            claimed, taken = ([], {}) if existing else claim_phones([access_phone.strip()])
+            u = {"PhoneNumber": access_phone.strip(), "Name": access_name or f"User-{access_phone.strip()}", "Departments":"", "PasswordHash": hash_pw(DEFAULT_DASHBOARD_PW), "Role":"User"}
+            if taken:
+                st.error("Phone already registered with another organization")
+            elif not existing and not add_claimed_user(storage, u, phone_claims(), claimed):
+                st.error("Could not create the user")
+            else:
+                storage.grant_access([access_phone.strip()], access_role, me)
+                st.success("Access granted")
+
+        st.markdown("---")
+        st.subheader("Maintenance")
+        st.caption("Retention, rotation and compaction run daily off-peak in the background.")
+        report = last_report(storage)
+        if report:
+            st.json(report)
+        else:
+            st.info("Maintenance has not run yet")
+        if st.button("Run Maintenance Now", key="run_maintenance"):
+            with st.spinner("Running maintenance..."):
+                report = run_maintenance(storage)
+            (st.success if report["ok"] else st.error)(f"Maintenance finished in {report['duration_s']}s")
+            st.rerun()
+
+        st.markdown("---")
+        show_backups()
     with tab5:
         st.subheader("Edit Attendance")
         df=storage.get_attendance()
@@ -1044,6 +968,14 @@ def show_admin():
                 st.success("Updated & logged")
                 st.rerun()
 
+    with tab6:
+        st.subheader("Live Occupancy")
+        odf_live = storage.get_offices()
+        show_live_board(odf_live["OfficeName"].tolist() if not odf_live.empty else [])
+
+    with tab7:
+        show_anomalies()
+
     # Keep a bottom Back as well for convenience
     if st.button("Back", key="admin_back_bottom"):
         nav_to("home")
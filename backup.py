@@ -0,0 +1,297 @@
+# backup.py
+#
+# Online snapshots of the live store, safe to take during business hours:
+# - SQLite (sql backend, or sqlalchemy on a sqlite:/// URL) is copied with the
+#   online backup API in small page steps. Each step holds the read lock for
+#   only a few milliseconds, so punches keep committing between steps.
+# - The Excel workbook is snapshotted after successful saves (at most once per
+#   EXCEL_SNAPSHOT_MIN_SECONDS; saves inside that window get one trailing
+#   snapshot at its end). The copy runs on a background thread and is
+#   zip-verified before it is kept.
+# Old snapshots are pruned by a recent + daily retention policy. Restore swaps
+# a snapshot back in place, after first snapshotting the current state.
+#
+# A SQLite restore brings back the snapshot's change_log too, but the Seq counter
+# is moved past every Seq issued before the restore: changes made afterwards get
+# new numbers, so feed consumers never skip them (their entries from after the
+# snapshot stay in their own records; the data they describe is gone). The
+# Excel backend's changes.db is not part of a snapshot and keeps counting.
+#
+#     python backup.py                 # take a snapshot now
+#     python backup.py --list
+#     python backup.py --restore attendance_20261019-101500-000_manual.db
+
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+from storage import CHANGE_LOG_DDL, DATA_FILE, ExcelStorage, SqlStorage, notify, on_workbook_saved, report_error
+
+BACKUP_DIR = "backups"
+BACKUP_PAGES_PER_STEP = 256  # ~1 MB with 4 KB pages
+BACKUP_STEP_SLEEP = 0.01  # seconds between steps; writers get the lock here
+BACKUP_MAX_RESTARTS = 3
+BACKUP_INTERVAL_SECONDS = 3600  # scheduled SQLite snapshots
+EXCEL_SNAPSHOT_MIN_SECONDS = 300
+BACKUP_KEEP_RECENT = 24  # newest snapshots always kept
+BACKUP_KEEP_DAYS = 14  # plus the newest snapshot of each of the last N days
+
+
+def sqlite_path(storage):
+    # The database file behind a SQL backend, or None when it is not a local SQLite file
+    if isinstance(storage, SqlStorage):
+        return storage.db_path
+    engine = getattr(storage, "engine", None)
+    if engine is not None and engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+        return engine.url.database
+    return None
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def backup_sqlite(src_path, dest_path, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP, max_restarts=BACKUP_MAX_RESTARTS):
+    # A commit from another connection restarts a stepped backup; when punches keep doing that,
+    # the copy finishes in one step instead (one short read lock) so it always completes
+    tmp = dest_path + ".tmp"
+    state = {"remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                raise _TooManyRestarts
+        state["remaining"] = remaining
+
+    src, dst = sqlite3.connect(src_path), sqlite3.connect(tmp)
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+        except _TooManyRestarts:
+            src.backup(dst)
+    finally:
+        dst.close(); src.close()
+    os.replace(tmp, dest_path)
+    return state["restarts"]
+
+
+def issued_change_seq(con):
+    # Highest change_log Seq ever handed out (deleted rows included), 0 before the first change
+    con.execute(CHANGE_LOG_DDL)  # snapshots from before the change feed have no change_log
+    row = con.execute("SELECT seq FROM sqlite_sequence WHERE name='change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def reserve_change_seq(con, floor):
+    # The next change_log row gets a Seq above `floor`
+    con.execute(CHANGE_LOG_DDL)
+    if con.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='change_log'", (floor,)).rowcount == 0:
+        con.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (floor,))
+
+
+def list_snapshots(root, ext):
+    if not os.path.isdir(root):
+        return []
+    snaps = []
+    for f in os.listdir(root):
+        if f.startswith("attendance_") and f.endswith(ext):
+            st = os.stat(os.path.join(root, f))
+            snaps.append({"name": f, "bytes": st.st_size, "created": datetime.fromtimestamp(st.st_mtime)})
+    return sorted(snaps, key=lambda s: s["name"], reverse=True)  # names sort by time, newest first
+
+
+def swap_in(src, dest):
+    # Copy next to the target, then rename over it: readers see the old or the new file, never half of one
+    shutil.copyfile(src, dest + ".restore")
+    os.replace(dest + ".restore", dest)
+
+
+def recover_workbook(root=BACKUP_DIR):
+    # Startup recovery for a corrupted workbook: put back the newest snapshot that verifies
+    for snap in list_snapshots(root, ".xlsx"):
+        path = os.path.join(root, snap["name"])
+        if verify_workbook(path):
+            swap_in(path, DATA_FILE)
+            return snap["name"]
+    return None
+
+
+def verify_workbook(path):
+    # A workbook copied mid-save fails the zip CRC check
+    try:
+        with zipfile.ZipFile(path) as z:
+            return z.testzip() is None and "xl/workbook.xml" in z.namelist()
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+class BackupManager:
+    def __init__(self, storage, root=BACKUP_DIR):
+        self.storage = storage
+        self.root = root
+        self.db_path = sqlite_path(storage)
+        self.kind = "excel" if isinstance(storage, ExcelStorage) else "sqlite" if self.db_path else None
+        self._lock = threading.Lock()  # one snapshot at a time
+        self._excel_lock = threading.Lock()  # guards the throttle state below
+        self._last_excel_snapshot = 0.0
+        self._trailing = None  # timer for the snapshot at the end of the throttle window
+        self._unsubscribe = lambda: None
+        self.last_report = None
+
+    @property
+    def ext(self):
+        return ".xlsx" if self.kind == "excel" else ".db"
+
+    # --- snapshots ---
+    def snapshot(self, reason="manual"):
+        if self.kind is None:
+            return {"ok": False, "error": "Backups of server databases are left to the database's own tooling"}
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            now = datetime.now()
+            name = f"attendance_{now:%Y%m%d-%H%M%S}-{now.microsecond // 1000:03d}_{reason}{self.ext}"
+            path = os.path.join(self.root, name)
+            started = time.perf_counter()
+            try:
+                restarts = 0
+                if self.kind == "sqlite":
+                    restarts = backup_sqlite(self.db_path, path)
+                else:
+                    shutil.copyfile(DATA_FILE, path + ".tmp")
+                    if not verify_workbook(path + ".tmp"):
+                        os.remove(path + ".tmp")
+                        raise ValueError("workbook changed while copying")
+                    os.replace(path + ".tmp", path)
+            except Exception as e:
+                self.last_report = {"ok": False, "name": name, "error": str(e)}
+                report_error(f"Backup failed: {e}")
+                return self.last_report
+            pruned = self.prune()
+            self.last_report = {"ok": True, "name": name, "bytes": os.path.getsize(path),
+                                "duration_s": round(time.perf_counter() - started, 3), "restarts": restarts, "pruned": len(pruned)}
+            return self.last_report
+
+    def on_workbook_saved(self, event, payload):
+        # Called by storage after every workbook save; the copy happens off the writer's thread.
+        # Inside the throttle window one trailing snapshot is scheduled, so a burst's last saves are kept too
+        if self.kind != "excel":
+            return
+        with self._excel_lock:
+            if self._trailing is not None:
+                return  # the pending snapshot will copy this save as well
+            wait = self._last_excel_snapshot + EXCEL_SNAPSHOT_MIN_SECONDS - time.monotonic()
+            self._trailing = threading.Timer(max(wait, 0), self._excel_snapshot)
+            self._trailing.name, self._trailing.daemon = "attendance-backup", True
+            self._trailing.start()
+
+    def _excel_snapshot(self):
+        with self._excel_lock:
+            self._trailing = None
+            self._last_excel_snapshot = time.monotonic()
+        self.snapshot("auto")
+
+    def close(self):
+        # Stop following workbook saves (the app drops evicted resources); a scheduled snapshot is dropped too
+        self._unsubscribe()
+        with self._excel_lock:
+            if self._trailing is not None:
+                self._trailing.cancel()
+                self._trailing = None
+
+    # --- retention ---
+    def list_snapshots(self):
+        return list_snapshots(self.root, self.ext)
+
+    def prune(self, keep_recent=BACKUP_KEEP_RECENT, keep_days=BACKUP_KEEP_DAYS):
+        snaps = self.list_snapshots()
+        keep = {s["name"] for s in snaps[:keep_recent]}
+        days = []
+        for s in snaps:  # newest first, so the first seen per day is that day's newest
+            day = s["name"][len("attendance_"):][:8]
+            if day not in days:
+                days.append(day)
+                if len(days) <= keep_days:
+                    keep.add(s["name"])
+        removed = [s["name"] for s in snaps if s["name"] not in keep]
+        for name in removed:
+            os.remove(os.path.join(self.root, name))
+        return removed
+
+    # --- restore ---
+    def restore(self, name):
+        path = os.path.join(self.root, os.path.basename(name))
+        if not os.path.exists(path):
+            raise FileNotFoundError(name)
+        if self.kind == "excel" and not verify_workbook(path):
+            raise ValueError(f"{name} is not a valid workbook")
+        safety = self.snapshot("pre-restore")
+        with self.storage.lock:
+            if self.kind == "sqlite":
+                # One step, in place: pooled connections stay valid and see the restored data
+                src, dst = sqlite3.connect(path), sqlite3.connect(self.db_path, timeout=30)
+                try:
+                    issued = issued_change_seq(dst)
+                    dst.commit()
+                    src.backup(dst)
+                    with dst:
+                        reserve_change_seq(dst, issued)  # Seq values are never handed out twice
+                finally:
+                    dst.close(); src.close()
+            else:
+                swap_in(path, DATA_FILE)
+            self.storage.invalidate_caches()  # access cache is rebuilt from the restored data
+        notify(self.storage, "storage_reloaded", [{"reason": "restore", "name": name}])  # so are the event-fed caches
+        return {"restored": name, "safety_snapshot": safety.get("name")}
+
+
+class BackupScheduler(threading.Thread):
+    # Periodic SQLite snapshots; Excel snapshots are driven by workbook saves instead
+    def __init__(self, manager, interval=BACKUP_INTERVAL_SECONDS):
+        super().__init__(name="attendance-backup-scheduler", daemon=True)
+        self.manager = manager
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.manager.snapshot("scheduled")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def make_backup_manager(storage, root=BACKUP_DIR):
+    # Call manager.close() when dropping it: the workbook-save listener is process-wide
+    manager = BackupManager(storage, root)
+    if manager.kind == "excel":
+        manager._unsubscribe = on_workbook_saved(manager.on_workbook_saved)
+    return manager
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Snapshot, list or restore attendance backups")
+    ap.add_argument("--list", action="store_true")
+    ap.add_argument("--restore", metavar="NAME")
+    args = ap.parse_args()
+    s = make_storage()
+    s.init()
+    m = BackupManager(s)
+    if args.list:
+        for snap in m.list_snapshots():
+            print(f"{snap['name']}  {snap['bytes']:>12,}  {snap['created']:%Y-%m-%d %H:%M:%S}")
+    elif args.restore:
+        print(json.dumps(m.restore(args.restore), indent=2))
+    else:
+        result = m.snapshot()
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result["ok"] else 1)
@@ -0,0 +1,199 @@
+# bulk_import.py
+#
+# Admin bulk import of users, departments and offices from CSV or XLSX. Every
+# check runs column-wise over the whole upload. Rows that fail are listed in a
+# per-row error report. The valid rows then go to storage in one write: one
+# transaction for SQL, one workbook save for Excel.
+#
+# An XLSX upload may hold several sheets named users / departments / offices,
+# so a user can reference a department created in the same import.
+# In a multi-tenant deployment the new phones are claimed in the tenant catalog
+# first (tenants.PhoneClaims); phones of other organizations are row errors.
+#
+#     python bulk_import.py people.xlsx              # dry run, prints the error report
+#     python bulk_import.py users.csv --kind users --apply
+
+import os
+from io import BytesIO
+
+import pandas as pd
+
+from storage import DEFAULT_DASHBOARD_PW, hash_pw, report_error
+
+IMPORT_KINDS = ["users", "departments", "offices"]
+IMPORT_COLUMNS = {
+    "users": ["PhoneNumber", "Name", "Departments", "Password"],
+    "departments": ["DepartmentGroup"],
+    "offices": ["OfficeName", "Latitude", "Longitude", "RadiusMeters"],
+}
+REQUIRED_COLUMNS = {"users": ["PhoneNumber", "Name"], "departments": ["DepartmentGroup"],
+                    "offices": ["OfficeName", "Latitude", "Longitude"]}
+ERROR_COLUMNS = ["Sheet", "Row", "Column", "Value", "Error"]
+PHONE_PATTERN = r"^\d{10}$"
+DEFAULT_RADIUS_METERS = 350
+
+
+def read_upload(name, data, kind=None):
+    # -> {kind: DataFrame}; everything is read as text so phone numbers keep leading zeros
+    if str(name).lower().endswith((".xlsx", ".xlsm")):
+        sheets = pd.read_excel(BytesIO(data), sheet_name=None, dtype=str, engine="openpyxl")
+        frames = {s.strip().lower(): df for s, df in sheets.items() if s.strip().lower() in IMPORT_KINDS}
+        if not frames and kind and len(sheets) == 1:
+            frames = {kind: next(iter(sheets.values()))}
+    else:
+        frames = {kind or "users": pd.read_csv(BytesIO(data), dtype=str, keep_default_na=False)}
+    return {k: df.rename(columns=lambda c: str(c).strip()).fillna("").apply(lambda col: col.str.strip())
+            for k, df in frames.items()}
+
+
+def _errors(sheet, df, mask, column, msg):
+    bad = df.loc[mask]
+    return pd.DataFrame({"Sheet": sheet, "Row": bad.index + 2,  # header is spreadsheet row 1
+                         "Column": column, "Value": bad[column] if column in bad else "", "Error": msg})
+
+
+def _valid_rows(df, errs):
+    return df.loc[~df.index.isin(pd.concat(errs)["Row"] - 2)]
+
+
+def _missing_columns(kind, df):
+    missing = [c for c in REQUIRED_COLUMNS[kind] if c not in df.columns]
+    if not missing:
+        return None
+    return pd.DataFrame([{"Sheet": kind, "Row": 1, "Column": c, "Value": "", "Error": "Missing column"} for c in missing])
+
+
+def _split_departments(col):
+    # "HR, Ops" -> ["HR", "Ops"], exploded one department per row (index kept)
+    return col.str.split(",").explode().str.strip().loc[lambda s: s.fillna("") != ""]
+
+
+def validate_departments(df, existing):
+    errs = [_errors("departments", df, df["DepartmentGroup"] == "", "DepartmentGroup", "Department name is empty"),
+            _errors("departments", df, df["DepartmentGroup"].isin(existing), "DepartmentGroup", "Department already exists"),
+            _errors("departments", df, (df["DepartmentGroup"] != "") & df["DepartmentGroup"].duplicated(), "DepartmentGroup",
+                    "Duplicate department in file")]
+    return errs
+
+
+def validate_offices(df, existing):
+    lat = pd.to_numeric(df["Latitude"], errors="coerce")
+    lon = pd.to_numeric(df["Longitude"], errors="coerce")
+    rad = pd.to_numeric(df.get("RadiusMeters", pd.Series("", index=df.index)).replace("", DEFAULT_RADIUS_METERS), errors="coerce")
+    name = df["OfficeName"]
+    errs = [_errors("offices", df, name == "", "OfficeName", "Office name is empty"),
+            _errors("offices", df, name.isin(existing), "OfficeName", "Office already exists"),
+            _errors("offices", df, (name != "") & name.duplicated(), "OfficeName", "Duplicate office in file"),
+            _errors("offices", df, ~lat.between(-90, 90), "Latitude", "Latitude must be a number between -90 and 90"),
+            _errors("offices", df, ~lon.between(-180, 180), "Longitude", "Longitude must be a number between -180 and 180"),
+            _errors("offices", df, ~(rad > 0), "RadiusMeters", "Radius must be a positive number")]
+    # Both zero is the number_input default, never a real office
+    errs.append(_errors("offices", df, (lat == 0) & (lon == 0), "Latitude", "Coordinates are 0,0"))
+    return errs, lat, lon, rad
+
+
+def validate_users(df, existing_phones, known_departments, foreign_phones=None):
+    phone = df["PhoneNumber"].str.replace(r"[\s-]", "", regex=True).str.replace(r"^\+91", "", regex=True)
+    df["PhoneNumber"] = phone
+    deps = _split_departments(df["Departments"]) if "Departments" in df else pd.Series(dtype=str)
+    unknown = deps[~deps.isin(known_departments)]
+    errs = [_errors("users", df, ~phone.str.match(PHONE_PATTERN), "PhoneNumber", "Phone number must be 10 digits"),
+            _errors("users", df, phone.isin(existing_phones), "PhoneNumber", "User already exists"),
+            _errors("users", df, (phone != "") & phone.duplicated(), "PhoneNumber", "Duplicate phone number in file"),
+            _errors("users", df, df["Name"] == "", "Name", "Name is empty")]
+    if foreign_phones is not None:  # phones -> {phone: other tenant}
+        taken = foreign_phones(phone[phone.str.match(PHONE_PATTERN)].tolist())
+        errs.append(_errors("users", df, phone.isin(list(taken)), "PhoneNumber", "Phone registered with another organization"))
+    if not unknown.empty:
+        errs.append(pd.DataFrame({"Sheet": "users", "Row": unknown.index + 2, "Column": "Departments",
+                                  "Value": unknown.values, "Error": "Unknown department"}))
+    return errs
+
+
+def run_import(storage, frames, dry_run=True, default_password=DEFAULT_DASHBOARD_PW, claims=None):
+    # Validates every sheet against storage (and each other), then writes the valid rows in one storage call
+    frames = dict(frames)
+    errors, clean = [], {}
+    for kind in list(frames):
+        missing = _missing_columns(kind, frames[kind])
+        if missing is not None:
+            errors.append(missing)
+            del frames[kind]
+
+    existing_deps = set(storage.get_departments().get("DepartmentGroup", pd.Series(dtype=str)).astype(str))
+    new_deps = set()
+    if "departments" in frames:
+        df = frames["departments"].reset_index(drop=True)
+        errs = validate_departments(df, existing_deps)
+        errors += errs
+        ok = _valid_rows(df, errs)
+        new_deps = set(ok["DepartmentGroup"])
+        clean["departments"] = ok[["DepartmentGroup"]].to_dict("records")
+
+    if "offices" in frames:
+        df = frames["offices"].reset_index(drop=True)
+        existing = set(storage.get_offices().get("OfficeName", pd.Series(dtype=str)).astype(str))
+        errs, lat, lon, rad = validate_offices(df, existing)
+        errors += errs
+        ok = _valid_rows(df, errs).index
+        clean["offices"] = pd.DataFrame({"OfficeName": df.loc[ok, "OfficeName"], "Latitude": lat[ok],
+                                         "Longitude": lon[ok], "RadiusMeters": rad[ok]}).to_dict("records")
+
+    if "users" in frames:
+        df = frames["users"].reset_index(drop=True)
+        existing = set(storage.get_users().get("PhoneNumber", pd.Series(dtype=str)).astype(str))
+        errs = validate_users(df, existing, existing_deps | new_deps, claims.foreign if claims else None)
+        errors += errs
+        ok = _valid_rows(df, errs)
+        pw = ok["Password"] if "Password" in ok else pd.Series("", index=ok.index)
+        deps = ok["Departments"].str.split(",").map(lambda ds: ",".join(d.strip() for d in ds if d.strip())) \
+            if "Departments" in ok else ""
+        clean["users"] = pd.DataFrame({"PhoneNumber": ok["PhoneNumber"], "Name": ok["Name"], "Departments": deps,
+                                       "PasswordHash": pw.replace("", default_password).map(hash_pw),
+                                       "Role": "User"}).to_dict("records")
+
+    errors = pd.concat(errors, ignore_index=True).sort_values(["Sheet", "Row"]) if errors else pd.DataFrame(columns=ERROR_COLUMNS)
+    report = {"dry_run": dry_run, "rows": {k: len(v) for k, v in frames.items()},
+              "valid": {k: len(v) for k, v in clean.items()}, "errors": errors.reset_index(drop=True), "written": False}
+    if not dry_run and any(clean.values()):
+        phones = [u["PhoneNumber"] for u in clean.get("users", [])]
+        claimed, taken = claims.claim(phones) if claims and phones else ([], {})
+        if taken:  # registered with another organization since validation
+            report_error(f"Import stopped, nothing was written: phones registered with another organization: {', '.join(taken)}")
+            return report
+        report["written"] = storage.import_records(users=clean.get("users", []), departments=clean.get("departments", []),
+                                                   offices=clean.get("offices", []))
+        if not report["written"] and claims:
+            claims.release(claimed)
+    return report
+
+
+def template_workbook():
+    # Empty XLSX with the expected sheets and headers, offered as a download in the admin page
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+        for kind in IMPORT_KINDS:
+            pd.DataFrame(columns=IMPORT_COLUMNS[kind]).to_excel(writer, sheet_name=kind, index=False)
+    return buf.getvalue()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Bulk import users, departments and offices")
+    ap.add_argument("path")
+    ap.add_argument("--kind", choices=IMPORT_KINDS, help="what a CSV (or single-sheet XLSX) contains")
+    ap.add_argument("--apply", action="store_true", help="write valid rows (default is a dry run)")
+    ap.add_argument("--default-password", default=DEFAULT_DASHBOARD_PW)
+    args = ap.parse_args()
+    s = make_storage()
+    s.init()
+    with open(args.path, "rb") as f:
+        frames = read_upload(os.path.basename(args.path), f.read(), args.kind)
+    result = run_import(s, frames, dry_run=not args.apply, default_password=args.default_password)
+    print(f"rows: {result['rows']}  valid: {result['valid']}  written: {result['written']}")
+    if not result["errors"].empty:
+        print(result["errors"].to_string(index=False))
+    sys.exit(0 if result["errors"].empty else 1)
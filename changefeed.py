@@ -0,0 +1,83 @@
+# changefeed.py
+#
+# Cursor-based reader for the append-only change log (see CHANGE FEED in
+# storage.py). Punches, attendance edits and user changes each get a Seq
+# number; a consumer such as payroll remembers the last Seq it processed and
+# asks for everything after it, one page at a time. Entries are never
+# rewritten, so re-reading from an old cursor is always safe. A restore (see
+# backup.py) puts back older entries but never reuses a Seq, so a cursor taken
+# before it still sees every change made after it.
+#
+#     python changefeed.py --since 0 --limit 500
+#     python changefeed.py --cursor-file payroll.cursor     # resume; the file is advanced after printing
+#     python changefeed.py --cursor-file payroll.cursor --follow
+
+import json
+import os
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+def read_changes(storage, since=0, limit=DEFAULT_PAGE_SIZE):
+    # -> {"changes": [...], "next_cursor": Seq of the last change (or since), "has_more": bool}
+    since = max(0, int(since))
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    rows = storage.get_changes(since, limit + 1)  # one extra row tells whether another page exists
+    page = rows[:limit]
+    changes = [{"seq": r["Seq"], "at": r["At"], "event": r["Event"], "phone": r["PhoneNumber"], "date": r["Date"],
+                "data": json.loads(r["Data"] or "{}")} for r in page]
+    return {"changes": changes, "next_cursor": page[-1]["Seq"] if page else since, "has_more": len(rows) > limit}
+
+
+def iter_changes(storage, since=0, limit=DEFAULT_PAGE_SIZE):
+    # Every change after `since`, fetched page by page
+    while True:
+        page = read_changes(storage, since, limit)
+        yield from page["changes"]
+        if not page["has_more"]:
+            return
+        since = page["next_cursor"]
+
+
+def load_cursor(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def save_cursor(path, seq):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(str(seq))
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Print attendance changes after a sequence number, as JSON lines")
+    ap.add_argument("--since", type=int, help="last Seq already processed (default 0, or the cursor file)")
+    ap.add_argument("--limit", type=int, default=DEFAULT_PAGE_SIZE, help="changes per page")
+    ap.add_argument("--cursor-file", help="read the cursor from this file and advance it after printing")
+    ap.add_argument("--follow", action="store_true", help="keep polling for new changes")
+    ap.add_argument("--interval", type=float, default=5.0, help="seconds between polls with --follow")
+    args = ap.parse_args()
+    s = make_storage()
+    s.init()
+    since = args.since if args.since is not None else load_cursor(args.cursor_file) if args.cursor_file else 0
+    while True:
+        page = read_changes(s, since, args.limit)
+        for c in page["changes"]:
+            print(json.dumps(c), flush=True)
+        since = page["next_cursor"]
+        if args.cursor_file and page["changes"]:
+            save_cursor(args.cursor_file, since)
+        if page["has_more"]:
+            continue
+        if not args.follow:
+            break
+        time.sleep(args.interval)
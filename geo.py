@@ -0,0 +1,92 @@
+# geo.py
+#
+# Geofence checks shared by the Mark Attendance page and the headless API, and
+# the per-session location fix used by the Mark Attendance page: the browser is
+# asked once, the fix is reused until it is GEO_MAX_AGE_SECONDS old, and the
+# inside/outside verdict for every office is computed once per fix.
+
+import os
+import time
+
+import pandas as pd
+from geopy.distance import geodesic
+
+GEOFENCE_BUFFER_METERS = 150  # tolerance added to each office radius for GPS drift
+GEO_MAX_AGE_SECONDS = int(os.environ.get("ATTENDANCE_GEO_MAX_AGE_SECONDS", "300"))
+GEO_RETRY_SECONDS = 30  # a failed lookup (e.g. permission denied) is not retried on every rerun
+
+
+def office_row(offices_df, office_name):
+    if offices_df is None or offices_df.empty:
+        return None
+    r = offices_df[offices_df["OfficeName"] == office_name]
+    return None if r.empty else r.iloc[0]
+
+
+def distance_to_office_m(row, lat, lon):
+    return geodesic((float(lat), float(lon)), (float(row["Latitude"]), float(row["Longitude"]))).meters
+
+
+def office_verdict(row, lat, lon):
+    # -> (inside, distance in meters)
+    d = distance_to_office_m(row, lat, lon)
+    return d <= float(row["RadiusMeters"]) + GEOFENCE_BUFFER_METERS, d
+
+
+def office_distance_matrix(offices_df):
+    # Meters between every pair of offices, indexed by OfficeName on both axes
+    if offices_df is None or offices_df.empty:
+        return pd.DataFrame()
+    names = offices_df["OfficeName"].astype(str).tolist()
+    rows = [r for _, r in offices_df.iterrows()]
+    return pd.DataFrame([[distance_to_office_m(b, a["Latitude"], a["Longitude"]) for b in rows] for a in rows],
+                        index=pd.Index(names), columns=names)
+
+
+def within_office(offices_df, office_name, lat, lon) -> bool:
+    row = office_row(offices_df, office_name)
+    if row is None or lat is None or lon is None:
+        return False
+    return office_verdict(row, lat, lon)[0]
+
+
+def office_verdicts(offices_df, lat, lon):
+    # -> {office: (inside, distance in meters)} for every office
+    if offices_df is None or offices_df.empty:
+        return {}
+    return {r["OfficeName"]: office_verdict(r, lat, lon) for _, r in offices_df.iterrows()}
+
+
+def make_fix(location, offices_df, now=None):
+    # Browser geolocation result -> cached fix. Failures are cached too, with the browser's message.
+    now = time.time() if now is None else now
+    coords = (location or {}).get("coords") or {}
+    lat, lon = coords.get("latitude"), coords.get("longitude")
+    if lat is None or lon is None:
+        err = (location or {}).get("error") or {}
+        return {"at": now, "error": err.get("message") or "Location unavailable"}
+    return {"at": now, "lat": float(lat), "lon": float(lon), "accuracy": coords.get("accuracy"),
+            "verdicts": office_verdicts(offices_df, lat, lon)}
+
+
+def fix_age(fix, now=None):
+    return (time.time() if now is None else now) - fix["at"]
+
+
+def needs_fix(fix, max_age=GEO_MAX_AGE_SECONDS, now=None):
+    if fix is None:
+        return True
+    return fix_age(fix, now) > (GEO_RETRY_SECONDS if "error" in fix else max_age)
+
+
+def fix_verdict(fix, offices_df, office_name):
+    # True/False from the cached fix, None without a usable fix. Offices added after the fix are checked once.
+    if not fix or "error" in fix:
+        return None
+    verdicts = fix["verdicts"]
+    if office_name not in verdicts:
+        row = office_row(offices_df, office_name)
+        if row is None:
+            return False
+        verdicts[office_name] = office_verdict(row, fix["lat"], fix["lon"])
+    return verdicts[office_name][0]
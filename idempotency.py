@@ -0,0 +1,75 @@
+# idempotency.py
+#
+# Server-side duplicate-punch suppression. One RecentPunches lives on each
+# storage instance (shared by every session in the process); punches whose
+# (phone, action, office, minute) or client idempotency key was already
+# recorded are acknowledged without touching storage.
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+DEDUP_MAX_ENTRIES = 10_000
+DUPLICATE_MESSAGE = "Already recorded"
+
+
+class RecentPunches:
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def claim(self, keys) -> bool:
+        # Reserves all keys atomically; False (nothing reserved) if any was seen before
+        with self._lock:
+            if any(k in self._keys for k in keys):
+                for k in keys:
+                    if k in self._keys: self._keys.move_to_end(k)
+                self.suppressed += 1
+                return False
+            for k in keys:
+                self._keys[k] = True
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+            return True
+
+    def release(self, keys):
+        # Forget keys whose write failed so a retry is not swallowed
+        with self._lock:
+            for k in keys:
+                self._keys.pop(k, None)
+
+
+def punch_keys(p, minute):
+    keys = [("punch", str(p.get("phone")), str(p.get("action")).strip().upper(), str(p.get("office") or ""), minute)]
+    if p.get("idempotency_key"):
+        keys.append(("token", str(p.get("phone")), str(p["idempotency_key"])))
+    return keys
+
+
+def run_deduplicated(recent, punches, write_fn):
+    # Calls write_fn with only the fresh punches; results keep the input order
+    minute = datetime.now(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d %H:%M")
+    results, fresh, claimed = [None] * len(punches), [], []
+    in_batch, repeats = {}, []  # key -> index claimed in this batch; (i, index) for repeats of it
+    for i, p in enumerate(punches):
+        keys = punch_keys(p, minute)
+        if recent.claim(keys):
+            fresh.append(i); claimed.append(keys)
+            in_batch.update((k, i) for k in keys)
+            continue
+        first = next((in_batch[k] for k in keys if k in in_batch), None)
+        if first is None:
+            results[i] = (True, DUPLICATE_MESSAGE)
+        else:
+            repeats.append((i, first))
+    if fresh:
+        written = write_fn([punches[i] for i in fresh])
+        for i, keys, res in zip(fresh, claimed, written):
+            results[i] = res
+            if not res[0]: recent.release(keys)
+    for i, first in repeats:
+        results[i] = (True, DUPLICATE_MESSAGE) if results[first][0] else results[first]
+    return results
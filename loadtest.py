@@ -0,0 +1,302 @@
+# loadtest.py
+#
+# Morning-rush load test. Replays the storage calls the Streamlit pages make
+# (login -> Mark Attendance -> IN, plus admin dashboard reruns) for many
+# concurrent simulated sessions, in a scratch directory so real data is never
+# touched. Geolocation is stubbed: each user "stands" inside or near their office.
+#
+#     python loadtest.py --users 500 --window 600 --backends excel sql sqlalchemy
+#     python loadtest.py --users 200 --pool process --workers 4 --double-click 0.2
+#
+# Threads share one storage instance (like one Streamlit server); processes
+# each open their own (like replicas behind a load balancer).
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+import storage as storage_mod
+from geo import within_office
+from storage import SEED_OFFICES, hash_pw, make_storage
+
+PASSWORD = "loadtest"
+_worker_storage = None  # per-process storage for the process pool
+_reported = []  # messages storage passed to report_error in this process (e.g. failed workbook saves)
+
+
+def collect_reported(msg):
+    _reported.append(str(msg))
+
+
+def drain_reported():
+    msgs = _reported[:]
+    del _reported[:len(msgs)]
+    return msgs
+
+
+def open_storage(backend, workdir):
+    os.chdir(workdir)  # DATA_FILE and attendance.db are relative paths
+    if backend == "sqlalchemy":
+        storage_mod.DATABASE_URL = f"sqlite:///{os.path.join(workdir, 'attendance.db')}"
+    return make_storage(backend)
+
+
+def seed(backend, workdir, n_users):
+    s = open_storage(backend, workdir)
+    s.init()
+    if s.get_offices().empty:
+        for o in SEED_OFFICES:
+            s.add_office(o["OfficeName"], o["Latitude"], o["Longitude"], o["RadiusMeters"])
+    users = [{"PhoneNumber": f"9{i:09d}", "Name": f"User{i}", "Departments": random.choice(["Sales", "Ops", "HR", "IT"]),
+              "PasswordHash": hash_pw(PASSWORD), "Role": "User"} for i in range(n_users)]
+    if backend == "excel":
+        # One workbook write instead of n_users rewrites
+        df = pd.concat([storage_mod.read_sheet("users"), pd.DataFrame(users)], ignore_index=True)
+        storage_mod.write_sheet("users", df)
+    else:
+        for u in users:
+            s.add_user(u)
+    return users
+
+
+def stub_location(office, inside):
+    # Roughly 50 m from the office when inside, ~5 km away otherwise
+    d = 0.0005 if inside else 0.05
+    return {"coords": {"latitude": float(office["Latitude"]) + d, "longitude": float(office["Longitude"])}}
+
+
+# ---------------------------
+# Simulated page flows (mirror the storage calls in app.py)
+# ---------------------------
+def timed(timings, op, fn, *args):
+    t, err = time.perf_counter(), None
+    try:
+        return fn(*args)
+    except Exception as e:
+        err = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        timings.append((op, time.perf_counter() - t, err))
+
+
+def employee_session(s, user, office_name, inside, clicks):
+    timings, outcome = [], None
+    try:
+        ok = timed(timings, "login", s.check_password, user["PhoneNumber"], PASSWORD)
+        if not ok:
+            return timings, ("login_failed", user["PhoneNumber"])
+        u = timed(timings, "login", s.get_user, user["PhoneNumber"])
+        timed(timings, "home", s.has_access, u["PhoneNumber"])
+        offices_df = timed(timings, "mark_page", s.get_offices)
+        loc = stub_location(offices_df[offices_df["OfficeName"] == office_name].iloc[0], inside)
+        within_office(offices_df, office_name, loc["coords"]["latitude"], loc["coords"]["longitude"])
+        for _ in range(clicks):  # double clicks / reloads
+            ok, msg = timed(timings, "punch_in", s.mark_attendance, u["PhoneNumber"], u["Name"], u["Departments"], "IN", office_name)
+            outcome = ("ok" if ok else "failed", u["PhoneNumber"], msg)
+    except Exception as e:
+        outcome = ("error", user["PhoneNumber"], f"{type(e).__name__}: {e}")
+    return timings, outcome
+
+
+def admin_session(s):
+    timings = []
+    try:
+        timed(timings, "admin_rerun", s.get_attendance)
+        timed(timings, "admin_rerun", s.get_departments)
+        timed(timings, "admin_rerun", s.get_offices)
+        timed(timings, "admin_rerun", s.get_access_grants)
+    except Exception:
+        pass
+    return timings, None
+
+
+def run_session(s, kind, args):
+    return admin_session(s) if kind == "admin" else employee_session(s, *args)
+
+
+def _init_process(backend, workdir):
+    global _worker_storage
+    storage_mod.set_error_reporter(collect_reported)
+    _worker_storage = open_storage(backend, workdir)
+
+
+def _process_task(kind, args):
+    # Errors reported inside a worker process travel back with its session
+    return (*run_session(_worker_storage, kind, args), drain_reported())
+
+
+def _thread_task(s, kind, args):
+    # Threads report into this process's list, drained once after the run
+    return (*run_session(s, kind, args), [])
+
+
+# ---------------------------
+# Runner
+# ---------------------------
+def build_schedule(users, window, admins, admin_interval, double_click, outside_rate):
+    office_names = [o["OfficeName"] for o in SEED_OFFICES]
+    tasks = [(random.uniform(0, window), "employee",
+              (u, random.choice(office_names), random.random() >= outside_rate, 2 if random.random() < double_click else 1))
+             for u in users]
+    for a in range(admins):
+        t = 0.0
+        while t <= window:
+            tasks.append((t + a * admin_interval / max(admins, 1), "admin", ()))
+            t += admin_interval
+    return sorted(tasks, key=lambda t: t[0])
+
+
+def run_backend(backend, args):
+    workdir = tempfile.mkdtemp(prefix=f"loadtest_{backend}_")
+    cwd = os.getcwd()
+    try:
+        users = seed(backend, workdir, args.users)
+        schedule = build_schedule(users, args.window, args.admins, args.admin_interval, args.double_click, args.outside_rate)
+
+        if args.pool == "process":
+            pool = ProcessPoolExecutor(args.workers, initializer=_init_process, initargs=(backend, workdir))
+            submit = lambda kind, a: pool.submit(_process_task, kind, a)
+        else:
+            shared = open_storage(backend, workdir)
+            pool = ThreadPoolExecutor(args.workers)
+            submit = lambda kind, a: pool.submit(_thread_task, shared, kind, a)
+
+        drain_reported()  # seeding is not part of the run
+        start = time.perf_counter()
+        futures = []
+        for at, kind, a in schedule:
+            delay = at - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(submit(kind, a))
+        timings, outcomes, reported = [], [], []
+        for f in as_completed(futures):
+            t, o, r = f.result()
+            timings.extend(t)
+            reported.extend(r)
+            if o:
+                outcomes.append(o)
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        reported.extend(drain_reported())
+
+        checks = integrity(open_storage(backend, workdir), outcomes)
+        return summarize(backend, args, timings, outcomes, elapsed, checks, reported)
+    finally:
+        os.chdir(cwd)
+
+
+def integrity(s, outcomes):
+    # Every acknowledged IN must be in storage, and (Date, PhoneNumber) must stay unique
+    acked = {o[1] for o in outcomes if o[0] == "ok"}
+    try:
+        df = s.get_attendance()
+    except Exception as e:  # e.g. a workbook corrupted by concurrent writers in several processes
+        return {"acknowledged": len(acked), "rows": 0, "lost_punches": len(acked), "duplicate_rows": 0,
+                "unreadable": f"{type(e).__name__}: {e}"}
+    if df.empty:
+        return {"acknowledged": len(acked), "rows": 0, "lost_punches": len(acked), "duplicate_rows": 0}
+    df["Date"] = storage_mod.iso_dates(df["Date"])
+    present = set(df.loc[df["IN"].astype(str) != "", "PhoneNumber"].astype(str))
+    dups = int(df.duplicated(["Date", "PhoneNumber"]).sum())
+    return {"acknowledged": len(acked), "rows": len(df), "lost_punches": len(acked - present), "duplicate_rows": dups}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def error_kind(msg, default):
+    msg = str(msg).lower()
+    return "lock" if "locked" in msg or "permission" in msg else default
+
+
+def summarize(backend, args, timings, outcomes, elapsed, checks, reported=()):
+    by_op = defaultdict(list)
+    errors = Counter()
+    for op, secs, err in timings:
+        by_op[op].append(secs)
+        if err:
+            errors[error_kind(err, err.split(":")[0])] += 1
+    for o in outcomes:
+        if o[0] == "failed":  # storage returned (False, msg); raised exceptions are counted above
+            errors[error_kind(o[-1], "punch_failed")] += 1
+    for msg in reported:  # storage swallows these (returns False or an empty frame) and reports them instead
+        errors[error_kind(msg, "reported:" + str(msg).split(":")[0])] += 1
+    sessions = Counter(o[0] for o in outcomes)
+    raised = sum(1 for _, _, err in timings if err)
+    punches = len(by_op.get("punch_in", []))
+    return {
+        "backend": backend,
+        "pool": f"{args.pool}x{args.workers}",
+        "users": args.users,
+        "elapsed_s": round(elapsed, 2),
+        "punch_throughput_per_s": round(punches / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {op: {"p50": round(percentile(v, 50) * 1000, 1), "p95": round(percentile(v, 95) * 1000, 1),
+                            "p99": round(percentile(v, 99) * 1000, 1), "max": round(max(v) * 1000, 1), "n": len(v)}
+                       for op, v in sorted(by_op.items())},
+        "errors": dict(errors),
+        "sessions": dict(sessions),
+        "reported_errors": list(reported)[:20],
+        "integrity": checks,
+        "passed": (checks["lost_punches"] == 0 and checks["duplicate_rows"] == 0 and not checks.get("unreadable")
+                   and set(sessions) <= {"ok"} and not raised and not reported),
+    }
+
+
+def print_report(r):
+    print(f"\n== {r['backend']} ({r['pool']}, {r['users']} users, {r['elapsed_s']}s) ==")
+    print(f"punch throughput: {r['punch_throughput_per_s']}/s")
+    print(f"{'op':<12}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (ms)")
+    for op, l in r["latency_ms"].items():
+        print(f"{op:<12}{l['n']:>7}{l['p50']:>9}{l['p95']:>9}{l['p99']:>9}{l['max']:>9}")
+    print(f"sessions: {r['sessions']}")
+    print(f"errors: {r['errors'] or 'none'}")
+    for msg in r["reported_errors"][:3]:
+        print(f"  reported: {msg}")
+    c = r["integrity"]
+    print(f"integrity: {c['acknowledged']} acknowledged, {c['rows']} rows, {c['lost_punches']} lost, "
+          f"{c['duplicate_rows']} duplicate (Date, PhoneNumber) -> {'PASS' if r['passed'] else 'FAIL'}")
+    if c.get("unreadable"):
+        print(f"storage unreadable after run: {c['unreadable']}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Concurrent punch-in load test")
+    ap.add_argument("--backends", nargs="+", default=["excel", "sql"], choices=["excel", "sql", "sqlalchemy"])
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--window", type=float, default=10.0, help="seconds over which sessions arrive")
+    ap.add_argument("--pool", choices=["thread", "process"], default="thread")
+    ap.add_argument("--workers", type=int, default=16)
+    ap.add_argument("--admins", type=int, default=2, help="concurrent admin dashboards re-running")
+    ap.add_argument("--admin-interval", type=float, default=5.0)
+    ap.add_argument("--double-click", type=float, default=0.1, help="share of users who click IN twice")
+    ap.add_argument("--outside-rate", type=float, default=0.1, help="share of users outside the geofence")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args(argv)
+
+    random.seed(args.seed)
+    storage_mod.set_error_reporter(collect_reported)  # errors are counted, not printed
+    results = [run_backend(b, args) for b in args.backends]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print_report(r)
+    return 0 if all(r["passed"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
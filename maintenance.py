@@ -0,0 +1,76 @@
+# maintenance.py
+#
+# Off-peak housekeeping that used to run inside every Excel punch: retention,
+# rotation and compaction for the workbook, ANALYZE/VACUUM for SQLite.
+#
+# The Streamlit app starts one MaintenanceScheduler thread per process. For cron
+# or a one-off run:
+#
+#     python maintenance.py          # run now and print the report
+
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from storage import make_storage, report_error
+
+LOCAL_TZ = ZoneInfo("Asia/Kolkata")
+MAINTENANCE_HOUR = 2  # local time; nobody punches at 02:00
+REPORT_SETTING = "last_maintenance"
+
+
+def run_maintenance(storage):
+    started = datetime.now(LOCAL_TZ)
+    report = {"started_at": started.isoformat(timespec="seconds")}
+    try:
+        report.update(storage.run_maintenance())
+        report["ok"] = True
+    except Exception as e:
+        report.update({"ok": False, "error": str(e)})
+        report_error(f"Maintenance failed: {e}")
+    report["duration_s"] = round((datetime.now(LOCAL_TZ) - started).total_seconds(), 3)
+    storage.set_setting(REPORT_SETTING, json.dumps(report))
+    return report
+
+
+def last_report(storage):
+    raw = storage.get_setting(REPORT_SETTING)
+    try:
+        return json.loads(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def next_run_after(now, hour=MAINTENANCE_HOUR):
+    run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    return run if run > now else run + timedelta(days=1)
+
+
+class MaintenanceScheduler(threading.Thread):
+    def __init__(self, storage, hour=MAINTENANCE_HOUR):
+        super().__init__(name="attendance-maintenance", daemon=True)
+        self.storage = storage
+        self.hour = hour
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            now = datetime.now(LOCAL_TZ)
+            if self._stop_event.wait((next_run_after(now, self.hour) - now).total_seconds()):
+                break
+            run_maintenance(self.storage)
+            time.sleep(1)  # never fire twice for the same slot
+
+    def stop(self):
+        self._stop_event.set()
+
+
+if __name__ == "__main__":
+    store = make_storage()
+    store.init()
+    result = run_maintenance(store)
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if result["ok"] else 1)
@@ -0,0 +1,258 @@
+# occupancy.py
+#
+# Live per-office / per-department headcounts for today. The board is built once
+# from storage, then kept current from storage events ("attendance_marked",
+# "attendance_updated") so the admin Live view never has to scan attendance rows.
+#
+# TodayStatusCache is the per-user counterpart for the home and mark pages: one
+# keyed lookup at login, then updated in place by the same events.
+#
+# Events only reach subscribers in the writing process. Punches from the API or
+# another replica are picked up from the change feed (changefeed.py): both caches
+# keep a cursor and replay newer entries at most every FEED_POLL_SECONDS.
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+
+from changefeed import iter_changes
+
+LOCAL_TZ = ZoneInfo("Asia/Kolkata")
+FEED_POLL_SECONDS = 2
+STATUSES = ["In Office", "WFH", "Out", "Leave"]
+NOT_MARKED = "Not marked"
+PUNCH_ACTIONS = ["IN", "OUT", "Leave", "WFH IN", "WFH OUT"]
+# What the mark page offers for each status; everything else is hidden unless asked for
+ACTIONS_BY_STATUS = {
+    NOT_MARKED: ["IN", "Leave", "WFH IN"],
+    "In Office": ["OUT"],
+    "WFH": ["WFH OUT"],
+    "Out": ["IN", "WFH IN"],
+    "Leave": [],
+}
+
+
+def today_local():
+    return datetime.now(LOCAL_TZ).date()
+
+
+def split_list(value):
+    return [p.strip() for p in str(value or "").split(",") if p.strip()]
+
+
+def person_status(rec):
+    # IN is overwritten on every IN punch, so IN later than OUT means the person came back in
+    if str(rec.get("Leave", "")).lower() == "yes":
+        return "Leave"
+    t_in, t_out = rec.get("IN", ""), rec.get("OUT", "")
+    if not t_in or (t_out and t_out >= t_in):
+        return "Out"
+    return "WFH" if str(rec.get("WFH", "")).lower() == "yes" else "In Office"
+
+
+def today_status(rec):
+    if not rec or not (rec.get("IN") or rec.get("OUT") or str(rec.get("Leave", "")).lower() == "yes"):
+        return NOT_MARKED
+    return person_status(rec)
+
+
+def status_line(rec):
+    status = today_status(rec)
+    offices = split_list((rec or {}).get("Office"))
+    if status == "In Office":
+        return f"In office{' at ' + offices[-1] if offices else ''} since {rec['IN']}"
+    if status == "WFH":
+        return f"Working from home since {rec['IN']}"
+    if status == "Out":
+        return f"Out since {rec['OUT']}" if rec.get("OUT") else "Out"
+    if status == "Leave":
+        return "On leave today"
+    return "Not marked yet today"
+
+
+class FeedFollower:
+    # Replays attendance entries of the change feed after a cursor. Entries of this process were already
+    # applied from its events; applying them again is harmless, since each carries the resulting row or fields.
+    def __init__(self, storage, apply):
+        self.storage = storage
+        self.apply = apply
+        self.cursor = 0
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+
+    def skip_to_end(self):
+        # Before a full read from storage: everything after this point is replayed on top of it
+        self.cursor = self.storage.last_change_seq()
+
+    def poll(self):
+        now = time.monotonic()
+        if now < self._next_poll or not self._lock.acquire(blocking=False):
+            return  # polled recently, or another session is polling right now
+        try:
+            self._next_poll = now + FEED_POLL_SECONDS
+            for c in iter_changes(self.storage, self.cursor):
+                self.cursor = c["seq"]
+                if c["event"] in ("attendance_marked", "attendance_updated"):
+                    self.apply(c["event"], dict(c["data"], phone=c["phone"], date=c["date"]))
+        finally:
+            self._lock.release()
+
+
+class TodayStatusCache:
+    def __init__(self, storage, max_entries=10_000):
+        self.storage = storage
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()  # phone -> (day, today's row or None), least recently used first
+        self.feed = FeedFollower(storage, self.on_event)
+        self.feed.skip_to_end()
+
+    def _put(self, phone, day, row):
+        # Caller holds the lock
+        self._rows[phone] = (day, row)
+        self._rows.move_to_end(phone)
+        while len(self._rows) > self.max_entries:
+            self._rows.popitem(last=False)
+
+    def load(self, phone):
+        # The one storage read: at login, or when the cached entry is from yesterday
+        day = today_local()
+        row = self.storage.get_attendance_row(str(phone), day)
+        row = {k: "" if v is None else str(v) for k, v in row.items()} if row else None
+        with self._lock:
+            self._put(str(phone), day, row)
+        return row
+
+    def get(self, phone):
+        self.feed.poll()
+        with self._lock:
+            hit = self._rows.get(str(phone))
+            if hit is not None:
+                self._rows.move_to_end(str(phone))
+        if hit is None or hit[0] != today_local():
+            return self.load(phone)
+        return hit[1]
+
+    def on_event(self, event, payload):
+        day = today_local().isoformat()
+        if event == "storage_reloaded":
+            self.feed.skip_to_end()
+        with self._lock:
+            if event == "storage_reloaded":
+                self._rows.clear()
+                return
+            if event == "attendance_marked":
+                row = payload["row"]
+                if row.get("Date") == day:
+                    self._put(str(payload["phone"]), today_local(), dict(row))
+            elif event == "attendance_updated" and payload.get("date") == day:
+                hit = self._rows.get(str(payload["phone"]))
+                if hit is not None and hit[1] is not None:
+                    row = dict(hit[1])
+                    row.update({k: "" if v is None else str(v) for k, v in payload["updates"].items()})
+                    self._rows[str(payload["phone"])] = (hit[0], row)
+
+
+class OccupancyBoard:
+    def __init__(self, storage):
+        self.storage = storage
+        self._lock = threading.Lock()
+        self.day = None
+        self.people = {}  # phone -> today's row plus "CurrentOffice"
+        self.by_office = Counter()
+        self.by_department = Counter()
+        self.by_status = Counter()
+        self.updated_at = None
+        self.feed = FeedFollower(storage, self._apply)
+
+    # --- building ---
+    def rebuild(self):
+        self.feed.skip_to_end()
+        df = self.storage.get_attendance()
+        day = today_local()
+        with self._lock:
+            self.day = day
+            self.people = {}
+            self.by_office, self.by_department, self.by_status = Counter(), Counter(), Counter()
+            if not df.empty:
+                dates = pd.to_datetime(df["Date"], errors="coerce").dt.date
+                for rec in df[dates == day].to_dict("records"):
+                    rec = {k: "" if v is None else str(v) for k, v in rec.items()}
+                    offices = split_list(rec.get("Office"))
+                    rec["CurrentOffice"] = offices[-1] if offices else ""
+                    self._put(rec)
+            self.updated_at = datetime.now(LOCAL_TZ)
+
+    def _ensure_today(self):
+        if self.day != today_local():
+            self.rebuild()
+
+    # --- incremental updates (caller holds the lock) ---
+    def _contribution(self, rec, sign):
+        status = person_status(rec)
+        self.by_status[status] += sign
+        if status == "In Office":
+            self.by_office[rec.get("CurrentOffice") or "Unassigned"] += sign
+        if status in ("In Office", "WFH"):
+            for d in split_list(rec.get("Departments")) or ["Unassigned"]:
+                self.by_department[d] += sign
+
+    def _put(self, rec):
+        prev = self.people.get(rec["PhoneNumber"])
+        if prev is not None:
+            self._contribution(prev, -1)
+        self.people[rec["PhoneNumber"]] = rec
+        self._contribution(rec, +1)
+        for c in (self.by_office, self.by_department, self.by_status):
+            for k in [k for k, v in c.items() if v <= 0]:
+                del c[k]
+
+    def on_event(self, event, payload):
+        if event == "storage_reloaded":
+            self.rebuild()
+            return
+        self._apply(event, payload)
+
+    def _apply(self, event, payload):
+        if event not in ("attendance_marked", "attendance_updated"):
+            return
+        self._ensure_today()
+        with self._lock:
+            if event == "attendance_marked":
+                row = dict(payload["row"])
+                if row.get("Date") != self.day.isoformat():
+                    return
+                prev = self.people.get(row["PhoneNumber"], {})
+                office = payload.get("office")
+                if payload.get("action") in ("IN", "OUT") and office and office != "-":
+                    row["CurrentOffice"] = office
+                else:
+                    row["CurrentOffice"] = prev.get("CurrentOffice", "")
+            else:
+                if payload.get("date") != self.day.isoformat() or payload["phone"] not in self.people:
+                    return
+                row = dict(self.people[payload["phone"]])
+                row.update({k: "" if v is None else str(v) for k, v in payload["updates"].items()})
+                if "Office" in payload["updates"]:
+                    offices = split_list(row["Office"])
+                    row["CurrentOffice"] = offices[-1] if offices else ""
+            self._put(row)
+            self.updated_at = datetime.now(LOCAL_TZ)
+
+    # --- reading ---
+    def snapshot(self):
+        self._ensure_today()
+        self.feed.poll()
+        with self._lock:
+            return {
+                "day": self.day,
+                "updated_at": self.updated_at,
+                "by_office": dict(self.by_office),
+                "by_department": dict(self.by_department),
+                "by_status": {s: self.by_status.get(s, 0) for s in STATUSES},
+                "present": [dict(r) for r in self.people.values() if person_status(r) in ("In Office", "WFH")],
+            }
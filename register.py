@@ -0,0 +1,147 @@
+# register.py
+#
+# Monthly muster roll: one row per employee, one column per day, coded
+# P (present at an office), WFH, L (leave) or A (absent); days still to come
+# are left blank. A month of attendance is coded column-wise and pivoted with
+# unstack, then names and departments are joined from users.
+#
+# RegisterCache keeps each month's register until a storage event touches that
+# month (or a user changes, or a restore or maintenance run rewrites attendance). The current month also expires after
+# REGISTER_MAX_AGE_SECONDS, since the API process may write to it too.
+#
+#     python register.py 2026-09 --out muster_2026-09.xlsx
+
+import threading
+import time
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+
+from analytics import month_bounds, month_key
+from reports import HEADER_FILL, HEADER_FONT, TITLE_FONT, workbook_bytes
+
+REGISTER_CODES = np.array(["A", "P", "WFH", "L"])  # index = precedence when a day has several rows
+REGISTER_MAX_AGE_SECONDS = 60
+ID_COLUMNS = ["Name", "PhoneNumber", "Departments"]
+TOTAL_COLUMNS = ["P", "WFH", "L", "A"]
+
+
+def day_codes(df):
+    # One precedence code per attendance row: leave beats WFH beats an office punch
+    leave = df["Leave"].eq("Yes").to_numpy()
+    wfh = df["WFH"].eq("Yes").to_numpy()
+    present = (df["IN"].ne("") | df["OUT"].ne("")).to_numpy()
+    return np.select([leave, wfh, present], [3, 2, 1], default=0)
+
+
+def build_register(attendance, users, month, today=None):
+    # -> DataFrame: Name, PhoneNumber, Departments, "01".."31", P, WFH, L, A
+    start, end = month_bounds(month)
+    days = pd.date_range(start, end).strftime("%d").tolist()
+    today = today or datetime.now(ZoneInfo("Asia/Kolkata")).date()
+    elapsed = sum(date.fromisoformat(f"{month}-{d}") <= today for d in days)
+
+    att = attendance.reindex(columns=["Date", "IN", "OUT", "WFH", "Leave", *ID_COLUMNS]).fillna("").astype(str)
+    att = att[att["PhoneNumber"] != ""]
+    codes = pd.Series(day_codes(att), index=pd.MultiIndex.from_arrays([att["PhoneNumber"], att["Date"].str[8:10]]))
+    grid = codes.groupby(level=[0, 1]).max().unstack(fill_value=0)
+
+    people = users.reindex(columns=ID_COLUMNS).fillna("").astype(str).drop_duplicates("PhoneNumber", keep="last")
+    # People who punched but are no longer in users keep the name from their attendance rows
+    gone = att.drop_duplicates("PhoneNumber", keep="last").loc[lambda d: ~d["PhoneNumber"].isin(people["PhoneNumber"]), ID_COLUMNS]
+    people = pd.concat([people, gone], ignore_index=True).sort_values(["Name", "PhoneNumber"], kind="stable")
+
+    grid = grid.reindex(index=people["PhoneNumber"], columns=days, fill_value=0).to_numpy()
+    labels = REGISTER_CODES[grid].astype(object)
+    labels[:, elapsed:] = ""
+    past = grid[:, :elapsed]
+    totals = np.stack([(past == REGISTER_CODES.tolist().index(c)).sum(axis=1) for c in TOTAL_COLUMNS], axis=1)
+    return pd.concat([people.reset_index(drop=True),
+                      pd.DataFrame(labels, columns=days),
+                      pd.DataFrame(totals, columns=TOTAL_COLUMNS)], axis=1)
+
+
+def register_xlsx(register, month):
+    # Write-only workbook: rows are streamed, never held as a cell grid
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(f"Muster {month}")
+    ws.freeze_panes = "D3"
+    ws.column_dimensions["A"].width = 24
+    ws.column_dimensions["B"].width = 14
+    ws.column_dimensions["C"].width = 18
+    title = WriteOnlyCell(ws, value=f"Attendance register - {month}")
+    title.font = TITLE_FONT
+    ws.append([title])
+    header = []
+    for name in register.columns:
+        c = WriteOnlyCell(ws, value=name)
+        c.font, c.fill = HEADER_FONT, HEADER_FILL
+        header.append(c)
+    ws.append(header)
+    for row in register.astype(object).values.tolist():  # object dtype -> plain Python ints for the totals
+        ws.append(row)
+    return workbook_bytes(wb)
+
+
+class RegisterCache:
+    def __init__(self, storage):
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._months = {}  # month -> {"at": built_at, "register": DataFrame, "xlsx": bytes or None}
+        self._version = 0  # bumped on every invalidation, so a build that raced one is not kept
+
+    def on_event(self, event, payload):
+        if event not in ("attendance_marked", "attendance_updated", "user_added", "user_updated", "storage_reloaded"):
+            return
+        with self._lock:
+            self._version += 1
+            if event == "attendance_marked":
+                self._months.pop(month_key(payload["row"]["Date"]), None)
+            elif event == "attendance_updated":
+                self._months.pop(month_key(payload["date"]), None)
+            else:  # users changed, or a restore/maintenance rewrote attendance
+                self._months.clear()
+
+    def _entry(self, month):
+        current = month == month_key(datetime.now(ZoneInfo("Asia/Kolkata")).date().isoformat())
+        with self._lock:
+            hit, version = self._months.get(month), self._version
+        if hit and not (current and time.monotonic() - hit["at"] > REGISTER_MAX_AGE_SECONDS):
+            return hit
+        start, end = month_bounds(month)
+        entry = {"at": time.monotonic(), "xlsx": None,
+                 "register": build_register(self.storage.get_attendance_between(start, end), self.storage.get_users(), month)}
+        with self._lock:
+            if version == self._version:
+                self._months[month] = entry
+        return entry
+
+    def get(self, month):
+        return self._entry(month)["register"]
+
+    def xlsx(self, month):
+        # The export is built once per cached register
+        entry = self._entry(month)
+        if entry["xlsx"] is None:
+            entry["xlsx"] = register_xlsx(entry["register"], month)
+        return entry["xlsx"]
+
+
+if __name__ == "__main__":
+    import argparse
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Build the monthly muster register")
+    ap.add_argument("month", help="YYYY-MM")
+    ap.add_argument("--out")
+    args = ap.parse_args()
+    s = make_storage()
+    s.init()
+    out = args.out or f"muster_{args.month}.xlsx"
+    with open(out, "wb") as f:
+        f.write(RegisterCache(s).xlsx(args.month))
+    print(f"wrote {out}")
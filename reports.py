@@ -0,0 +1,261 @@
+# reports.py
+#
+# Monthly management report: one formatted sheet per department group, with a
+# per-employee summary above the daily rows. Attendance is partitioned by
+# Departments, and each part is built and serialized in a process-pool worker
+# using openpyxl write-only mode. The parts are delivered as a zip of
+# per-department workbooks, or merged into one workbook by copying each
+# finished sheet's XML, so the parent never re-writes a cell.
+#
+# ReportRunner builds on a background thread, so admin sessions keep
+# responding and can poll its progress.
+#
+#     python reports.py 2026-09 --format zip --out september.zip
+
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+
+from analytics import month_bounds
+from storage import report_error
+
+REPORT_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+REPORT_FORMATS = ["xlsx", "zip"]
+MAX_JOBS = 10  # finished reports kept in memory for download
+NO_DEPARTMENT = "Unassigned"
+DETAIL_COLUMNS = ["Date", "Name", "PhoneNumber", "IN", "OUT", "Hours", "WFH", "Leave", "Office"]
+SUMMARY_COLUMNS = ["Name", "PhoneNumber", "DaysInOffice", "WFHDays", "LeaveDays", "TotalHours", "AvgHours"]
+OVERVIEW_COLUMNS = ["Department", "People", "DaysInOffice", "WFHDays", "LeaveDays", "TotalHours"]
+COLUMN_WIDTHS = [12, 24, 14, 10, 10, 8, 6, 6, 18]
+
+TITLE_FONT = Font(bold=True, size=14)
+SECTION_FONT = Font(bold=True, size=12)
+HEADER_FONT = Font(bold=True, color="FFFFFF")
+HEADER_FILL = PatternFill("solid", fgColor="305496")
+
+
+# ---------------------------
+# Data (runs in the workers)
+# ---------------------------
+def partition_by_department(df):
+    # A person in "HR,Ops" appears in both HR's and Ops' sheets
+    if df.empty:
+        return {}
+    x = df.assign(Department=df["Departments"].astype(str).str.split(",")).explode("Department")
+    x["Department"] = x["Department"].str.strip().replace("", NO_DEPARTMENT)
+    return {d: g.drop(columns="Department") for d, g in x.groupby("Department", sort=True)}
+
+
+def department_tables(df):
+    df = df.fillna("").sort_values(["Date", "Name"])
+    tin = pd.to_timedelta(df["IN"].where(df["IN"] != ""), errors="coerce")
+    tout = pd.to_timedelta(df["OUT"].where(df["OUT"] != ""), errors="coerce")
+    hours = ((tout - tin).dt.total_seconds() / 3600).round(2)
+    detail = df.assign(Hours=hours.where(hours > 0))[DETAIL_COLUMNS]
+    present, wfh = df["IN"] != "", df["WFH"] == "Yes"
+    summary = detail.assign(office=present & ~wfh, wfh=present & wfh, leave=df["Leave"] == "Yes")\
+        .groupby("PhoneNumber", sort=False)\
+        .agg(Name=("Name", "last"), DaysInOffice=("office", "sum"), WFHDays=("wfh", "sum"), LeaveDays=("leave", "sum"),
+             TotalHours=("Hours", "sum"), AvgHours=("Hours", "mean"))\
+        .reset_index().round(2).sort_values("Name")[SUMMARY_COLUMNS]
+    return detail, summary
+
+
+def _rows(df):
+    # NaN -> empty cell
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+
+def build_department(dept, df, month):
+    # Worker entry point: -> (dept, overview totals, single-sheet workbook bytes)
+    detail, summary = department_tables(df)
+    totals = [dept, len(summary), *summary[["DaysInOffice", "WFHDays", "LeaveDays"]].sum().tolist(),
+              round(float(summary["TotalHours"].sum()), 2)]
+    wb = Workbook(write_only=True)
+    write_department_sheet(wb, sheet_title(dept, set()), dept, month, _rows(detail), _rows(summary))
+    return dept, totals, workbook_bytes(wb)
+
+
+# ---------------------------
+# Workbook writing (write-only: rows are streamed, never held as a cell grid)
+# Every sheet uses TITLE, SECTION, HEADER styles in that order, so all parts
+# get identical styles.xml and their sheet XML can be merged as-is.
+# ---------------------------
+def sheet_title(name, used):
+    # Excel sheet names: max 31 chars, no []:*?/\ , unique case-insensitively
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(name)).strip()[:31] or NO_DEPARTMENT
+    title, n = base, 1
+    while title.lower() in used:
+        n += 1
+        title = f"{base[:31 - len(str(n)) - 1]}~{n}"
+    used.add(title.lower())
+    return title
+
+
+def _styled(ws, values, font, fill=None):
+    cells = []
+    for v in values:
+        c = WriteOnlyCell(ws, value=v)
+        c.font = font
+        if fill is not None:
+            c.fill = fill
+        cells.append(c)
+    return cells
+
+
+def write_department_sheet(wb, title, dept, month, detail_rows, summary_rows):
+    ws = wb.create_sheet(title)
+    for i, w in enumerate(COLUMN_WIDTHS):
+        ws.column_dimensions[chr(ord("A") + i)].width = w
+    ws.append(_styled(ws, [f"{dept} - {month}"], TITLE_FONT))
+    ws.append([])
+    ws.append(_styled(ws, ["Employee summary"], SECTION_FONT))
+    ws.append(_styled(ws, SUMMARY_COLUMNS, HEADER_FONT, HEADER_FILL))
+    for r in summary_rows:
+        ws.append(r)
+    ws.append([])
+    ws.append(_styled(ws, ["Daily attendance"], SECTION_FONT))
+    ws.append(_styled(ws, DETAIL_COLUMNS, HEADER_FONT, HEADER_FILL))
+    for r in detail_rows:
+        ws.append(r)
+
+
+def write_overview_sheet(wb, month, totals):
+    ws = wb.create_sheet("Overview")
+    ws.column_dimensions["A"].width = 24
+    ws.append(_styled(ws, [f"Attendance report - {month}"], TITLE_FONT))
+    ws.append([f"Generated {datetime.now():%Y-%m-%d %H:%M}"])
+    ws.append([])
+    ws.append(_styled(ws, ["Departments"], SECTION_FONT))
+    ws.append(_styled(ws, OVERVIEW_COLUMNS, HEADER_FONT, HEADER_FILL))
+    for t in totals:
+        ws.append(t)
+
+
+def workbook_bytes(wb):
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def merge_workbooks(parts):
+    # parts: [(sheet title, single-sheet workbook bytes)] -> one workbook. openpyxl writes an empty
+    # skeleton with the right sheet names, rels and content types; the sheet XML is then swapped in.
+    skeleton = Workbook(write_only=True)
+    for title, _ in parts:
+        skeleton.create_sheet(title)
+    sheets, styles = {}, None
+    for i, (title, data) in enumerate(parts, 1):
+        with zipfile.ZipFile(BytesIO(data)) as part:
+            if styles is None:
+                styles = part.read("xl/styles.xml")
+            elif part.read("xl/styles.xml") != styles:
+                raise ValueError(f"Sheet '{title}' was written with a different style sequence")
+            sheets[f"xl/worksheets/sheet{i}.xml"] = part.read("xl/worksheets/sheet1.xml")
+    out = BytesIO()
+    with zipfile.ZipFile(BytesIO(workbook_bytes(skeleton))) as base, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name in base.namelist():
+            data = sheets.get(name) or (styles if name == "xl/styles.xml" else base.read(name))
+            zf.writestr(name, data)
+    return out.getvalue()
+
+
+# ---------------------------
+# Report generation
+# ---------------------------
+def generate_report(storage, month, fmt="xlsx", workers=REPORT_WORKERS, progress=None):
+    # -> (filename, bytes); progress(done, total) is called as departments finish
+    start, end = month_bounds(month)
+    parts = partition_by_department(storage.get_attendance_between(start, end))
+    progress = progress or (lambda done, total: None)
+    progress(0, len(parts))
+    results = {}
+    if workers <= 1 or len(parts) <= 1:
+        for i, (dept, df) in enumerate(parts.items(), 1):
+            results[dept] = build_department(dept, df, month)[1:]
+            progress(i, len(parts))
+    else:
+        # spawn, not fork: the Streamlit server is multi-threaded
+        with ProcessPoolExecutor(min(workers, len(parts)), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(build_department, dept, df, month) for dept, df in parts.items()]
+            for i, f in enumerate(as_completed(futures), 1):
+                dept, totals, data = f.result()
+                results[dept] = (totals, data)
+                progress(i, len(parts))
+
+    depts = sorted(results)
+    overview = Workbook(write_only=True)
+    write_overview_sheet(overview, month, [results[d][0] for d in depts])
+    used = {"overview"}
+    parts = [("Overview", workbook_bytes(overview))] + [(sheet_title(d, used), results[d][1]) for d in depts]
+    if fmt == "zip":
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for title, data in parts:
+                zf.writestr(f"{title}.xlsx", data)
+        return f"attendance_report_{month}.zip", buf.getvalue()
+    return f"attendance_report_{month}.xlsx", merge_workbooks(parts)
+
+
+class ReportRunner:
+    def __init__(self, storage, workers=REPORT_WORKERS):
+        self.storage = storage
+        self.workers = workers
+        self._jobs = []  # newest first
+        self._lock = threading.Lock()
+
+    def start(self, month, fmt="xlsx", requested_by=""):
+        job = {"id": uuid.uuid4().hex[:8], "month": month, "format": fmt, "requested_by": requested_by,
+               "status": "running", "done": 0, "total": 0, "started_at": datetime.now(),
+               "filename": None, "data": None, "error": None}
+        with self._lock:
+            self._jobs.insert(0, job)
+            del self._jobs[MAX_JOBS:]
+        threading.Thread(target=self._run, args=(job,), name=f"report-{job['id']}", daemon=True).start()
+        return job["id"]
+
+    def _run(self, job):
+        try:
+            filename, data = generate_report(self.storage, job["month"], job["format"], self.workers,
+                                             progress=lambda done, total: job.update(done=done, total=total))
+            job.update(status="done", filename=filename, data=data)
+        except Exception as e:
+            job.update(status="failed", error=str(e))
+            report_error(f"Report {job['month']} failed: {e}")
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def running(self):
+        return any(j["status"] == "running" for j in self.jobs())
+
+
+if __name__ == "__main__":
+    import argparse
+    from storage import make_storage
+
+    ap = argparse.ArgumentParser(description="Build the monthly per-department attendance report")
+    ap.add_argument("month", help="YYYY-MM")
+    ap.add_argument("--format", choices=REPORT_FORMATS, default="xlsx")
+    ap.add_argument("--workers", type=int, default=REPORT_WORKERS)
+    ap.add_argument("--out")
+    args = ap.parse_args()
+    s = make_storage()
+    s.init()
+    name, data = generate_report(s, args.month, args.format, args.workers,
+                                 progress=lambda d, t: print(f"\r{d}/{t} departments", end="", flush=True))
+    with open(args.out or name, "wb") as f:
+        f.write(data)
+    print(f"\nwrote {args.out or name}")
@@ -0,0 +1,998 @@
+# storage.py
+#
+# Storage layer shared by the Streamlit app and the headless tools (API, CLI).
+# Nothing in here may call Streamlit directly; errors go through report_error().
+
+import os
+import sys
+import hashlib
+import json
+import uuid
+from datetime import datetime, date, timedelta
+import pandas as pd
+import openpyxl
+import sqlite3
+import threading
+from zoneinfo import ZoneInfo
+from idempotency import RecentPunches, run_deduplicated
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+ADMIN_PHONES = ["8080042473"]
+DEFAULT_DASHBOARD_PW = "32193"
+SEED_OFFICES = [
+    {"OfficeName": "CSMT", "Latitude": 18.94358359403972, "Longitude": 72.83826109487124, "RadiusMeters": 350},
+    {"OfficeName": "Thane", "Latitude": 19.236363706991003, "Longitude": 72.98719749815108, "RadiusMeters": 350},
+    {"OfficeName": "Nerul", "Latitude": 19.044282739911402, "Longitude": 73.01426940651511, "RadiusMeters": 350},
+]
+
+DATA_FILE = "attendance_system.xlsx"
+CHANGE_LOG_FILE = "changes.db"  # Excel backend's change feed; the SQL backends keep change_log in their own database
+ROW_LIMIT = 1_048_000
+MONTH_LIMIT = 10
+ACCESS_ROLES = ["Admin", "Manager"]
+ACCESS_GRANT_COLUMNS = ["PhoneNumber","Role","GrantedBy","GrantedAt"]
+ACCESS_VERSION_KEY = "access_grants_version"  # settings row every grant/revoke rewrites (see SqlStorage.access_roles)
+
+# SQLAlchemy backend ("sqlalchemy" in storage_mode.txt). Any SQLAlchemy URL works, e.g.
+# postgresql+psycopg://user:pw@db-host/attendance, so several app replicas can share one database.
+DATABASE_URL = os.environ.get("ATTENDANCE_DATABASE_URL", "sqlite:///attendance.db")
+DB_POOL_SIZE = int(os.environ.get("ATTENDANCE_DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("ATTENDANCE_DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE_SECONDS = 1800
+
+# ---------------------------
+# UTILITIES
+# ---------------------------
+# Where storage errors are surfaced: app.py points this at st.error, headless callers keep stderr
+_error_reporter = lambda msg: print(msg, file=sys.stderr)
+
+# Called after every successful workbook save (backup snapshots); same contract as storage events
+_save_listeners = []
+
+def on_workbook_saved(fn):
+    # -> a function that removes the listener again
+    _save_listeners.append(fn)
+    def unsubscribe():
+        if fn in _save_listeners:
+            _save_listeners.remove(fn)
+    return unsubscribe
+
+def set_error_reporter(fn):
+    global _error_reporter
+    _error_reporter = fn
+
+def report_error(msg):
+    _error_reporter(msg)
+
+def new_access_version():
+    # A fresh token rather than a counter: a restored database can never hand back a version a reader already holds
+    return uuid.uuid4().hex
+
+def hash_pw(pw: str) -> str:
+    return hashlib.sha256(str(pw).encode()).hexdigest()
+
+def parse_phone_list(text) -> list:
+    # Accepts comma, semicolon, whitespace or newline separated phone numbers; keeps first-seen order
+    seen = []
+    for p in str(text or "").replace(";", ",").replace("\n", ",").split(","):
+        for ph in p.split():
+            if ph not in seen: seen.append(ph)
+    return seen
+
+def emit_event(listeners, event, payload):
+    # Notify in-process subscribers (occupancy board, caches, ...); a failing listener never fails the write
+    for fn in list(listeners):
+        try:
+            fn(event, payload)
+        except Exception as e:
+            report_error(f"Listener error on '{event}': {e}")
+
+# ---------------------------
+# CHANGE FEED
+# Every mutation is also appended to change_log with a monotonically increasing Seq,
+# so payroll and other consumers can pull "changes since N" (see changefeed.py).
+# The SQL backends write the entry in the mutation's own transaction (log_changes), so
+# a commit never lacks its entry and Seq order is commit order. The workbook cannot
+# share a transaction with changes.db; Excel logs after a confirmed save (emit_changes).
+# ---------------------------
+CHANGE_EVENTS = ("attendance_marked", "attendance_updated", "edit_appended", "user_added", "user_updated",
+                 "geofence_override")
+CHANGE_COLUMNS = ["Seq", "At", "Event", "PhoneNumber", "Date", "Data"]
+CHANGE_LOG_DDL = """CREATE TABLE IF NOT EXISTS change_log (
+    Seq INTEGER PRIMARY KEY AUTOINCREMENT, At TEXT, Event TEXT, PhoneNumber TEXT, Date TEXT, Data TEXT)"""
+CHANGE_LOG_INSERT = "INSERT INTO change_log (At, Event, PhoneNumber, Date, Data) VALUES (?,?,?,?,?)"
+
+def change_row(event, payload):
+    # -> (At, Event, PhoneNumber, Date, Data JSON); password hashes never enter the feed
+    data = {k: v for k, v in payload.items() if k not in ("phone", "date")}
+    for key in ("user", "updates"):
+        if isinstance(data.get(key), dict) and "PasswordHash" in data[key]:
+            data[key] = {k: v for k, v in data[key].items() if k != "PasswordHash"}
+            if key == "updates":
+                data["password_changed"] = True
+    day = payload.get("date") or (payload.get("row") or {}).get("Date", "")
+    return (datetime.now(ZoneInfo("Asia/Kolkata")).isoformat(timespec="seconds"), event,
+            str(payload.get("phone", "")), str(day), json.dumps(data, default=str, separators=(",", ":")))
+
+def change_rows(event, payloads):
+    return [change_row(event, p) for p in payloads] if event in CHANGE_EVENTS else []
+
+def log_changes(con, event, payloads):
+    # Inside the caller's open sqlite3 transaction: SQLite's single writer lock makes Seq order the commit order
+    rows = change_rows(event, payloads)
+    if rows:
+        con.executemany(CHANGE_LOG_INSERT, rows)
+
+def append_change_rows(db_path, rows):
+    con = sqlite3.connect(db_path, timeout=30)
+    try:
+        with con:
+            con.executemany(CHANGE_LOG_INSERT, rows)
+    finally:
+        con.close()
+
+def read_change_rows(db_path, since, limit):
+    con = sqlite3.connect(db_path, timeout=30)
+    try:
+        cur = con.execute("SELECT Seq, At, Event, PhoneNumber, Date, Data FROM change_log WHERE Seq > ? ORDER BY Seq LIMIT ?",
+                          (int(since), int(limit)))
+        return [dict(zip(CHANGE_COLUMNS, r)) for r in cur.fetchall()]
+    finally:
+        con.close()
+
+def last_change_rows_seq(db_path):
+    con = sqlite3.connect(db_path, timeout=30)
+    try:
+        return con.execute("SELECT COALESCE(MAX(Seq), 0) FROM change_log").fetchone()[0]
+    finally:
+        con.close()
+
+def notify(store, event, payloads):
+    for p in payloads:
+        emit_event(store._listeners, event, p)
+
+def emit_changes(store, event, payloads):
+    # For writes already saved outside the feed's transaction (Excel) and for entries that record no
+    # mutation (geofence_override). Log first, then notify: a listener woken by an event already finds it in the feed
+    rows = change_rows(event, payloads)
+    if rows:
+        try:
+            store.append_changes(rows)
+        except Exception as e:
+            report_error(f"Change log write failed for '{event}': {e}")
+    notify(store, event, payloads)
+
+def migrate_legacy_whitelist(store):
+    # One-time move of the old comma-separated `whitelist` setting into access grants
+    legacy = parse_phone_list(store.get_setting("whitelist"))
+    if legacy:
+        store.grant_access(legacy, "Admin", "whitelist")
+        store.set_setting("whitelist", "")
+
+def init_workbook():
+    if os.path.exists(DATA_FILE): return
+    with pd.ExcelWriter(DATA_FILE, engine="openpyxl") as writer:
+        # Users
+        df_users = pd.DataFrame(columns=["PhoneNumber","Name","Departments","PasswordHash","Role"])
+        for i, ph in enumerate(ADMIN_PHONES):
+            df_users.loc[len(df_users)] = [ph, f"Admin{i+1}", "Management Team", hash_pw(DEFAULT_DASHBOARD_PW), "Admin"]
+        df_users.to_excel(writer, sheet_name="users", index=False)
+        # Attendance
+        pd.DataFrame(columns=["Date","Name","PhoneNumber","IN","OUT","WFH","Leave","Departments","Office"])\
+            .to_excel(writer, sheet_name="attendance_1", index=False)
+        # Offices
+        offs = pd.DataFrame(SEED_OFFICES)
+        offs.to_excel(writer, sheet_name="offices", index=False)
+        # Departments
+        pd.DataFrame({"DepartmentGroup":["Management Team",]}).to_excel(writer, sheet_name="departments", index=False)
+        # Settings
+        pd.DataFrame(columns=["Key","Value"]).to_excel(writer, sheet_name="settings", index=False)
+        # Access grants (admin dashboard access, keyed by phone)
+        now = datetime.now().isoformat()
+        pd.DataFrame([[ph, "Admin", "seed", now] for ph in ADMIN_PHONES], columns=ACCESS_GRANT_COLUMNS)\
+            .to_excel(writer, sheet_name="access_grants", index=False)
+        # Edit logs
+        pd.DataFrame(columns=["DateTime","EditedByPhone","EditedByName","TargetPhone","Date","Field","OldValue","NewValue","Reason"])\
+            .to_excel(writer, sheet_name="attendance_edits", index=False)
+
+def read_sheet(sheet):
+    try:
+        return pd.read_excel(DATA_FILE, sheet_name=sheet, engine="openpyxl", dtype=str).fillna("")
+    except Exception as e:
+        report_error(f"Error reading sheet '{sheet}': {e}")
+        # Return empty DataFrame if sheet doesn't exist
+        return pd.DataFrame()
+
+def write_sheet(sheet, df):
+    return write_sheets({sheet: df})
+
+def write_sheets(frames):
+    # Replaces several sheets with a single open/save of the workbook
+    try:
+        with pd.ExcelWriter(DATA_FILE, engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
+            for sheet, df in frames.items():
+                df.to_excel(writer, sheet_name=sheet, index=False)
+    except Exception as e:
+        report_error(f"Error writing to Excel: {e}")
+        return False
+    emit_event(_save_listeners, "workbook_saved", {"path": DATA_FILE, "sheets": list(frames)})
+    return True
+
+def attendance_sheets():
+    # attendance_1, attendance_2, ... oldest first; run_maintenance rotates a full sheet into an archive
+    book = openpyxl.load_workbook(DATA_FILE, read_only=True)  # only sheet names are needed
+    sheetnames = book.sheetnames
+    book.close()
+    # Only consider sheets with numeric suffix like attendance_1, attendance_2, ...
+    numeric_sheets = []
+    for s in sheetnames:
+        if s.startswith("attendance_"):
+            suffix = s.split("_")[-1]
+            if suffix.isdigit():
+                numeric_sheets.append((int(suffix), s))
+    numeric_sheets.sort(key=lambda t: t[0])
+    return [s for _, s in numeric_sheets]
+
+def get_latest_attendance_sheet():
+    sheets = attendance_sheets()
+    if not sheets:
+        # Fallback: create the first attendance sheet if missing
+        first = "attendance_1"
+        # Ensure the sheet is created if it doesn't exist
+        try:
+            pd.read_excel(DATA_FILE, sheet_name=first)
+        except Exception:
+            write_sheet(first, pd.DataFrame(columns=["Date","Name","PhoneNumber","IN","OUT","WFH","Leave","Departments","Office"]))
+        return first
+    return sheets[-1]
+
+def iso_dates(col):
+    # "2024-05-01" or "2024-05-01 00:00:00" (date cells read back as text) -> "2024-05-01"; a string slice, no parsing
+    return col.astype(str).str[:10]
+
+# ---------------------------
+# Storage Class
+# ---------------------------
+class ExcelStorage:
+    def __init__(self):
+        self._grants = None  # cached {phone: role}; reset on every grant/revoke
+        self._admin_phones = frozenset()
+        self._listeners = []
+        self._recent = RecentPunches()  # duplicate-punch filter shared by all sessions
+        self.lock = threading.RLock()  # serializes writes against run_maintenance() within the process
+
+    def subscribe(self, fn): self._listeners.append(fn)
+    def _emit(self, event, **payload): emit_changes(self, event, [payload])
+    def invalidate_caches(self): self._grants = None  # after the workbook was replaced (restore)
+
+    def init(self):
+        init_workbook()
+        book = openpyxl.load_workbook(DATA_FILE, read_only=True)
+        has_grants = "access_grants" in book.sheetnames
+        book.close()
+        if not has_grants:
+            write_sheet("access_grants", pd.DataFrame(columns=ACCESS_GRANT_COLUMNS))
+        con = sqlite3.connect(CHANGE_LOG_FILE); con.execute(CHANGE_LOG_DDL); con.close()
+        migrate_legacy_whitelist(self)
+    def get_user(self, phone):
+        df=read_sheet("users"); r=df[df["PhoneNumber"]==str(phone)]
+        return None if r.empty else r.iloc[0].to_dict()
+    def add_user(self,u):
+        df=read_sheet("users"); df=pd.concat([df,pd.DataFrame([u])],ignore_index=True)
+        if not write_sheet("users",df): return False
+        self._emit("user_added", phone=str(u.get("PhoneNumber")), user=dict(u)); return True
+    def update_user(self,phone,updates):
+        df=read_sheet("users")
+        if str(phone) not in df["PhoneNumber"].values: return False
+        for k,v in updates.items():
+            if k not in df.columns: df[k]=""
+            df.loc[df["PhoneNumber"]==str(phone),k]=v
+        if not write_sheet("users",df): return False
+        self._emit("user_updated", phone=str(phone), updates=dict(updates)); return True
+    def check_password(self,phone,pw): u=self.get_user(phone); return u and u["PasswordHash"]==hash_pw(pw)
+    def get_users(self): return read_sheet("users")
+    def import_records(self, users=(), departments=(), offices=()):
+        # Bulk import: every sheet is patched in memory and saved together
+        frames = {}
+        with self.lock:
+            if users:
+                frames["users"] = pd.concat([read_sheet("users"), pd.DataFrame(list(users))], ignore_index=True)
+            if departments:
+                df = self.get_departments()
+                frames["departments"] = pd.concat([df, pd.DataFrame(list(departments))], ignore_index=True).drop_duplicates("DepartmentGroup")
+            if offices:
+                df = self.get_offices()
+                frames["offices"] = pd.concat([df, pd.DataFrame(list(offices))], ignore_index=True).drop_duplicates("OfficeName", keep="last")
+            ok = write_sheets(frames) if frames else True
+        if ok:
+            emit_changes(self, "user_added", [dict(phone=str(u["PhoneNumber"]), user=dict(u)) for u in users])
+        return ok
+
+    def mark_attendance(self, phone, name, deps, action, office=None, idempotency_key=None):
+        return self.mark_attendance_batch([{"phone": phone, "name": name, "deps": deps, "action": action, "office": office, "idempotency_key": idempotency_key}])[0]
+
+    def mark_attendance_batch(self, punches):
+        # Duplicates (same punch this minute, or a repeated idempotency key) never reach the sheet/DB
+        return run_deduplicated(self._recent, punches, self._write_punches)
+
+    def _write_punches(self, punches):
+        # Applies every punch to one in-memory copy of the sheet: one read and one write per batch
+        with self.lock:
+            return self._write_punches_locked(punches)
+
+    def _write_punches_locked(self, punches):
+        try:
+            sheet = get_latest_attendance_sheet()
+            df = read_sheet(sheet)
+            # Retention/rotation live in run_maintenance(); a punch only reads, patches and writes
+            df["Date"] = iso_dates(df["Date"])
+            LOCAL_TZ = ZoneInfo("Asia/Kolkata")
+            now_local = datetime.now(LOCAL_TZ)
+            day = now_local.date()
+            nowt = now_local.strftime("%H:%M:%S")
+
+            results, events = [], []
+            for p in punches:
+                action = str(p.get("action")).strip().upper()
+                df, idx, err = self._apply_punch(df, str(p.get("phone")), p.get("name"), p.get("deps"), action, p.get("office"), day, nowt)
+                if err:
+                    results.append((False, err)); continue
+                row = {k: str(v) for k, v in df.loc[idx].items()}
+                row["Date"] = day.isoformat()
+                events.append(dict(phone=str(p.get("phone")), action=action, office=p.get("office"), row=row))
+                results.append((True, "Recorded"))
+
+            if events and not write_sheet(sheet, df):
+                # Nothing was saved: failed results release the idempotency keys, so a retry is written
+                return [(False, "Could not save attendance")] * len(punches)
+            emit_changes(self, "attendance_marked", events)
+            return results
+
+        except Exception as e:
+            report_error(f"Error in mark_attendance: {e}")
+            return [(False, f"Error: {e}")] * len(punches)
+
+    def _apply_punch(self, df, phone, name, deps, action, office, day, nowt):
+        if action not in ("IN", "OUT", "WFH IN", "WFH OUT", "LEAVE"):
+            return df, None, f"Invalid action: {action}"
+
+        idxs = df[(df["PhoneNumber"] == phone) & (df["Date"] == day.isoformat())].index
+
+        if len(idxs):
+            idx = idxs[0]
+        else:
+            new = {
+                "Date": day.isoformat(),
+                "Name": name,
+                "PhoneNumber": phone,
+                "Departments": deps,
+                "IN": "",
+                "OUT": "",
+                "WFH": "No",
+                "Leave": "No",
+                "Office": ""
+            }
+            df = pd.concat([df, pd.DataFrame([new])], ignore_index=True)
+            idx = df.index[-1]
+
+        # --- Office Handling ---
+        prev_office = str(df.at[idx, "Office"]).strip()
+        offices = [o.strip() for o in prev_office.split(",") if o.strip()] if prev_office else []
+
+        if office and office != "-":
+            if office not in offices:
+                offices.append(office)
+            df.at[idx, "Office"] = ",".join(offices)
+
+        # --- Independent Actions ---
+        if action == "IN":
+            df.at[idx, "IN"] = nowt   # ✅ Updates only IN
+            if df.at[idx, "WFH"] == "":
+                df.at[idx, "WFH"] = "No"
+            if df.at[idx, "Leave"] == "":
+                df.at[idx, "Leave"] = "No"
+
+        elif action == "OUT":
+            df.at[idx, "OUT"] = nowt  # ✅ Updates only OUT
+            if df.at[idx, "WFH"] == "":
+                df.at[idx, "WFH"] = "No"
+            if df.at[idx, "Leave"] == "":
+                df.at[idx, "Leave"] = "No"
+
+        elif action == "WFH IN":
+            df.at[idx, "IN"] = nowt
+            df.at[idx, "WFH"] = "Yes"
+
+        elif action == "WFH OUT":
+            df.at[idx, "OUT"] = nowt
+            df.at[idx, "WFH"] = "Yes"
+
+        elif action == "LEAVE":
+            df.at[idx, "Leave"] = "Yes"
+
+        # Fill defaults if missing
+        if not df.at[idx, "WFH"]:
+            df.at[idx, "WFH"] = "No"
+        if not df.at[idx, "Leave"]:
+            df.at[idx, "Leave"] = "No"
+        return df, idx, None
+
+    def get_attendance_row(self, phone, day=None):
+        day = day or datetime.now(ZoneInfo("Asia/Kolkata")).date()
+        df = read_sheet(get_latest_attendance_sheet())
+        if df.empty: return None
+        r = df[(df["PhoneNumber"] == str(phone)) & (iso_dates(df["Date"]) == day.isoformat())]
+        if r.empty: return None
+        row = r.iloc[0].to_dict(); row["Date"] = day.isoformat()
+        return row
+
+    def get_attendance(self):
+        # Every sheet, archives from rotation included, like the SQL backends' whole table
+        frames = [read_sheet(s) for s in attendance_sheets() or [get_latest_attendance_sheet()]]
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    def get_attendance_between(self, start, end):
+        # Inclusive ISO date range over all sheets; the workbook has to be read whole, the SQL backends use the Date key
+        df = self.get_attendance()
+        if df.empty: return df
+        df["Date"] = iso_dates(df["Date"])
+        return df[(df["Date"] >= str(start)) & (df["Date"] <= str(end))].reset_index(drop=True)
+
+    def run_maintenance(self):
+        # Retention, compaction and rotation of the latest attendance sheet; scheduled off-peak, never per punch
+        with self.lock:
+            sheet = get_latest_attendance_sheet()
+            df = read_sheet(sheet)
+            report = {"backend": "excel", "sheet": sheet, "rows_before": len(df), "rows_expired": 0,
+                      "duplicates_removed": 0, "rotated_to": None}
+            if df.empty:
+                report["rows_after"] = 0
+                return report
+            df["Date"] = iso_dates(df["Date"])
+            cutoff = (date.today() - timedelta(days=MONTH_LIMIT*30)).isoformat()
+            keep = df["Date"] >= cutoff
+            report["rows_expired"] = int((~keep).sum())
+            df = df[keep]
+            deduped = df.drop_duplicates(["Date", "PhoneNumber"], keep="last")
+            report["duplicates_removed"] = len(df) - len(deduped)
+            df = deduped.sort_values(["Date", "PhoneNumber"], kind="stable")
+            frames = {sheet: df}
+            if len(df) > ROW_LIMIT:
+                # The full sheet stays as an archive (readers span all sheets); new punches go to a fresh one,
+                # and today's rows move along so a day is never split across two sheets
+                new_sheet = f"attendance_{int(sheet.split('_')[1])+1}"
+                moving = df["Date"] >= datetime.now(ZoneInfo("Asia/Kolkata")).date().isoformat()
+                frames = {sheet: df[~moving], new_sheet: df[moving]}
+                report["rotated_to"] = new_sheet
+            saved = write_sheets(frames)
+            report["rows_after"] = len(df)
+        if saved and (report["rows_expired"] or report["duplicates_removed"] or report["rotated_to"]):
+            # Rows went away (or moved to an archive sheet) without per-row events: caches built on attendance start over
+            notify(self, "storage_reloaded", [{"reason": "maintenance"}])
+        return report
+    def get_offices(self): return read_sheet("offices")
+    def add_office(self,n,lat,lon,r): df=self.get_offices(); df.loc[len(df)]=[n,lat,lon,r]; write_sheet("offices",df)
+    def delete_office(self,n): df=self.get_offices(); df=df[df["OfficeName"]!=n]; write_sheet("offices",df)
+    def get_departments(self): return read_sheet("departments")
+    def add_department(self,g): df=self.get_departments(); df.loc[len(df)]=[g]; write_sheet("departments",df)
+    def delete_department(self,g): df=self.get_departments(); df=df[df["DepartmentGroup"]!=g]; write_sheet("departments",df)
+    def get_setting(self,key): df=read_sheet("settings"); r=df[df["Key"]==key]; return "" if r.empty else str(r.iloc[0]["Value"])
+    def set_setting(self,key,val):
+        df = read_sheet("settings")
+        if key in df["Key"].values:
+            df.loc[df["Key"]==key, "Value"] = str(val)
+        else:
+            df = pd.concat([df, pd.DataFrame([{ "Key": key, "Value": str(val)}])], ignore_index=True)
+        write_sheet("settings", df)
+    def append_edit(self,e):
+        df=read_sheet("attendance_edits"); df=pd.concat([df,pd.DataFrame([e])],ignore_index=True)
+        if write_sheet("attendance_edits",df): self._emit("edit_appended", phone=str(e.get("TargetPhone")), date=e.get("Date"), edit=dict(e))
+    def get_edits(self): return read_sheet("attendance_edits")
+    def append_changes(self, rows): append_change_rows(CHANGE_LOG_FILE, rows)
+    def get_changes(self, since=0, limit=500): return read_change_rows(CHANGE_LOG_FILE, since, limit)
+    def last_change_seq(self): return last_change_rows_seq(CHANGE_LOG_FILE)
+
+    # Access grants
+    def get_access_grants(self):
+        df = read_sheet("access_grants")
+        return df if not df.empty else pd.DataFrame(columns=ACCESS_GRANT_COLUMNS)
+    def access_roles(self):
+        if self._grants is None:
+            df = self.get_access_grants()
+            self._grants = dict(zip(df["PhoneNumber"].astype(str), df["Role"].astype(str)))
+            self._admin_phones = frozenset(self._grants)
+        return self._grants
+    def admin_phones(self): self.access_roles(); return self._admin_phones
+    def has_access(self, phone, roles=None):
+        role = self.access_roles().get(str(phone).strip())
+        return role is not None and (roles is None or role in roles)
+    def grant_access(self, phones, role="Admin", granted_by=""):
+        phones = [str(p).strip() for p in phones if str(p).strip()]
+        if not phones: return 0
+        with self.lock:  # read-modify-write of the workbook, like punches and maintenance
+            df = self.get_access_grants()
+            df = df[~df["PhoneNumber"].astype(str).isin(phones)]
+            now = datetime.now().isoformat()
+            new = pd.DataFrame([[p, role, granted_by, now] for p in dict.fromkeys(phones)], columns=ACCESS_GRANT_COLUMNS)
+            write_sheet("access_grants", pd.concat([df, new], ignore_index=True))
+            self._grants = None
+        return len(new)
+    def revoke_access(self, phones):
+        phones = {str(p).strip() for p in phones}
+        with self.lock:
+            df = self.get_access_grants()
+            keep = ~df["PhoneNumber"].astype(str).isin(phones)
+            removed = int((~keep).sum())
+            if removed:
+                write_sheet("access_grants", df[keep])
+                self._grants = None
+        return removed
+
+    def update_attendance_fields(self, phone: str, date_str: str, updates: dict):
+        target_date = pd.to_datetime(date_str, errors="coerce").date() if not isinstance(date_str, date) else date_str
+        with self.lock:
+            # Newest sheet first: older days may sit in an archive sheet after rotation
+            for sheet in reversed(attendance_sheets() or [get_latest_attendance_sheet()]):
+                df = read_sheet(sheet)
+                if df.empty:
+                    continue
+                # Normalize Date to ISO text for comparison
+                df["Date"] = iso_dates(df["Date"])
+                mask = (df["PhoneNumber"].astype(str) == str(phone)) & (df["Date"] == (target_date.isoformat() if target_date else str(date_str)))
+                if mask.any():
+                    break
+            else:
+                return False
+            for k, v in updates.items():
+                if k not in df.columns:
+                    df[k] = ""
+                df.loc[mask, k] = v
+            if not write_sheet(sheet, df):
+                return False
+        self._emit("attendance_updated", phone=str(phone), date=target_date.isoformat() if target_date else str(date_str), updates=dict(updates))
+        return True
+
+class SqlStorage:
+    def __init__(self, db_path: str = "attendance.db", admin_phones=None):
+        self.db_path = db_path
+        self.seed_admins = list(ADMIN_PHONES if admin_phones is None else admin_phones)  # per-tenant shards bring their own
+        self._grants = None  # cached {phone: role}, valid while the stored access version is unchanged
+        self._grants_version = None
+        self._admin_phones = frozenset()
+        self._listeners = []
+        self._recent = RecentPunches()  # duplicate-punch filter shared by all sessions
+        self.lock = threading.RLock()  # serializes writes against run_maintenance() within the process
+
+    def subscribe(self, fn): self._listeners.append(fn)
+    def invalidate_caches(self): self._grants = None  # after the database was replaced (restore)
+
+    def init(self):
+        con = sqlite3.connect(self.db_path)
+        cur = con.cursor()
+        # Users
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+          PhoneNumber TEXT PRIMARY KEY,
+          Name TEXT,
+          Departments TEXT,
+          PasswordHash TEXT,
+          Role TEXT
+        )""")
+        # Attendance
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS attendance (
+          Date TEXT,
+          Name TEXT,
+          PhoneNumber TEXT,
+          IN_TIME TEXT,
+          OUT_TIME TEXT,
+          WFH TEXT,
+          Leave TEXT,
+          Departments TEXT,
+          Office TEXT,
+          PRIMARY KEY (Date, PhoneNumber)
+        )""")
+        # Offices
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS offices (
+          OfficeName TEXT PRIMARY KEY,
+          Latitude REAL,
+          Longitude REAL,
+          RadiusMeters REAL
+        )""")
+        # Departments
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS departments (
+          DepartmentGroup TEXT PRIMARY KEY
+        )""")
+        # Settings
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+          Key TEXT PRIMARY KEY,
+          Value TEXT
+        )""")
+        # Edit logs
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_edits (
+          DateTime TEXT,
+          EditedByPhone TEXT,
+          EditedByName TEXT,
+          TargetPhone TEXT,
+          Date TEXT,
+          Field TEXT,
+          OldValue TEXT,
+          NewValue TEXT,
+          Reason TEXT
+        )""")
+        # Access grants (admin dashboard access, keyed by phone)
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='access_grants'")
+        grants_existed = cur.fetchone() is not None
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS access_grants (
+          PhoneNumber TEXT PRIMARY KEY,
+          Role TEXT NOT NULL DEFAULT 'Admin',
+          GrantedBy TEXT,
+          GrantedAt TEXT
+        )""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_access_grants_role ON access_grants(Role)")
+        cur.execute(CHANGE_LOG_DDL)
+
+        # Seed admin phones in users and access grants
+        for i, ph in enumerate(self.seed_admins):
+            cur.execute("INSERT OR IGNORE INTO users (PhoneNumber, Name, Departments, PasswordHash, Role) VALUES (?,?,?,?,?)",
+                        (ph, f"Admin{i+1}", "Management Team", hash_pw(DEFAULT_DASHBOARD_PW), "Admin"))
+            if not grants_existed:
+                cur.execute("INSERT OR IGNORE INTO access_grants (PhoneNumber, Role, GrantedBy, GrantedAt) VALUES (?,?,?,?)",
+                            (ph, "Admin", "seed", datetime.now().isoformat()))
+        # Seed departments default
+        cur.execute("INSERT OR IGNORE INTO departments (DepartmentGroup) VALUES (?)", ("Management Team",))
+
+        con.commit(); con.close()
+        migrate_legacy_whitelist(self)
+
+    # User APIs
+    def get_user(self, phone):
+        con = sqlite3.connect(self.db_path)
+        cur = con.cursor()
+        cur.execute("SELECT PhoneNumber, Name, Departments, PasswordHash, Role FROM users WHERE PhoneNumber=?", (str(phone),))
+        row = cur.fetchone(); con.close()
+        if not row: return None
+        return {"PhoneNumber": row[0], "Name": row[1], "Departments": row[2], "PasswordHash": row[3], "Role": row[4]}
+
+    def add_user(self, u):
+        change = dict(phone=str(u.get("PhoneNumber")), user=dict(u))
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                con.execute("INSERT OR REPLACE INTO users (PhoneNumber, Name, Departments, PasswordHash, Role) VALUES (?,?,?,?,?)",
+                            (u.get("PhoneNumber"), u.get("Name"), u.get("Departments",""), u.get("PasswordHash",""), u.get("Role","User")))
+                log_changes(con, "user_added", [change])
+        finally:
+            con.close()
+        notify(self, "user_added", [change])
+        return True
+
+    def update_user(self, phone, updates):
+        con = sqlite3.connect(self.db_path)
+        cur = con.cursor()
+        # Build dynamic update
+        fields = []
+        values = []
+        for k in ["Name","Departments","PasswordHash","Role","PhoneNumber"]:
+            if k in updates:
+                fields.append(f"{ 'PhoneNumber' if k=='PhoneNumber' else k }=?")
+                values.append(updates[k])
+        if not fields:
+            con.close(); return True
+        values.append(str(phone))
+        change = dict(phone=str(phone), updates=dict(updates))
+        try:
+            with con:
+                cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE PhoneNumber=?", tuple(values))
+                changed = cur.rowcount
+                if changed > 0:
+                    log_changes(con, "user_updated", [change])
+        finally:
+            con.close()
+        if changed > 0:
+            notify(self, "user_updated", [change])
+        return changed > 0
+
+    def check_password(self, phone, pw):
+        u = self.get_user(phone)
+        return u and u.get("PasswordHash") == hash_pw(pw)
+
+    def get_users(self):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT PhoneNumber, Name, Departments, PasswordHash, Role FROM users", con)
+        con.close(); return df.fillna("")
+
+    def import_records(self, users=(), departments=(), offices=()):
+        # Bulk import in one transaction: a failing row (e.g. a phone registered meanwhile) rolls back everything
+        changes = [dict(phone=str(u["PhoneNumber"]), user=dict(u)) for u in users]
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                con.executemany("INSERT INTO users (PhoneNumber, Name, Departments, PasswordHash, Role) VALUES (?,?,?,?,?)",
+                                [(u["PhoneNumber"], u["Name"], u.get("Departments", ""), u.get("PasswordHash", ""), u.get("Role", "User")) for u in users])
+                con.executemany("INSERT OR IGNORE INTO departments (DepartmentGroup) VALUES (?)", [(d["DepartmentGroup"],) for d in departments])
+                con.executemany("INSERT OR REPLACE INTO offices (OfficeName, Latitude, Longitude, RadiusMeters) VALUES (?,?,?,?)",
+                                [(o["OfficeName"], o["Latitude"], o["Longitude"], o["RadiusMeters"]) for o in offices])
+                log_changes(con, "user_added", changes)
+        except sqlite3.Error as e:
+            report_error(f"Import failed, nothing was written: {e}")
+            return False
+        finally:
+            con.close()
+        notify(self, "user_added", changes)
+        return True
+
+    # Attendance APIs
+    def mark_attendance(self, phone, name, deps, action, office=None, idempotency_key=None):
+        return self.mark_attendance_batch([{"phone": phone, "name": name, "deps": deps, "action": action, "office": office, "idempotency_key": idempotency_key}])[0]
+
+    def mark_attendance_batch(self, punches):
+        # Duplicates (same punch this minute, or a repeated idempotency key) never reach the sheet/DB
+        return run_deduplicated(self._recent, punches, self._write_punches)
+
+    def _write_punches(self, punches):
+        # All punches share one connection and one transaction; nothing is kept if any statement fails
+        try:
+            LOCAL_TZ = ZoneInfo("Asia/Kolkata")
+            now_local = datetime.now(LOCAL_TZ)
+            today_str = now_local.date().isoformat()
+            nowt = now_local.strftime("%H:%M:%S")
+            results, events = [], []
+            with self.lock:
+                con = sqlite3.connect(self.db_path)
+                try:
+                    cur = con.cursor()
+                    for p in punches:
+                        action = str(p.get("action")).strip().upper()
+                        row, err = self._apply_punch(cur, str(p.get("phone")), p.get("name"), p.get("deps"), action, p.get("office"), today_str, nowt)
+                        if err:
+                            results.append((False, err)); continue
+                        events.append(dict(phone=str(p.get("phone")), action=action, office=p.get("office"), row=row))
+                        results.append((True, "Recorded"))
+                    log_changes(con, "attendance_marked", events)
+                    con.commit()
+                except Exception:
+                    con.rollback()
+                    raise
+                finally:
+                    con.close()
+            notify(self, "attendance_marked", events)
+            return results
+        except Exception as e:
+            report_error(f"Error in mark_attendance (SQL): {e}")
+            return [(False, f"Error: {e}")] * len(punches)
+
+    def _apply_punch(self, cur, phone, name, deps, action, office, today_str, nowt):
+        if action not in ("IN", "OUT", "WFH IN", "WFH OUT", "LEAVE"):
+            return None, f"Invalid action: {action}"
+        # Ensure row exists
+        cur.execute("SELECT Date, Name, PhoneNumber, IN_TIME, OUT_TIME, WFH, Leave, Departments, Office FROM attendance WHERE Date=? AND PhoneNumber=?",
+                    (today_str, phone))
+        row = cur.fetchone()
+        if not row:
+            cur.execute("INSERT INTO attendance (Date, Name, PhoneNumber, IN_TIME, OUT_TIME, WFH, Leave, Departments, Office) VALUES (?,?,?,?,?,?,?,?,?)",
+                        (today_str, name, phone, "", "", "No", "No", deps, ""))
+
+        # Office merge
+        if office and office != "-":
+            cur.execute("SELECT Office FROM attendance WHERE Date=? AND PhoneNumber=?", (today_str, phone))
+            prev = cur.fetchone()
+            current = prev[0] if prev and prev[0] else ""
+            parts = [p.strip() for p in current.split(',') if p and p.strip()]
+            if office not in parts:
+                parts.append(office)
+            new_off = ",".join(parts)
+            cur.execute("UPDATE attendance SET Office=? WHERE Date=? AND PhoneNumber=?", (new_off, today_str, phone))
+
+        # Actions
+        if action == "IN":
+            cur.execute("UPDATE attendance SET IN_TIME=?, WFH=COALESCE(NULLIF(WFH,''),'No'), Leave=COALESCE(NULLIF(Leave,''),'No') WHERE Date=? AND PhoneNumber=?",
+                        (nowt, today_str, phone))
+        elif action == "OUT":
+            cur.execute("UPDATE attendance SET OUT_TIME=?, WFH=COALESCE(NULLIF(WFH,''),'No'), Leave=COALESCE(NULLIF(Leave,''),'No') WHERE Date=? AND PhoneNumber=?",
+                        (nowt, today_str, phone))
+        elif action == "WFH IN":
+            cur.execute("UPDATE attendance SET IN_TIME=?, WFH='Yes' WHERE Date=? AND PhoneNumber=?",
+                        (nowt, today_str, phone))
+        elif action == "WFH OUT":
+            cur.execute("UPDATE attendance SET OUT_TIME=?, WFH='Yes' WHERE Date=? AND PhoneNumber=?",
+                        (nowt, today_str, phone))
+        elif action == "LEAVE":
+            cur.execute("UPDATE attendance SET Leave='Yes' WHERE Date=? AND PhoneNumber=?", (today_str, phone))
+
+        return self._attendance_row(cur, today_str, phone), None
+
+    def _attendance_row(self, cur, day_str, phone):
+        cur.execute("SELECT Date, Name, PhoneNumber, IN_TIME, OUT_TIME, WFH, Leave, Departments, Office FROM attendance WHERE Date=? AND PhoneNumber=?",
+                    (day_str, str(phone)))
+        r = cur.fetchone()
+        if not r: return None
+        return dict(zip(["Date","Name","PhoneNumber","IN","OUT","WFH","Leave","Departments","Office"], ["" if v is None else str(v) for v in r]))
+
+    def get_attendance_row(self, phone, day=None):
+        day = day or datetime.now(ZoneInfo("Asia/Kolkata")).date()
+        con = sqlite3.connect(self.db_path)
+        row = self._attendance_row(con.cursor(), day.isoformat(), phone)
+        con.close(); return row
+
+    def get_attendance(self):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT Date as Date, Name, PhoneNumber, IN_TIME as `IN`, OUT_TIME as `OUT`, WFH, Leave, Departments, Office FROM attendance", con)
+        con.close(); return df.fillna("")
+    def get_attendance_between(self, start, end):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT Date as Date, Name, PhoneNumber, IN_TIME as `IN`, OUT_TIME as `OUT`, WFH, Leave, Departments, Office FROM attendance "
+                               "WHERE Date BETWEEN ? AND ?", con, params=(str(start), str(end)))
+        con.close(); return df.fillna("")
+
+    # Offices / Departments / Settings / Edits
+    def get_offices(self):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT OfficeName, Latitude, Longitude, RadiusMeters FROM offices", con)
+        con.close(); return df.fillna("")
+    def add_office(self, n, lat, lon, r):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.execute("INSERT OR REPLACE INTO offices (OfficeName, Latitude, Longitude, RadiusMeters) VALUES (?,?,?,?)", (n, lat, lon, r))
+        con.commit(); con.close()
+    def delete_office(self, n):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.execute("DELETE FROM offices WHERE OfficeName=?", (n,))
+        con.commit(); con.close()
+
+    def get_departments(self):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT DepartmentGroup FROM departments", con)
+        con.close(); return df.fillna("")
+    def add_department(self, g):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.execute("INSERT OR IGNORE INTO departments (DepartmentGroup) VALUES (?)", (g,))
+        con.commit(); con.close()
+    def delete_department(self, g):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.execute("DELETE FROM departments WHERE DepartmentGroup=?", (g,))
+        con.commit(); con.close()
+
+    def get_setting(self, key):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.execute("SELECT Value FROM settings WHERE Key=?", (key,))
+        row = cur.fetchone(); con.close()
+        return "" if not row else str(row[0])
+    def set_setting(self, key, val):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.execute("INSERT INTO settings (Key, Value) VALUES (?, ?) ON CONFLICT(Key) DO UPDATE SET Value=excluded.Value", (key, str(val)))
+        con.commit(); con.close()
+
+    def append_edit(self, e):
+        change = dict(phone=str(e.get("TargetPhone")), date=e.get("Date"), edit=dict(e))
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                con.execute("INSERT INTO attendance_edits (DateTime, EditedByPhone, EditedByName, TargetPhone, Date, Field, OldValue, NewValue, Reason) VALUES (?,?,?,?,?,?,?,?,?)",
+                            (e.get("DateTime"), e.get("EditedByPhone"), e.get("EditedByName"), e.get("TargetPhone"), e.get("Date"), e.get("Field"), e.get("OldValue"), e.get("NewValue"), e.get("Reason")))
+                log_changes(con, "edit_appended", [change])
+        finally:
+            con.close()
+        notify(self, "edit_appended", [change])
+
+    def append_changes(self, rows): append_change_rows(self.db_path, rows)
+    def get_changes(self, since=0, limit=500): return read_change_rows(self.db_path, since, limit)
+    def last_change_seq(self): return last_change_rows_seq(self.db_path)
+
+    def get_edits(self):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT DateTime, EditedByPhone, EditedByName, TargetPhone, Date, Field, OldValue, NewValue, Reason FROM attendance_edits", con)
+        con.close(); return df.fillna("")
+
+    def update_attendance_fields(self, phone: str, date_str: str, updates: dict):
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        sets = []
+        vals = []
+        # Map keys to SQL columns
+        mapping = {"IN": "IN_TIME", "OUT": "OUT_TIME", "WFH": "WFH", "Leave": "Leave", "Office": "Office"}
+        for k, v in updates.items():
+            col = mapping.get(k, k)
+            sets.append(f"{col}=?")
+            vals.append(v)
+        if not sets:
+            con.close(); return True
+        vals.extend([date_str if isinstance(date_str, str) else date_str.isoformat(), str(phone)])
+        change = dict(phone=str(phone), date=vals[-2], updates=dict(updates))
+        try:
+            with con:
+                cur.execute(f"UPDATE attendance SET {', '.join(sets)} WHERE Date=? AND PhoneNumber=?", tuple(vals))
+                changed = cur.rowcount
+                if changed > 0:
+                    log_changes(con, "attendance_updated", [change])
+        finally:
+            con.close()
+        if changed > 0:
+            notify(self, "attendance_updated", [change])
+        return changed > 0
+
+    def run_maintenance(self):
+        # ANALYZE refreshes planner stats, VACUUM compacts free pages; scheduled off-peak
+        with self.lock:
+            con = sqlite3.connect(self.db_path, isolation_level=None)
+            size = lambda: con.execute("PRAGMA page_count").fetchone()[0] * con.execute("PRAGMA page_size").fetchone()[0]
+            report = {"backend": "sql", "db_path": self.db_path, "bytes_before": size(),
+                      "free_pages": con.execute("PRAGMA freelist_count").fetchone()[0]}
+            con.execute("ANALYZE")
+            con.execute("VACUUM")
+            con.execute("PRAGMA optimize")
+            report.update({"analyzed": True, "vacuumed": True, "bytes_after": size()})
+            con.close()
+            return report
+
+    # Access grants
+    def get_access_grants(self):
+        con = sqlite3.connect(self.db_path)
+        df = pd.read_sql_query("SELECT PhoneNumber, Role, GrantedBy, GrantedAt FROM access_grants ORDER BY Role, PhoneNumber", con)
+        con.close(); return df.fillna("")
+    def access_roles(self):
+        # Other processes grant and revoke too: one settings-row read per check decides whether the cache is current
+        con = sqlite3.connect(self.db_path)
+        try:
+            row = con.execute("SELECT Value FROM settings WHERE Key=?", (ACCESS_VERSION_KEY,)).fetchone()
+            version = row[0] if row else ""
+            if self._grants is None or version != self._grants_version:
+                self._grants = dict(con.execute("SELECT PhoneNumber, Role FROM access_grants").fetchall())
+                self._grants_version = version
+                self._admin_phones = frozenset(self._grants)
+        finally:
+            con.close()
+        return self._grants
+    def admin_phones(self): self.access_roles(); return self._admin_phones
+    def has_access(self, phone, roles=None):
+        role = self.access_roles().get(str(phone).strip())
+        return role is not None and (roles is None or role in roles)
+    def grant_access(self, phones, role="Admin", granted_by=""):
+        phones = list(dict.fromkeys(str(p).strip() for p in phones if str(p).strip()))
+        if not phones: return 0
+        now = datetime.now().isoformat()
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.executemany("INSERT INTO access_grants (PhoneNumber, Role, GrantedBy, GrantedAt) VALUES (?,?,?,?) "
+                        "ON CONFLICT(PhoneNumber) DO UPDATE SET Role=excluded.Role, GrantedBy=excluded.GrantedBy, GrantedAt=excluded.GrantedAt",
+                        [(p, role, granted_by, now) for p in phones])
+        self._bump_access_version(cur)
+        con.commit(); con.close()
+        self._grants = None
+        return len(phones)
+    def revoke_access(self, phones):
+        phones = [str(p).strip() for p in phones]
+        con = sqlite3.connect(self.db_path); cur = con.cursor()
+        cur.executemany("DELETE FROM access_grants WHERE PhoneNumber=?", [(p,) for p in phones])
+        removed = cur.rowcount
+        self._bump_access_version(cur)
+        con.commit(); con.close()
+        self._grants = None
+        return removed
+    def _bump_access_version(self, cur):
+        # Same transaction as the grant change: every process's next access_roles() reloads
+        cur.execute("INSERT INTO settings (Key, Value) VALUES (?, ?) ON CONFLICT(Key) DO UPDATE SET Value=excluded.Value",
+                    (ACCESS_VERSION_KEY, new_access_version()))
+
+def get_storage_mode():
+    try:
+        if os.path.exists("storage_mode.txt"):
+            with open("storage_mode.txt", "r", encoding="utf-8") as f:
+                mode = f.read().strip().lower()
+                if mode in ("sql", "sqlite", "db"):
+                    return "sql"
+                if mode in ("sqlalchemy", "alchemy", "server"):
+                    return "sqlalchemy"
+    except Exception:
+        pass
+    return "excel"
+
+def make_storage(mode=None):
+    mode = mode or get_storage_mode()
+    if mode == "sqlalchemy":
+        from alchemy_storage import AlchemyStorage  # optional dependency, only needed for this backend
+        return AlchemyStorage(DATABASE_URL)
+    return SqlStorage() if mode == "sql" else ExcelStorage()
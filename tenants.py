@@ -0,0 +1,328 @@
+# tenants.py
+#
+# Multi-tenant deployments: every organization gets its own storage shard, a
+# SQLite file under TENANT_SHARD_DIR by default, or any SQLAlchemy URL, so a
+# shard can live on another disk or database server. A small catalog
+# (tenants.db) records where each shard lives and which tenant every phone
+# number belongs to. Logins and API punches are routed by phone. Writers claim a
+# phone in the catalog before the shard stores it (PhoneClaims), so a number can
+# never belong to two organizations.
+#
+# ShardRouter keeps up to MAX_OPEN_SHARDS initialized shards in an LRU cache
+# and keeps the catalog's phone index current from each shard's user events.
+# Without a catalog file the app and API stay single-tenant.
+#
+# Shards use the SQL backends only: the Excel backend works on one workbook
+# per process (DATA_FILE), so it cannot hold several tenants side by side.
+#
+#     python tenants.py add acme "Acme Corp" --admin 9800000001
+#     python tenants.py add globex "Globex" --location "postgresql+psycopg://user:pw@db2/globex" --admin 9800000002
+#     python tenants.py list
+#     python tenants.py where 9800000001
+#     python tenants.py reindex acme     # re-read the shard's users into the phone index
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+from storage import SqlStorage, report_error
+
+TENANT_CATALOG = os.environ.get("ATTENDANCE_TENANT_CATALOG", "tenants.db")
+TENANT_SHARD_DIR = os.environ.get("ATTENDANCE_SHARD_DIR", "shards")
+MAX_OPEN_SHARDS = int(os.environ.get("ATTENDANCE_MAX_OPEN_SHARDS", "32"))
+PHONE_CACHE_TTL_SECONDS = 60  # other processes release and renumber phones; routes are re-read after this
+TENANT_ID_PATTERN = r"^[a-z0-9][a-z0-9_-]{1,31}$"
+
+
+def tenants_enabled(catalog_path=TENANT_CATALOG):
+    return os.path.exists(catalog_path)
+
+
+class TenantCatalog:
+    def __init__(self, path=TENANT_CATALOG):
+        self.path = path
+        self._phones = {}  # phone -> (tenant, expires); positive lookups only, misses always ask the catalog
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def init(self):
+        con = self._connect()
+        with con:
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS tenants (
+              TenantId TEXT PRIMARY KEY,
+              Name TEXT NOT NULL,
+              Location TEXT NOT NULL,
+              AdminPhones TEXT NOT NULL DEFAULT '',
+              CreatedAt TEXT
+            )""")
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS tenant_phones (
+              PhoneNumber TEXT PRIMARY KEY,
+              TenantId TEXT NOT NULL REFERENCES tenants(TenantId)
+            )""")
+            con.execute("CREATE INDEX IF NOT EXISTS idx_tenant_phones_tenant ON tenant_phones(TenantId)")
+        con.close()
+
+    # --- tenants ---
+    def add_tenant(self, tenant_id, name, location=None, admin_phones=()):
+        if not re.match(TENANT_ID_PATTERN, tenant_id):
+            raise ValueError("Tenant id must be 2-32 lowercase letters, digits, '-' or '_'")
+        location = location or os.path.join(TENANT_SHARD_DIR, f"{tenant_id}.db")
+        taken = {p: t for p in admin_phones if (t := self.tenant_for_phone(p))}
+        if taken:
+            raise ValueError(f"Phone numbers already belong to other tenants: {taken}")
+        con = self._connect()
+        try:
+            with con:
+                con.execute("INSERT INTO tenants (TenantId, Name, Location, AdminPhones, CreatedAt) VALUES (?,?,?,?,?)",
+                            (tenant_id, name, location, ",".join(admin_phones), datetime.now().isoformat(timespec="seconds")))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Tenant '{tenant_id}' already exists")
+        finally:
+            con.close()
+        return self.tenant(tenant_id)
+
+    def tenant(self, tenant_id):
+        con = self._connect()
+        row = con.execute("SELECT TenantId, Name, Location, AdminPhones FROM tenants WHERE TenantId=?", (str(tenant_id),)).fetchone()
+        con.close()
+        if not row:
+            return None
+        return {"TenantId": row[0], "Name": row[1], "Location": row[2], "AdminPhones": [p for p in row[3].split(",") if p]}
+
+    def tenants(self):
+        con = self._connect()
+        df = pd.read_sql_query("SELECT t.TenantId, t.Name, t.Location, t.CreatedAt, count(p.PhoneNumber) AS Phones "
+                               "FROM tenants t LEFT JOIN tenant_phones p ON p.TenantId = t.TenantId "
+                               "GROUP BY t.TenantId ORDER BY t.TenantId", con)
+        con.close(); return df
+
+    # --- phone routing ---
+    def _remember(self, pairs):
+        # Caller holds the lock
+        expires = time.monotonic() + PHONE_CACHE_TTL_SECONDS
+        self._phones.update((p, (t, expires)) for p, t in pairs)
+
+    def tenant_for_phone(self, phone):
+        phone = str(phone).strip()
+        with self._lock:
+            hit = self._phones.get(phone)
+        if hit and hit[1] > time.monotonic():
+            return hit[0]
+        con = self._connect()
+        row = con.execute("SELECT TenantId FROM tenant_phones WHERE PhoneNumber=?", (phone,)).fetchone()
+        con.close()
+        with self._lock:
+            if row:
+                self._remember([(phone, row[0])])
+            else:
+                self._phones.pop(phone, None)
+        return row[0] if row else None
+
+    def assign_phones(self, tenant_id, phones):
+        # -> {phone: other tenant} for phones that already belong elsewhere (those are left alone)
+        phones = [str(p) for p in phones]
+        con = self._connect()
+        try:
+            with con:
+                con.executemany("INSERT OR IGNORE INTO tenant_phones (PhoneNumber, TenantId) VALUES (?,?)",
+                                [(p, tenant_id) for p in phones])
+                owners = dict(con.execute(f"SELECT PhoneNumber, TenantId FROM tenant_phones WHERE PhoneNumber IN ({','.join('?' * len(phones))})",
+                                          phones).fetchall()) if phones else {}
+        finally:
+            con.close()
+        with self._lock:
+            self._remember(owners.items())
+        return {p: t for p, t in owners.items() if t != tenant_id}
+
+    def owners(self, phones):
+        # -> {phone: tenant} for the phones the catalog knows
+        phones = list(dict.fromkeys(str(p) for p in phones))
+        con = self._connect()
+        try:
+            found = {}
+            for i in range(0, len(phones), 500):  # stays under SQLite's bound-parameter limit
+                chunk = phones[i:i + 500]
+                found.update(con.execute(f"SELECT PhoneNumber, TenantId FROM tenant_phones WHERE PhoneNumber IN ({','.join('?' * len(chunk))})",
+                                         chunk).fetchall())
+        finally:
+            con.close()
+        return found
+
+    def reserve_phones(self, tenant_id, phones):
+        # Claims phones before a shard stores them -> (newly claimed, {phone: other tenant}).
+        # All or nothing: when any phone belongs elsewhere, none is claimed.
+        claimed, conflicts = [], {}
+        con = self._connect()
+        try:
+            for p in dict.fromkeys(str(p) for p in phones):
+                if con.execute("INSERT OR IGNORE INTO tenant_phones (PhoneNumber, TenantId) VALUES (?,?)", (p, tenant_id)).rowcount:
+                    claimed.append(p)
+                else:
+                    owner = con.execute("SELECT TenantId FROM tenant_phones WHERE PhoneNumber=?", (p,)).fetchone()[0]
+                    if owner != tenant_id:
+                        conflicts[p] = owner
+            if conflicts:
+                con.rollback()
+                return [], conflicts
+            con.commit()
+        finally:
+            con.close()
+        with self._lock:
+            self._remember((p, tenant_id) for p in claimed)
+        return claimed, {}
+
+    def release_phones(self, tenant_id, phones):
+        con = self._connect()
+        with con:
+            con.executemany("DELETE FROM tenant_phones WHERE PhoneNumber=? AND TenantId=?", [(str(p), tenant_id) for p in phones])
+        con.close()
+        with self._lock:
+            for p in phones:
+                self._phones.pop(str(p), None)
+
+
+class PhoneClaims:
+    # One tenant's writers (signup, profile, grants, bulk import) claim a phone in the catalog before the
+    # shard stores it, so a number can never belong to two organizations or to none that routes to it
+    def __init__(self, catalog, tenant_id):
+        self.catalog = catalog
+        self.tenant_id = tenant_id
+
+    def foreign(self, phones):
+        # -> {phone: other tenant}
+        return {p: t for p, t in self.catalog.owners(phones).items() if t != self.tenant_id}
+
+    def claim(self, phones):
+        return self.catalog.reserve_phones(self.tenant_id, phones)
+
+    def release(self, phones):
+        # Undo a claim whose shard write failed
+        if phones:
+            self.catalog.release_phones(self.tenant_id, phones)
+
+
+def open_shard(tenant):
+    # A new, initialized storage for a catalog entry
+    location = tenant["Location"]
+    if "://" in location:
+        from alchemy_storage import AlchemyStorage  # optional dependency, only needed for URL shards
+        s = AlchemyStorage(location, admin_phones=tenant["AdminPhones"])
+    else:
+        os.makedirs(os.path.dirname(location) or ".", exist_ok=True)
+        s = SqlStorage(location, admin_phones=tenant["AdminPhones"])
+    s.init()
+    return s
+
+
+class ShardRouter:
+    def __init__(self, catalog, max_open=MAX_OPEN_SHARDS):
+        self.catalog = catalog
+        self.max_open = max_open
+        self._shards = OrderedDict()  # tenant -> storage, least recently used first
+        self._lock = threading.Lock()
+
+    def open(self, tenant_id):
+        # Uncached: callers that manage shard lifetime themselves (the Streamlit app) use this
+        tenant = self.catalog.tenant(tenant_id)
+        if tenant is None:
+            raise KeyError(f"Unknown tenant: {tenant_id}")
+        s = open_shard(tenant)
+        s.subscribe(lambda event, payload: self._sync_phones(tenant_id, event, payload))
+        conflicts = self.catalog.assign_phones(tenant_id, s.get_users()["PhoneNumber"].astype(str).tolist())
+        if conflicts:
+            report_error(f"Tenant '{tenant_id}': phones also registered with other tenants: {conflicts}")
+        return s
+
+    def storage(self, tenant_id):
+        with self._lock:
+            s = self._shards.get(tenant_id)
+            if s is not None:
+                self._shards.move_to_end(tenant_id)
+                return s
+        s = self.open(tenant_id)
+        with self._lock:
+            s = self._shards.setdefault(tenant_id, s)  # another thread may have opened it meanwhile
+            self._shards.move_to_end(tenant_id)
+            while len(self._shards) > self.max_open:
+                self._shards.popitem(last=False)  # connections are per call, so dropping the handle closes nothing
+        return s
+
+    def claims(self, tenant_id):
+        return PhoneClaims(self.catalog, tenant_id)
+
+    def for_phone(self, phone):
+        # -> (tenant id, storage), or (None, None) for a phone no tenant knows
+        tenant_id = self.catalog.tenant_for_phone(phone)
+        return (tenant_id, self.storage(tenant_id)) if tenant_id else (None, None)
+
+    def _sync_phones(self, tenant_id, event, payload):
+        # Writers claim phones first (PhoneClaims); this keeps the index current for any that did not
+        renumbered = event == "user_updated" and payload["updates"].get("PhoneNumber") not in (None, payload["phone"])
+        if event == "user_added":
+            phones = [payload["phone"]]
+        elif renumbered:
+            phones = [payload["updates"]["PhoneNumber"]]
+        else:
+            return
+        conflicts = self.catalog.assign_phones(tenant_id, phones)
+        if conflicts:
+            report_error(f"Phone already registered with another organization: {', '.join(conflicts)}")
+        elif renumbered:
+            self.catalog.release_phones(tenant_id, [payload["phone"]])  # only once the new number routes here
+
+
+def make_router(catalog_path=TENANT_CATALOG, max_open=MAX_OPEN_SHARDS):
+    # None in single-tenant deployments (no catalog file)
+    if not tenants_enabled(catalog_path):
+        return None
+    catalog = TenantCatalog(catalog_path)
+    catalog.init()
+    return ShardRouter(catalog, max_open)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    ap = argparse.ArgumentParser(description="Manage organizations in a multi-tenant deployment")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    a = sub.add_parser("add", help="create a tenant and its shard (creates the catalog on first use)")
+    a.add_argument("tenant_id")
+    a.add_argument("name")
+    a.add_argument("--location", help=f"SQLite path or SQLAlchemy URL (default {TENANT_SHARD_DIR}/<tenant_id>.db)")
+    a.add_argument("--admin", action="append", default=[], help="admin phone; repeat for several")
+    sub.add_parser("list")
+    w = sub.add_parser("where", help="which tenant a phone belongs to")
+    w.add_argument("phone")
+    r = sub.add_parser("reindex", help="re-read a shard's users into the phone index")
+    r.add_argument("tenant_id")
+    args = ap.parse_args()
+
+    catalog = TenantCatalog()
+    catalog.init()
+    if args.cmd == "add":
+        if not args.admin:
+            sys.exit("Give at least one --admin phone for the new organization")
+        try:
+            catalog.add_tenant(args.tenant_id, args.name, args.location, args.admin)
+        except ValueError as e:
+            sys.exit(str(e))
+        ShardRouter(catalog).open(args.tenant_id)
+        print(f"created {args.tenant_id}")
+    elif args.cmd == "list":
+        print(catalog.tenants().to_string(index=False))
+    elif args.cmd == "where":
+        print(catalog.tenant_for_phone(args.phone) or "unknown")
+    else:
+        ShardRouter(catalog).open(args.tenant_id)
+        print(catalog.tenants().to_string(index=False))
@@ -0,0 +1,70 @@
+# Parquet/DuckDB mirror on a SqlStorage in tmp_path
+
+import os
+import sqlite3
+import threading
+
+import pytest
+
+pytest.importorskip("duckdb")
+pytest.importorskip("pyarrow")
+
+from analytics import AttendanceAnalytics
+from storage import SqlStorage
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    s.import_records(users=[{"PhoneNumber": "9000000001", "Name": "A", "Departments": "Sales", "PasswordHash": "x"}])
+    s.mark_attendance("9000000001", "A", "Sales", "IN", "CSMT")
+    return s, AttendanceAnalytics(s, str(tmp_path / "analytics"))
+
+
+def add_day(storage, day, office="CSMT"):
+    con = sqlite3.connect(storage.db_path)
+    con.execute("INSERT INTO attendance VALUES (?,?,?,?,?,?,?,?,?)", (day, "A", "9000000001", "09:00:00", "18:00:00", "No", "No", "Sales", office))
+    con.commit(); con.close()
+
+
+def test_refresh_mirrors_months_and_never_users_passwords(mirror):
+    storage, analytics = mirror
+    add_day(storage, "2026-01-05")
+    report = analytics.refresh(full=True)
+    assert "2026-01" in report["months"]
+    assert analytics.attendance_between("2026-01-01", "2026-01-31")["Date"].tolist() == ["2026-01-05"]
+    assert "PasswordHash" not in analytics.query("SELECT * FROM users").columns
+
+
+def test_full_refresh_drops_months_gone_from_storage(mirror):
+    storage, analytics = mirror
+    add_day(storage, "2025-03-05")
+    analytics.refresh(full=True)
+    con = sqlite3.connect(storage.db_path)
+    con.execute("DELETE FROM attendance WHERE Date='2025-03-05'")
+    con.commit(); con.close()
+    analytics.refresh(full=True)
+    assert not os.path.exists(analytics._month_path("2025-03"))
+    assert analytics.date_bounds()[0] is not None
+
+
+def test_concurrent_refreshes(mirror):
+    _, analytics = mirror
+    errors = []
+
+    def run():
+        try:
+            for _ in range(5):
+                analytics.refresh(full=True)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    leftovers = [f for _, _, files in os.walk(analytics.root) for f in files if f.endswith(".tmp")]
+    assert leftovers == []
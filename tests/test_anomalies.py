@@ -0,0 +1,64 @@
+# Attendance audit: row checks, and AnomalyScanner following the change feed of a SqlStorage in tmp_path
+
+import pandas as pd
+import pytest
+
+from anomalies import AnomalyScanner, scan_rows, today_local
+from geo import office_distance_matrix
+from storage import SqlStorage, emit_changes
+
+OFFICES = pd.DataFrame({"OfficeName": ["CSMT", "Thane"], "Latitude": [18.94358359403972, 19.236363706991003],
+                        "Longitude": [72.83826109487124, 72.98719749815108], "RadiusMeters": [350, 350]})
+
+
+def row(phone, IN="", OUT="", office="CSMT", leave="", day="2026-09-01"):
+    return {"Date": day, "Name": "A", "PhoneNumber": phone, "IN": IN, "OUT": OUT, "WFH": "", "Leave": leave, "Office": office}
+
+
+def test_row_checks():
+    df = pd.DataFrame([row("1", "10:00:00", "09:00:00"), row("2", "09:00:00"), row("3", OUT="18:00:00"),
+                       row("4", "09:00:00", "18:00:00", leave="Yes"), row("5", "06:00:00", "22:00:00"),
+                       row("6", "04:00:00", "09:00:00"), row("7", "09:00:00", day="2026-09-02"),
+                       row("8", "09:00:00", "18:00:00", office="CSMT,Thane,CSMT")])
+    found = scan_rows(df, office_distance_matrix(OFFICES), today="2026-09-02")
+    assert sorted(zip(found["PhoneNumber"], found["Anomaly"])) == [
+        ("1", "in_after_out"), ("2", "missing_out"), ("3", "out_without_in"), ("4", "punch_on_leave"),
+        ("5", "long_day"), ("6", "odd_hours")]  # 7 is still open today; 8 had 9 h for the round trip
+
+
+def test_offices_that_cannot_all_be_reached():
+    df = pd.DataFrame([row("1", "09:00:00", "09:15:00", office="CSMT,Thane")])
+    found = scan_rows(df, office_distance_matrix(OFFICES), today="2026-09-02")
+    assert found["Anomaly"].tolist() == ["multi_office_day"] and found["Detail"][0].startswith("CSMT,Thane: 3")
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    for _, o in OFFICES.iterrows():
+        s.add_office(o["OfficeName"], o["Latitude"], o["Longitude"], o["RadiusMeters"])
+    return s
+
+
+def test_feed_adds_travel_and_geofence_overrides(store):
+    scanner = AnomalyScanner(store)
+    today = today_local()
+    store.mark_attendance("9000000001", "A", "", "IN", "CSMT")
+    store.mark_attendance("9000000001", "A", "", "OUT", "Thane")
+    emit_changes(store, "geofence_override", [dict(phone="9000000002", date=today, name="B", office="CSMT",
+                                                   distance_m=2400, accuracy=20)])
+    found = scanner.scan(today, today)
+    kinds = dict(zip(found["PhoneNumber"], found["Anomaly"]))
+    assert kinds["9000000002"] == "outside_geofence" and "2.4 km away" in found["Detail"][found["PhoneNumber"] == "9000000002"].iloc[0]
+    assert "impossible_travel" in found.loc[found["PhoneNumber"] == "9000000001", "Anomaly"].tolist()
+
+
+def test_new_punches_rescan_only_their_day(store):
+    scanner = AnomalyScanner(store)
+    today = today_local()
+    assert scanner.scan(today, today).empty
+    store.mark_attendance("9000000001", "A", "", "OUT", "CSMT")
+    assert scanner.scan(today, today)["Anomaly"].tolist() == ["out_without_in"]
+    scanner.on_event("storage_reloaded", {"reason": "restore"})
+    assert scanner.scan(today, today)["Anomaly"].tolist() == ["out_without_in"]  # rebuilt from the whole feed
@@ -0,0 +1,91 @@
+# Punch API through aiohttp's test client, on a SqlStorage in tmp_path
+
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import api
+from api import load_api_keys, make_app
+from storage import SqlStorage
+
+CSMT = (18.94358359403972, 72.83826109487124)
+KEYS = {"kiosk": "CSMT", "thane-kiosk": "Thane", "backoffice": None}
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    s.add_office("CSMT", *CSMT, 350)
+    s.add_office("Thane", 19.236363706991003, 72.98719749815108, 350)
+    s.add_user({"PhoneNumber": "9000000001", "Name": "A", "Departments": "Sales", "PasswordHash": "x", "Role": "User"})
+    return s
+
+
+def call(store, requests):
+    # requests: [(method, path, key, json)] -> [(status, body)]
+    async def run():
+        async with TestClient(TestServer(make_app(store, KEYS, "sql"))) as client:
+            out = []
+            for method, path, key, body in requests:
+                r = await client.request(method, path, json=body, headers={"X-API-Key": key} if key else {})
+                out.append((r.status, await r.json()))
+            return out
+    return asyncio.run(run())
+
+
+def test_keys_are_required(store):
+    [(status, body)] = call(store, [("POST", "/punch", "nope", {"phone": "9000000001", "action": "IN"})])
+    assert status == 401 and not body["ok"]
+    assert call(store, [("GET", "/health", None, None)])[0] == (200, {"ok": True, "storage": "sql"})
+
+
+def test_office_key_punches_at_its_office(store):
+    [(status, body), (_, again)] = call(store, [("POST", "/punch", "kiosk", {"phone": "9000000001", "action": "in"})] * 2)
+    assert status == 200 and body["message"] == "Recorded" and again["message"] == "Already recorded"
+    assert store.get_attendance_row("9000000001")["Office"] == "CSMT"
+
+
+def test_unbound_key_needs_a_location_inside_the_geofence(store):
+    results = call(store, [
+        ("POST", "/punch", "backoffice", {"phone": "9000000001", "action": "IN", "office": "CSMT"}),
+        ("POST", "/punch", "backoffice", {"phone": "9000000001", "action": "IN", "office": "CSMT", "lat": 19.2, "lon": 72.98}),
+        ("POST", "/punch", "backoffice", {"phone": "9000000001", "action": "IN", "office": "CSMT", "lat": CSMT[0], "lon": CSMT[1]}),
+    ])
+    assert [s for s, _ in results] == [422, 422, 200]
+    assert results[1][1]["message"] == "Outside the CSMT geofence"
+
+
+def test_batch_reports_each_punch(store):
+    [(status, body)] = call(store, [("POST", "/punch/batch", "kiosk", {"punches": [
+        {"phone": "9000000001", "action": "IN"}, {"phone": "9000000002", "action": "IN"}, {"phone": "9000000001", "action": "NAP"}]})])
+    assert status == 200 and not body["ok"]
+    assert [r["message"] for r in body["results"]] == ["Recorded", "Unknown phone: 9000000002", "Invalid action: NAP"]
+
+
+def test_office_keys_only_see_their_own_lobby(store):
+    results = call(store, [
+        ("GET", "/status/9000000001", "kiosk", None),
+        ("POST", "/punch", "kiosk", {"phone": "9000000001", "action": "IN"}),
+        ("GET", "/status/9000000001", "kiosk", None),
+        ("GET", "/status/9000000001", "thane-kiosk", None),
+        ("GET", "/status/9000000001", "backoffice", None),
+    ])
+    assert [s for s, _ in results] == [403, 200, 200, 403, 200]
+    assert results[2][1]["attendance"]["Office"] == "CSMT"
+
+
+def test_change_feed_is_for_unbound_keys(store):
+    store.mark_attendance("9000000001", "A", "Sales", "WFH IN")
+    [(denied, _), (status, page)] = call(store, [("GET", "/changes", "kiosk", None), ("GET", "/changes?since=0&limit=10", "backoffice", None)])
+    assert denied == 403 and status == 200
+    assert [c["event"] for c in page["changes"]] == ["user_added", "attendance_marked"]
+
+
+def test_key_list_and_excel_refusal(monkeypatch, tmp_path):
+    assert load_api_keys("kiosk-csmt:CSMT, bridge-1 ,") == {"kiosk-csmt": "CSMT", "bridge-1": None}
+    monkeypatch.setenv("ATTENDANCE_API_KEYS", "k")
+    monkeypatch.setattr(api, "get_storage_mode", lambda: "excel")
+    with pytest.raises(SystemExit, match="sql or sqlalchemy"):
+        api.main([])
@@ -0,0 +1,96 @@
+# Snapshots and restore of a SqlStorage database in tmp_path
+
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import backup
+import storage
+from backup import BackupManager, list_snapshots, make_backup_manager
+from storage import ExcelStorage, SqlStorage
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    return s
+
+
+@pytest.fixture
+def backups(store, tmp_path):
+    return BackupManager(store, str(tmp_path / "backups"))
+
+
+def test_snapshot_and_restore(store, backups):
+    store.mark_attendance("9000000001", "A", "", "IN", "CSMT")
+    snap = backups.snapshot()
+    assert snap["ok"] and [s["name"] for s in backups.list_snapshots()] == [snap["name"]]
+    store.mark_attendance("9000000002", "B", "", "IN", "CSMT")
+    events = []
+    store.subscribe(lambda event, payload: events.append((event, payload.get("reason"))))
+    result = backups.restore(snap["name"])
+    assert store.get_attendance_row("9000000002") is None
+    assert store.get_attendance_row("9000000001")["Office"] == "CSMT"
+    assert result["safety_snapshot"] in {s["name"] for s in backups.list_snapshots()}
+    assert events == [("storage_reloaded", "restore")]
+
+
+def test_restore_never_reuses_change_seq(store, backups):
+    store.mark_attendance("9000000001", "A", "", "IN", "CSMT")
+    snap = backups.snapshot()["name"]
+    store.mark_attendance("9000000002", "B", "", "IN", "CSMT")
+    store.mark_attendance("9000000003", "C", "", "IN", "CSMT")
+    cursor = store.last_change_seq()  # a consumer that read everything before the restore
+    backups.restore(snap)
+    store.mark_attendance("9000000004", "D", "", "IN", "CSMT")
+    assert [c["PhoneNumber"] for c in store.get_changes(cursor)] == ["9000000004"]
+
+
+def test_restore_reloads_access_grants(store, backups):
+    snap = backups.snapshot()["name"]
+    store.grant_access(["9000000001"], "Manager")
+    assert store.has_access("9000000001")
+    backups.restore(snap)
+    assert not store.has_access("9000000001")
+
+
+def test_restore_unknown_snapshot(backups):
+    with pytest.raises(FileNotFoundError):
+        backups.restore("attendance_nope.db")
+
+
+def test_prune_keeps_recent_and_daily(backups, tmp_path):
+    root = tmp_path / "backups"
+    root.mkdir()
+    for day in range(1, 6):
+        for hour in (9, 18):
+            (root / f"attendance_202610{day:02d}-{hour:02d}0000-000_auto.db").write_bytes(b"")
+    removed = backups.prune(keep_recent=2, keep_days=3)
+    kept = [s["name"] for s in list_snapshots(str(root), ".db")]
+    assert len(kept) + len(removed) == 10
+    assert kept == ["attendance_20261005-180000-000_auto.db", "attendance_20261005-090000-000_auto.db",
+                    "attendance_20261004-180000-000_auto.db", "attendance_20261003-180000-000_auto.db"]
+
+
+def test_workbook_bursts_get_a_trailing_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backup, "EXCEL_SNAPSHOT_MIN_SECONDS", 0.3)
+    excel = ExcelStorage()
+    excel.init()
+    manager = make_backup_manager(excel, "backups")
+    try:
+        for phone in ("9000000001", "9000000002", "9000000003"):
+            excel.mark_attendance(phone, "A", "", "WFH IN")
+        # The first save is copied at once; the rest of the burst by the trailing snapshot
+        deadline, rows = time.monotonic() + 10, 0
+        while rows < 3 and time.monotonic() < deadline:
+            time.sleep(0.1)
+            snaps = manager.list_snapshots()
+            rows = len(pd.read_excel(os.path.join("backups", snaps[0]["name"]), sheet_name="attendance_1")) if snaps else 0
+        assert rows == 3 and len(manager.list_snapshots()) >= 2
+    finally:
+        manager.close()
+    assert manager.on_workbook_saved not in storage._save_listeners
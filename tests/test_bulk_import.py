@@ -0,0 +1,84 @@
+# Bulk import validation and writes, on a SqlStorage in tmp_path
+
+import pandas as pd
+import pytest
+
+from bulk_import import read_upload, run_import, template_workbook
+from storage import SqlStorage
+from tenants import ShardRouter, TenantCatalog
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    s.add_department("Sales")
+    s.add_user({"PhoneNumber": "9000000001", "Name": "A", "Departments": "Sales", "PasswordHash": "x", "Role": "User"})
+    return s
+
+
+def users(*rows):
+    return pd.DataFrame(rows, columns=["PhoneNumber", "Name", "Departments", "Password"])
+
+
+def errors(report):
+    return list(report["errors"][["Row", "Column", "Error"]].itertuples(index=False, name=None))
+
+
+def test_each_bad_row_is_reported(store):
+    report = run_import(store, {"users": users(
+        ["+91 90000-00002", "B", "Sales", ""],
+        ["9000000001", "A again", "", ""],
+        ["12345", "C", "", ""],
+        ["9000000002", "", "Ops", ""],
+    )})
+    assert errors(report) == [(3, "PhoneNumber", "User already exists"),
+                              (4, "PhoneNumber", "Phone number must be 10 digits"),
+                              (5, "PhoneNumber", "Duplicate phone number in file"),
+                              (5, "Name", "Name is empty"),
+                              (5, "Departments", "Unknown department")]
+    assert report["valid"] == {"users": 1} and not report["written"]
+    assert store.get_user("9000000002") is None  # dry run
+
+
+def test_users_may_use_departments_from_the_same_upload(store):
+    frames = {"departments": pd.DataFrame({"DepartmentGroup": ["Ops", "Sales", "Ops"]}),
+              "users": users(["9000000002", "B", "Ops, Sales", ""])}
+    report = run_import(store, frames, dry_run=False)
+    assert errors(report) == [(3, "DepartmentGroup", "Department already exists"),
+                              (4, "DepartmentGroup", "Duplicate department in file")]
+    assert report["written"] and store.get_user("9000000002")["Departments"] == "Ops,Sales"
+
+
+def test_offices_are_range_checked(store):
+    offices = pd.DataFrame({"OfficeName": ["CSMT", "Nowhere", "Far"], "Latitude": ["18.94", "0", "95"],
+                            "Longitude": ["72.83", "0", "72"], "RadiusMeters": ["", "100", "-1"]})
+    report = run_import(store, {"offices": offices}, dry_run=False)
+    assert errors(report) == [(3, "Latitude", "Coordinates are 0,0"),
+                              (4, "Latitude", "Latitude must be a number between -90 and 90"),
+                              (4, "RadiusMeters", "Radius must be a positive number")]
+    assert store.get_offices().set_index("OfficeName").loc["CSMT", "RadiusMeters"] == 350
+
+
+def test_missing_columns_skip_the_sheet(store):
+    report = run_import(store, {"users": pd.DataFrame({"PhoneNumber": ["9000000002"]})}, dry_run=False)
+    assert errors(report) == [(1, "Name", "Missing column")] and not report["written"]
+
+
+def test_phones_of_other_tenants_are_refused(tmp_path):
+    catalog = TenantCatalog(str(tmp_path / "tenants.db"))
+    catalog.init()
+    catalog.add_tenant("acme", "Acme", str(tmp_path / "acme.db"), ["9800000001"])
+    catalog.add_tenant("beta", "Beta", str(tmp_path / "beta.db"), ["9800000002"])
+    router = ShardRouter(catalog)
+    acme, _ = router.storage("acme"), router.storage("beta")  # opening a shard indexes its users
+    report = run_import(acme, {"users": users(["9800000002", "B", "", ""], ["9000000003", "C", "", ""])},
+                        dry_run=False, claims=router.claims("acme"))
+    assert errors(report) == [(2, "PhoneNumber", "Phone registered with another organization")]
+    assert report["written"] and catalog.tenant_for_phone("9000000003") == "acme"
+
+
+def test_template_round_trips(store):
+    frames = read_upload("people.xlsx", template_workbook())
+    assert sorted(frames) == ["departments", "offices", "users"]
+    assert run_import(store, frames)["errors"].empty
@@ -0,0 +1,49 @@
+# Cursor-based reads of the change feed, on a SqlStorage in tmp_path
+
+import pytest
+
+from changefeed import iter_changes, load_cursor, read_changes, save_cursor
+from storage import SqlStorage
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    for i in range(5):
+        s.mark_attendance(f"900000000{i}", "A", "", "WFH IN")
+    return s
+
+
+def test_pages_follow_the_cursor(store):
+    first = read_changes(store, 0, 2)
+    assert [c["phone"] for c in first["changes"]] == ["9000000000", "9000000001"] and first["has_more"]
+    second = read_changes(store, first["next_cursor"], 2)
+    assert [c["phone"] for c in second["changes"]] == ["9000000002", "9000000003"]
+    last = read_changes(store, second["next_cursor"], 2)
+    assert len(last["changes"]) == 1 and not last["has_more"]
+    assert read_changes(store, last["next_cursor"])["changes"] == []
+    assert read_changes(store, last["next_cursor"])["next_cursor"] == last["next_cursor"]
+
+
+def test_entries_carry_the_row_and_never_password_hashes(store):
+    store.add_user({"PhoneNumber": "9000000009", "Name": "Z", "Departments": "", "PasswordHash": "secret", "Role": "User"})
+    store.update_user("9000000009", {"PasswordHash": "other"})
+    changes = list(iter_changes(store, 0, 2))
+    assert [c["event"] for c in changes] == ["attendance_marked"] * 5 + ["user_added", "user_updated"]
+    assert changes[0]["data"]["row"]["WFH"] == "Yes" and changes[0]["date"] == changes[0]["data"]["row"]["Date"]
+    assert "PasswordHash" not in changes[5]["data"]["user"]
+    assert changes[6]["data"] == {"updates": {}, "password_changed": True}
+
+
+def test_rereading_from_an_old_cursor_is_safe(store):
+    cursor = read_changes(store, 0, 3)["next_cursor"]
+    once = [c["seq"] for c in iter_changes(store, cursor)]
+    assert once == [c["seq"] for c in iter_changes(store, cursor)] and len(once) == 2
+
+
+def test_cursor_file(tmp_path):
+    path = str(tmp_path / "payroll.cursor")
+    assert load_cursor(path) == 0
+    save_cursor(path, 42)
+    assert load_cursor(path) == 42
@@ -0,0 +1,56 @@
+# Duplicate-punch suppression, without storage: write_fn records what would be written
+
+from idempotency import DUPLICATE_MESSAGE, RecentPunches, run_deduplicated
+
+
+def punch(phone, action="IN", office="CSMT", key=None):
+    return {"phone": phone, "action": action, "office": office, "idempotency_key": key}
+
+
+class Writer:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.written = []
+
+    def __call__(self, punches):
+        self.written.append([p["phone"] for p in punches])
+        return [(False, "disk full") if p["phone"] in self.fail else (True, "Recorded") for p in punches]
+
+
+def test_repeats_are_acknowledged_without_a_write():
+    recent, write = RecentPunches(), Writer()
+    assert run_deduplicated(recent, [punch("1")], write) == [(True, "Recorded")]
+    assert run_deduplicated(recent, [punch("1"), punch("2")], write) == [(True, DUPLICATE_MESSAGE), (True, "Recorded")]
+    assert write.written == [["1"], ["2"]]
+    assert recent.suppressed == 1
+
+
+def test_idempotency_key_covers_a_changed_retry():
+    recent, write = RecentPunches(), Writer()
+    run_deduplicated(recent, [punch("1", "OUT", "CSMT", key="k1")], write)
+    assert run_deduplicated(recent, [punch("1", "OUT", "Thane", key="k1")], write) == [(True, DUPLICATE_MESSAGE)]
+    assert write.written == [["1"]]
+
+
+def test_repeat_inside_a_batch_shares_the_first_result():
+    recent, write = RecentPunches(), Writer(fail={"2"})
+    results = run_deduplicated(recent, [punch("1"), punch("2"), punch("1"), punch("2")], write)
+    assert results == [(True, "Recorded"), (False, "disk full"), (True, DUPLICATE_MESSAGE), (False, "disk full")]
+    assert write.written == [["1", "2"]]
+
+
+def test_failed_write_releases_its_keys():
+    recent = RecentPunches()
+    assert run_deduplicated(recent, [punch("1", key="k1")], Writer(fail={"1"})) == [(False, "disk full")]
+    write = Writer()
+    assert run_deduplicated(recent, [punch("1", key="k1")], write) == [(True, "Recorded")]
+    assert write.written == [["1"]]
+
+
+def test_claim_is_all_or_nothing_and_bounded():
+    recent = RecentPunches(max_entries=3)
+    assert recent.claim(["a", "b"])
+    assert not recent.claim(["c", "a"])
+    assert recent.claim(["c"]) and "c" in recent._keys  # "c" was not reserved by the refused claim
+    recent.claim(["d"])
+    assert len(recent._keys) == 3 and "b" not in recent._keys  # least recently used goes first
@@ -0,0 +1,60 @@
+# Live board and today-status cache: in-process events, and punches from another process via the change feed
+
+import pytest
+
+import occupancy
+from occupancy import OccupancyBoard, TodayStatusCache, NOT_MARKED, today_status
+from storage import SqlStorage
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    # Two instances on one database stand in for the app and the API process
+    monkeypatch.setattr(occupancy, "FEED_POLL_SECONDS", 0)
+    app, api = SqlStorage(str(tmp_path / "attendance.db")), SqlStorage(str(tmp_path / "attendance.db"))
+    app.init()
+    return app, api
+
+
+def test_board_counts_in_process_punches(stores):
+    app, _ = stores
+    board = OccupancyBoard(app)
+    board.rebuild()
+    app.subscribe(board.on_event)
+    app.mark_attendance("9000000001", "A", "Sales", "IN", "CSMT")
+    app.mark_attendance("9000000002", "B", "Sales", "WFH IN")
+    snap = board.snapshot()
+    assert snap["by_office"] == {"CSMT": 1}
+    assert snap["by_department"] == {"Sales": 2}
+    assert snap["by_status"]["WFH"] == 1
+
+
+def test_board_follows_other_processes(stores):
+    app, api = stores
+    board = OccupancyBoard(app)
+    board.rebuild()
+    app.subscribe(board.on_event)
+    api.mark_attendance("9000000001", "A", "Sales", "IN", "CSMT")
+    api.mark_attendance("9000000001", "A", "Sales", "IN", "Thane")
+    assert board.snapshot()["by_office"] == {"Thane": 1}
+    api.mark_attendance("9000000001", "A", "Sales", "OUT", "Thane")
+    assert board.snapshot()["by_status"]["Out"] == 1
+
+
+def test_today_status_follows_other_processes(stores):
+    app, api = stores
+    cache = TodayStatusCache(app)
+    app.subscribe(cache.on_event)
+    assert today_status(cache.get("9000000001")) == NOT_MARKED
+    api.mark_attendance("9000000001", "A", "", "IN", "CSMT")
+    assert today_status(cache.get("9000000001")) == "In Office"
+
+
+def test_today_status_evicts_least_recently_used(stores):
+    app, _ = stores
+    cache = TodayStatusCache(app, max_entries=2)
+    cache.get("9000000001")
+    cache.get("9000000002")
+    cache.get("9000000001")
+    cache.get("9000000003")
+    assert list(cache._rows) == ["9000000001", "9000000003"]
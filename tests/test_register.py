@@ -0,0 +1,68 @@
+# Muster register coding and its per-month cache, on a SqlStorage in tmp_path
+
+from datetime import date
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+from analytics import month_key
+from register import RegisterCache, build_register
+from storage import SqlStorage
+
+THIS_MONTH = month_key(date.today().isoformat())
+
+
+def row(phone, day, IN="", OUT="", wfh="", leave="", name="A"):
+    return {"Date": f"2026-09-{day:02d}", "Name": name, "PhoneNumber": phone, "Departments": "Sales",
+            "IN": IN, "OUT": OUT, "WFH": wfh, "Leave": leave}
+
+
+def test_days_are_coded_by_precedence():
+    attendance = pd.DataFrame([row("1", 1, IN="09:00:00"), row("1", 2, IN="09:00:00", wfh="Yes"),
+                               row("1", 3, IN="09:00:00"), row("1", 3, leave="Yes"), row("2", 1, OUT="18:00:00", name="Gone")])
+    users = pd.DataFrame([{"Name": "A", "PhoneNumber": "1", "Departments": "Sales"},
+                          {"Name": "Z", "PhoneNumber": "3", "Departments": ""}])
+    reg = build_register(attendance, users, "2026-09", today=date(2026, 9, 4))
+    assert reg["PhoneNumber"].tolist() == ["1", "2", "3"]  # sorted by name; "Gone" left users but keeps a row
+    assert reg.loc[0, ["01", "02", "03", "04", "05"]].tolist() == ["P", "WFH", "L", "A", ""]
+    assert reg.loc[0, ["P", "WFH", "L", "A"]].tolist() == [1, 1, 1, 1]
+    assert reg.loc[2, ["P", "A"]].tolist() == [0, 4] and reg.loc[1, "Name"] == "Gone"
+    assert len(reg.columns) == 3 + 30 + 4
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    return s
+
+
+def test_cache_drops_only_the_month_an_event_touches(store):
+    cache = RegisterCache(store)
+    store.subscribe(cache.on_event)
+    current, past = cache.get(THIS_MONTH), cache.get("2020-01")
+    assert cache.get(THIS_MONTH) is current
+    store.mark_attendance("9000000001", "A", "", "WFH IN")
+    assert cache.get("2020-01") is past
+    fresh = cache.get(THIS_MONTH)
+    assert fresh is not current and fresh.loc[fresh["PhoneNumber"] == "9000000001", "WFH"].tolist() == [1]
+
+
+def test_users_and_reloads_clear_every_month(store):
+    cache = RegisterCache(store)
+    store.subscribe(cache.on_event)
+    past = cache.get("2020-01")
+    store.add_user({"PhoneNumber": "9000000001", "Name": "A", "Departments": "", "PasswordHash": "x", "Role": "User"})
+    assert cache.get("2020-01") is not past
+    past = cache.get("2020-01")
+    cache.on_event("storage_reloaded", {"reason": "restore"})
+    assert cache.get("2020-01") is not past
+
+
+def test_export_is_built_once_per_register(store):
+    cache = RegisterCache(store)
+    data = cache.xlsx("2020-01")
+    assert cache.xlsx("2020-01") is data
+    sheet = pd.read_excel(BytesIO(data), sheet_name=None, header=1)
+    assert list(sheet) == ["Muster 2020-01"] and "31" in next(iter(sheet.values())).columns.astype(str)
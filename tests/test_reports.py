@@ -0,0 +1,69 @@
+# Monthly department report, on a SqlStorage in tmp_path
+
+import time
+import zipfile
+from datetime import date
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+from reports import NO_DEPARTMENT, ReportRunner, generate_report, partition_by_department, sheet_title
+from storage import SqlStorage
+
+MONTH = date.today().strftime("%Y-%m")
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SqlStorage(str(tmp_path / "attendance.db"))
+    s.init()
+    s.mark_attendance("9000000001", "A", "HR,Ops", "IN", "CSMT")
+    s.mark_attendance("9000000002", "B", "Ops", "WFH IN")
+    s.mark_attendance("9000000003", "C", "", "IN", "CSMT")
+    return s
+
+
+def test_people_appear_under_each_of_their_departments():
+    df = pd.DataFrame({"Departments": ["HR, Ops", "Ops", ""], "Name": ["A", "B", "C"]})
+    parts = partition_by_department(df)
+    assert list(parts) == ["HR", "Ops", NO_DEPARTMENT]
+    assert parts["Ops"]["Name"].tolist() == ["A", "B"] and "Department" not in parts["Ops"]
+    assert partition_by_department(df.iloc[:0]) == {}
+
+
+def test_sheet_titles_are_valid_and_unique():
+    used = {"overview"}
+    assert sheet_title("R&D / QA", used) == "R&D _ QA"
+    assert sheet_title("Overview", used) == "Overview~2"
+    long = "x" * 40
+    assert [sheet_title(long, used) for _ in range(2)] == ["x" * 31, "x" * 29 + "~2"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_merged_workbook_has_a_sheet_per_department(store, workers):
+    name, data = generate_report(store, MONTH, "xlsx", workers)
+    assert name == f"attendance_report_{MONTH}.xlsx"
+    sheets = pd.read_excel(BytesIO(data), sheet_name=None, header=None)
+    assert list(sheets) == ["Overview", "HR", "Ops", NO_DEPARTMENT]
+    overview = sheets["Overview"].iloc[5:, :4].values.tolist()
+    assert overview == [["HR", 1, 1, 0], ["Ops", 2, 1, 1], [NO_DEPARTMENT, 1, 1, 0]]
+    assert sheets["Ops"].iloc[0, 0] == f"Ops - {MONTH}"
+
+
+def test_zip_holds_one_workbook_per_sheet(store):
+    name, data = generate_report(store, MONTH, "zip", workers=1)
+    with zipfile.ZipFile(BytesIO(data)) as zf:
+        assert name.endswith(".zip") and sorted(zf.namelist()) == sorted(
+            ["Overview.xlsx", "HR.xlsx", "Ops.xlsx", f"{NO_DEPARTMENT}.xlsx"])
+
+
+def test_runner_reports_progress_and_failures(store):
+    runner = ReportRunner(store, workers=1)
+    ok, bad = runner.start(MONTH, requested_by="admin"), runner.start("not-a-month")
+    deadline = time.monotonic() + 30
+    while runner.running() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    jobs = {j["id"]: j for j in runner.jobs()}
+    assert jobs[ok]["status"] == "done" and jobs[ok]["done"] == jobs[ok]["total"] == 3
+    assert jobs[bad]["status"] == "failed" and jobs[bad]["error"]
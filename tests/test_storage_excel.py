@@ -0,0 +1,63 @@
+# ExcelStorage in a scratch directory (the workbook and changes.db are relative paths)
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+import pytest
+
+import storage
+from storage import ExcelStorage
+
+
+def today():
+    return datetime.now(ZoneInfo("Asia/Kolkata")).date()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    s = ExcelStorage()
+    s.init()
+    return s
+
+
+def test_failed_save_is_not_acknowledged(store):
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr(storage, "write_sheet", lambda sheet, df: False)
+        assert store.mark_attendance("9000000001", "A", "", "IN", "CSMT") == (False, "Could not save attendance")
+        assert store.update_user("8080042473", {"Name": "Boss"}) is False
+    assert store.get_changes() == []
+    assert store.mark_attendance("9000000001", "A", "", "IN", "CSMT") == (True, "Recorded")
+    assert store.get_attendance_row("9000000001")["Office"] == "CSMT"
+    assert [c["Event"] for c in store.get_changes()] == ["attendance_marked"]
+
+
+def test_update_without_a_row_emits_nothing(store):
+    events = []
+    store.subscribe(lambda event, payload: events.append(event))
+    assert store.update_attendance_fields("9000000001", "2026-10-19", {"IN": "09:00:00"}) is False
+    assert events == [] and store.get_changes() == []
+
+
+def test_rotated_history_stays_readable(store, monkeypatch):
+    day = today().isoformat()
+    old = pd.DataFrame([{"Date": "2026-09-01", "Name": "A", "PhoneNumber": "9000000001", "IN": "09:00:00", "OUT": "18:00:00",
+                         "WFH": "No", "Leave": "No", "Departments": "", "Office": "CSMT"}])
+    storage.write_sheet("attendance_1", old)
+    store.mark_attendance("9000000002", "B", "", "WFH IN")
+    monkeypatch.setattr(storage, "ROW_LIMIT", 1)
+    assert store.run_maintenance()["rotated_to"] == "attendance_2"
+    # Today's row moved with the new sheet; history stays in the archive and is still read
+    assert storage.read_sheet("attendance_1")["Date"].tolist() == ["2026-09-01"]
+    assert store.get_attendance_row("9000000002")["WFH"] == "Yes"
+    assert sorted(store.get_attendance_between("2026-09-01", day)["PhoneNumber"]) == ["9000000001", "9000000002"]
+    assert store.update_attendance_fields("9000000001", "2026-09-01", {"OUT": "17:00:00"})
+    assert store.get_attendance_between("2026-09-01", "2026-09-01").iloc[0]["OUT"] == "17:00:00"
+
+
+def test_grants_round_trip(store):
+    assert store.grant_access(["9000000001", "9000000001"], "Manager", "8080042473") == 1
+    assert store.has_access("9000000001", ["Manager"]) and not store.has_access("9000000001", ["Admin"])
+    assert store.revoke_access(["9000000001"]) == 1
+    assert not store.has_access("9000000001")
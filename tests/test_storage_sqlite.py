@@ -0,0 +1,153 @@
+# Storage interface against SQLite: SqlStorage, and AlchemyStorage on a sqlite:/// URL
+
+import sqlite3
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from storage import SqlStorage
+
+
+def open_store(kind, path):
+    if kind == "sql":
+        s = SqlStorage(str(path))
+    else:
+        alchemy_storage = pytest.importorskip("alchemy_storage")
+        s = alchemy_storage.AlchemyStorage(f"sqlite:///{path}")
+    s.init()
+    return s
+
+
+@pytest.fixture(params=["sql", "sqlalchemy"])
+def store(request, tmp_path):
+    return open_store(request.param, tmp_path / "attendance.db")
+
+
+def today():
+    return datetime.now(ZoneInfo("Asia/Kolkata")).date()
+
+
+def edit(target, field, old, new, at):
+    return {"DateTime": at, "EditedByPhone": "8080042473", "EditedByName": "Admin1", "TargetPhone": target,
+            "Date": today().isoformat(), "Field": field, "OldValue": old, "NewValue": new, "Reason": "fix"}
+
+
+def test_mark_and_dedup(store):
+    assert store.mark_attendance("9000000001", "A", "Sales", "IN", "CSMT") == (True, "Recorded")
+    assert store.mark_attendance("9000000001", "A", "Sales", "IN", "CSMT") == (True, "Already recorded")
+    assert store.mark_attendance("9000000001", "A", "Sales", "OUT", "Thane", idempotency_key="k1") == (True, "Recorded")
+    assert store.mark_attendance("9000000001", "A", "Sales", "OUT", "Nerul", idempotency_key="k1") == (True, "Already recorded")
+    row = store.get_attendance_row("9000000001")
+    assert row["IN"] and row["OUT"] and row["Office"] == "CSMT,Thane" and row["WFH"] == "No"
+    assert len(store.get_attendance()) == 1
+
+
+def test_batch_keeps_order_and_rejects_invalid(store):
+    results = store.mark_attendance_batch([
+        {"phone": "9000000001", "name": "A", "deps": "", "action": "IN", "office": "CSMT"},
+        {"phone": "9000000002", "name": "B", "deps": "", "action": "NAP"},
+        {"phone": "9000000001", "name": "A", "deps": "", "action": "IN", "office": "CSMT"},
+        {"phone": "9000000003", "name": "C", "deps": "", "action": "WFH IN"},
+    ])
+    assert results == [(True, "Recorded"), (False, "Invalid action: NAP"), (True, "Already recorded"), (True, "Recorded")]
+    assert store.get_attendance_row("9000000002") is None
+    assert store.get_attendance_row("9000000003")["WFH"] == "Yes"
+
+
+def test_failed_write_is_retried(store):
+    def broken(*args):
+        raise RuntimeError("disk I/O error")
+
+    apply_punch, store._apply_punch = store._apply_punch, broken
+    assert store.mark_attendance("9000000001", "A", "", "IN", "CSMT")[0] is False
+    store._apply_punch = apply_punch
+    assert store.mark_attendance("9000000001", "A", "", "IN", "CSMT") == (True, "Recorded")
+    assert store.get_attendance_row("9000000001")["Office"] == "CSMT"
+
+
+def test_edits_round_trip(store):
+    store.append_edit(edit("9000000001", "OUT", "", "18:00:00", "2026-10-19T10:00:00"))
+    store.append_edit(edit("9000000001", "IN", "09:40:00", "09:30:00", "2026-10-19T09:00:00"))
+    edits = store.get_edits()
+    assert list(edits.columns) == ["DateTime", "EditedByPhone", "EditedByName", "TargetPhone", "Date", "Field", "OldValue", "NewValue", "Reason"]
+    assert sorted(edits["Field"]) == ["IN", "OUT"]
+
+
+# The schema attendance.db had before access grants and the change feed (no Id column on edits)
+LEGACY_SCHEMA = """
+CREATE TABLE users (PhoneNumber TEXT PRIMARY KEY, Name TEXT, Departments TEXT, PasswordHash TEXT, Role TEXT);
+CREATE TABLE attendance (Date TEXT, Name TEXT, PhoneNumber TEXT, IN_TIME TEXT, OUT_TIME TEXT, WFH TEXT, Leave TEXT,
+                         Departments TEXT, Office TEXT, PRIMARY KEY (Date, PhoneNumber));
+CREATE TABLE offices (OfficeName TEXT PRIMARY KEY, Latitude REAL, Longitude REAL, RadiusMeters REAL);
+CREATE TABLE departments (DepartmentGroup TEXT PRIMARY KEY);
+CREATE TABLE settings (Key TEXT PRIMARY KEY, Value TEXT);
+CREATE TABLE attendance_edits (DateTime TEXT, EditedByPhone TEXT, EditedByName TEXT, TargetPhone TEXT, Date TEXT,
+                               Field TEXT, OldValue TEXT, NewValue TEXT, Reason TEXT);
+INSERT INTO users VALUES ('8080042473', 'Admin1', 'Management Team', 'x', 'Admin');
+INSERT INTO settings VALUES ('whitelist', '9000000005');
+INSERT INTO attendance VALUES ('2026-01-05', 'A', '9000000001', '09:00:00', '18:00:00', 'No', 'No', '', 'CSMT');
+INSERT INTO attendance_edits VALUES ('2026-01-05T19:00:00', '8080042473', 'Admin1', '9000000001', '2026-01-05', 'OUT', '', '18:00:00', 'fix');
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = tmp_path / "legacy.db"
+    con = sqlite3.connect(path)
+    con.executescript(LEGACY_SCHEMA)
+    con.close()
+    return path
+
+
+@pytest.mark.parametrize("kind", ["sql", "sqlalchemy"])
+def test_existing_database_opens_unchanged(kind, legacy_db):
+    s = open_store(kind, legacy_db)
+    assert len(s.get_edits()) == 1
+    s.append_edit(edit("9000000001", "IN", "", "09:30:00", "2026-10-19T09:00:00"))
+    assert len(s.get_edits()) == 2
+    assert s.get_attendance_between("2026-01-01", "2026-01-31")["Office"].tolist() == ["CSMT"]
+    assert s.has_access("9000000005") and s.get_setting("whitelist") == ""  # whitelist moved into access grants
+    assert s.mark_attendance("9000000001", "A", "", "IN", "CSMT") == (True, "Recorded")
+
+
+def test_update_and_maintenance(store):
+    store.mark_attendance("9000000001", "A", "", "IN", "CSMT")
+    store.update_attendance_fields("9000000001", today(), {"IN": "09:00:00", "Office": "Thane"})
+    report = store.run_maintenance()
+    assert report["backend"] in ("sql", "sqlalchemy")
+    row = store.get_attendance_row("9000000001")
+    assert (row["IN"], row["Office"]) == ("09:00:00", "Thane")
+    assert store.get_attendance_between(today(), today())["PhoneNumber"].tolist() == ["9000000001"]
+
+
+def test_feed_commits_with_the_mutation(store):
+    events = []
+    store.subscribe(lambda event, payload: events.append(event))
+    store.mark_attendance("9000000001", "A", "", "IN", "CSMT")
+    store.update_user("9000000001", {"Name": "nobody"})  # no such user
+    store.update_attendance_fields("9000000002", today(), {"IN": "09:00:00"})  # no such row
+    store.update_attendance_fields("9000000001", today(), {"IN": "09:00:00"})
+    store.append_edit(edit("9000000001", "IN", "", "09:00:00", "2026-10-19T09:00:00"))
+    feed = store.get_changes()
+    assert [c["Event"] for c in feed] == events == ["attendance_marked", "attendance_updated", "edit_appended"]
+    assert [c["Seq"] for c in feed] == sorted(c["Seq"] for c in feed)
+
+
+def test_feed_and_data_commit_together(store, tmp_path):
+    # Without its feed entry the punch itself is rolled back
+    con = sqlite3.connect(tmp_path / "attendance.db")
+    con.execute("DROP TABLE change_log")
+    con.close()
+    assert store.mark_attendance("9000000001", "A", "", "IN", "CSMT")[0] is False
+    assert store.get_attendance_row("9000000001") is None
+
+
+def test_revoke_reaches_other_instances(store, tmp_path):
+    # Another replica's cached grants follow a revoke on its next check
+    other = open_store("sql" if isinstance(store, SqlStorage) else "sqlalchemy", tmp_path / "attendance.db")
+    store.grant_access(["9000000001"], "Manager", "8080042473")
+    assert other.has_access("9000000001", ["Manager"])
+    store.revoke_access(["9000000001"])
+    assert not other.has_access("9000000001")
+    assert other.has_access("8080042473")
@@ -0,0 +1,62 @@
+# Tenant catalog and shard routing, with SQLite shards in tmp_path
+
+import time
+
+import pytest
+
+import tenants
+from tenants import ShardRouter, TenantCatalog
+
+
+def user(phone, name="A"):
+    return {"PhoneNumber": phone, "Name": name, "Departments": "", "PasswordHash": "x", "Role": "User"}
+
+
+@pytest.fixture
+def router(tmp_path):
+    catalog = TenantCatalog(str(tmp_path / "tenants.db"))
+    catalog.init()
+    catalog.add_tenant("acme", "Acme", str(tmp_path / "acme.db"), ["9800000001"])
+    catalog.add_tenant("beta", "Beta", str(tmp_path / "beta.db"), ["9800000002"])
+    r = ShardRouter(catalog)
+    r.storage("acme"), r.storage("beta")  # opening a shard indexes its users
+    return r
+
+
+def test_phones_route_to_their_shard(router):
+    assert router.catalog.tenant_for_phone("9800000001") == "acme"
+    tenant_id, s = router.for_phone("9800000002")
+    assert tenant_id == "beta" and s.get_user("9800000002")["Name"] == "Admin1"
+    assert router.for_phone("9000000009") == (None, None)
+
+
+def test_reserve_is_all_or_nothing(router):
+    claimed, conflicts = router.claims("acme").claim(["9000000001", "9800000002"])
+    assert (claimed, conflicts) == ([], {"9800000002": "beta"})
+    assert router.catalog.tenant_for_phone("9000000001") is None
+    assert router.claims("acme").claim(["9000000001", "9800000001"]) == (["9000000001"], {})
+    router.claims("acme").release(["9000000001"])
+    assert router.catalog.tenant_for_phone("9000000001") is None
+
+
+def test_renumbering_onto_a_taken_phone_keeps_the_old_route(router):
+    acme = router.storage("acme")
+    acme.add_user(user("9000000001"))
+    acme.update_user("9000000001", {"PhoneNumber": "9800000002"})
+    assert router.catalog.owners(["9000000001", "9800000002"]) == {"9000000001": "acme", "9800000002": "beta"}
+    acme.add_user(user("9000000003"))
+    acme.update_user("9000000003", {"PhoneNumber": "9000000004"})
+    assert router.catalog.owners(["9000000003", "9000000004"]) == {"9000000004": "acme"}
+
+
+def test_routes_from_another_process_expire(router, monkeypatch):
+    # A second catalog instance stands in for the API process
+    monkeypatch.setattr(tenants, "PHONE_CACHE_TTL_SECONDS", 0.2)
+    other = TenantCatalog(router.catalog.path)
+    router.claims("acme").claim(["9000000001"])
+    assert other.tenant_for_phone("9000000001") == "acme"
+    router.claims("acme").release(["9000000001"])
+    router.claims("beta").claim(["9000000001"])
+    assert other.tenant_for_phone("9000000001") == "acme"  # still cached
+    time.sleep(0.3)
+    assert other.tenant_for_phone("9000000001") == "beta"